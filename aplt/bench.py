@@ -0,0 +1,508 @@
+"""Benchmarks for the load-tester's own throughput ceilings
+
+Each benchmark runs for a fixed duration and reports how fast the
+load-tester itself managed to go, so a bad load-test result can be told
+apart from aplt saturating, and regressions in aplt show up between
+releases. Benchmarks that need a push server run against the local stand-in
+from :mod:`aplt.server`, started in its own process so that its work and
+memory aren't counted against the load-tester.
+
+Results can be written as JSON with ``--output``.
+
+"""
+import gc
+import json
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+from configargparse import ArgumentParser
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+from aplt import __version__
+from aplt.codec import LIBRARY as JSON_LIBRARY
+from aplt.client import CommandProcessor
+from aplt.commands import (
+    ack,
+    connect,
+    counter,
+    disconnect,
+    expect_notification,
+    hello,
+    random_channel_id,
+    register,
+    send_notification,
+    timer_end,
+    timer_start,
+    wait,
+)
+from aplt.metrics import AggregateMetrics, SinkMetrics
+from aplt.runner import LoadRunner
+from aplt.scenarios import connect_and_idle_forever
+from aplt.vapid import BACKENDS, Vapid
+
+
+# Number of commands run back to back before yielding to the reactor
+COMMAND_BATCH = 100
+
+
+def measure(func, duration):
+    """Call a function repeatedly for ``duration`` seconds, returning the
+    number of calls per second"""
+    count = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < duration:
+        func()
+        count += 1
+        elapsed = time.time() - start
+    return count / elapsed
+
+
+def rss():
+    """Resident set size of this process, in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:  # pragma: nocover
+        # Peak rather than current, in KB on Linux but bytes on OSX
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+##############################################################################
+# Benchmark scenarios
+##############################################################################
+
+def _connect_loop(deadline):
+    while time.time() < deadline:
+        yield connect()
+        yield counter("bench.connections", 1)
+        yield disconnect()
+
+
+def _command_loop(deadline):
+    while time.time() < deadline:
+        for _ in range(COMMAND_BATCH):
+            yield counter("bench.commands", 1)
+        yield wait(0)
+
+
+def _idle_loop():
+    while True:
+        yield wait(100)
+
+
+def _counters(count):
+    for _ in range(count):
+        yield counter("bench.dispatch", 1)
+
+
+def _timers(count):
+    for _ in range(count // 2):
+        yield timer_start("bench.dispatch")
+        yield timer_end("bench.dispatch")
+
+
+def _nested_counter():
+    yield counter("bench.dispatch", 1)
+
+
+def _nested(count):
+    # Each nested scenario is two commands: itself and its counter
+    for _ in range(count // 2):
+        yield _nested_counter()
+
+
+DISPATCH_SCENARIOS = OrderedDict([
+    ("counter", _counters),
+    ("timer", _timers),
+    ("nested", _nested),
+])
+
+
+class NullHarness(object):
+    """Stands in for a :class:`aplt.runner.RunnerHarness`, dropping metrics
+    and firing :attr:`done` once the scenario ends"""
+    def __init__(self):
+        self.done = defer.Deferred()
+
+    def counter(self, name, count=1):
+        pass
+
+    def timer(self, name, duration):
+        pass
+
+    def remove_processor(self, processor=None):
+        self.done.callback(None)
+
+
+def _notification_loop(deadline):
+    yield connect()
+    yield hello(None)
+    reg, endpoint = yield register(random_channel_id())
+    while time.time() < deadline:
+        yield send_notification(endpoint, "benchmark", headers={"TTL": "0"})
+        notif = yield expect_notification(reg["channelID"], 5)
+        if notif:
+            yield ack(channel_id=notif["channelID"], version=notif["version"])
+            yield counter("bench.notifications", 1)
+    yield disconnect()
+
+
+def run_plan(websocket_url, scenario, quantity, *scenario_args):
+    """Launch ``quantity`` instances of a scenario at once
+
+    :returns: a deferred firing with the counters the scenarios recorded and
+        the seconds taken once they've all finished.
+
+    """
+    metrics = AggregateMetrics(SinkMetrics())
+    load_runner = LoadRunner(
+        [(scenario, quantity, quantity, 0, (scenario_args, {}))],
+        metrics, websocket_url, None, None, None)
+    d = defer.Deferred()
+    start = time.time()
+
+    def check_done():
+        if load_runner.finished:
+            d.callback((metrics.collect()[0], time.time() - start))
+        else:
+            reactor.callLater(0.01, check_done)
+    load_runner.start()
+    reactor.callLater(0, check_done)
+    return d
+
+
+def _rate(counter_name, result_name, quantity):
+    def rate(result):
+        counters, elapsed = result
+        return OrderedDict([
+            (result_name, counters.get(counter_name, 0) / elapsed),
+            ("clients", quantity),
+        ])
+    return rate
+
+
+##############################################################################
+# Benchmarks
+##############################################################################
+
+def bench_vapid(duration=1.0, backends=None):
+    """Measure VAPID signatures/sec for each crypto backend
+
+    Every signature is of a fresh set of claims, as when the signed header
+    cache misses.
+
+    :returns: a dict of signatures/sec by backend name.
+
+    """
+    results = OrderedDict()
+    for name in sorted(backends or BACKENDS):
+        vapid = Vapid(backend=name)
+        vapid.generate_keys()
+        claims = {"aud": "https://updates.push.services.mozilla.com",
+                  "sub": "mailto:loadtest@example.com"}
+        exp = [int(time.time()) + 86400]
+
+        def sign():
+            exp[0] += 1
+            vapid.sign(dict(claims, exp=exp[0]))
+        results[name] = measure(sign, duration)
+    return results
+
+
+def bench_connect(websocket_url, duration=1.0, concurrency=100):
+    """Measure WebSocket connections/sec established through
+    :meth:`aplt.runner.RunnerHarness.connect`"""
+    d = run_plan(websocket_url, _connect_loop, concurrency,
+                 time.time() + duration)
+    d.addCallback(_rate("bench.connections", "connections_per_sec",
+                        concurrency))
+    return d
+
+
+def bench_command(duration=1.0, concurrency=100):
+    """Measure commands/sec run by :class:`aplt.client.CommandProcessor`
+
+    Only ``counter`` commands are run, so no connection is needed and
+    nearly all the time is spent dispatching commands.
+
+    """
+    d = run_plan("ws://localhost:9/", _command_loop, concurrency,
+                 time.time() + duration)
+    d.addCallback(_rate("bench.commands", "commands_per_sec", concurrency))
+    return d
+
+
+def bench_notification(websocket_url, duration=1.0, concurrency=100):
+    """Measure notifications/sec sent, received and acked end to end"""
+    d = run_plan(websocket_url, _notification_loop, concurrency,
+                 time.time() + duration)
+    d.addCallback(_rate("bench.notifications", "notifications_per_sec",
+                        concurrency))
+    return d
+
+
+def bench_idle_rss(websocket_url, connections=500, timeout=60):
+    """Measure the memory held per connection of the
+    :func:`aplt.scenarios.connect_and_idle_forever` scenario
+
+    Connections are dropped again once measured.
+
+    """
+    gc.collect()
+    before = rss()
+    load_runner = LoadRunner(
+        [(connect_and_idle_forever, connections, connections, 0, ((), {}))],
+        SinkMetrics(), websocket_url, None, None, None)
+    load_runner.start()
+    harness = load_runner._harnesses[0]
+    deadline = time.time() + timeout
+    d = defer.Deferred()
+
+    def check_connected():
+        connected = len(harness._ws_clients)
+        if connected < connections and time.time() < deadline:
+            reactor.callLater(0.1, check_connected)
+            return
+        gc.collect()
+        used = rss() - before
+        for client, processor in harness._ws_clients.items():
+            # End the scenario first, or it takes the disconnect as an error
+            processor.setTimeout(None)
+            processor.shutdown(ended=True)
+            del client.processor
+            client.dropConnection(abort=True)
+        d.callback(OrderedDict([
+            ("bytes_per_connection", used / max(connected, 1)),
+            ("connections", connected),
+        ]))
+    reactor.callLater(0.1, check_connected)
+    return d
+
+
+@defer.inlineCallbacks
+def bench_dispatch(count=100000):
+    """Measure the time :class:`aplt.client.CommandProcessor` takes to run
+    a command, for a few kinds of command
+
+    :returns: a deferred firing with nanoseconds per command by kind.
+
+    """
+    results = OrderedDict()
+    for name, scenario in DISPATCH_SCENARIOS.items():
+        harness = NullHarness()
+        processor = CommandProcessor(scenario, (count,), {}, harness)
+        start = time.time()
+        processor.run()
+        yield harness.done
+        results[name + "_ns"] = (time.time() - start) * 1e9 / count
+    defer.returnValue(results)
+
+
+def bench_processor_rss(processors=50000):
+    """Measure the memory held per idle virtual client by its
+    :class:`aplt.client.CommandProcessor`, without any connection
+
+    Every processor is left waiting on a timer, as idle clients are.
+
+    """
+    gc.collect()
+    before = rss()
+    clients = []
+    for _ in range(processors):
+        processor = CommandProcessor(_idle_loop, (), {}, None)
+        processor.run()
+        clients.append(processor)
+    gc.collect()
+    used = rss() - before
+    for processor in clients:
+        processor.setTimeout(None)
+    return OrderedDict([
+        ("bytes_per_client", used / max(processors, 1)),
+        ("clients", processors),
+    ])
+
+
+BENCHMARKS = OrderedDict([
+    ("vapid", lambda args: bench_vapid(args.duration)),
+    ("command", lambda args: bench_command(args.duration, args.concurrency)),
+    ("dispatch", lambda args: bench_dispatch()),
+    ("connect", lambda args: bench_connect(args.websocket_url, args.duration,
+                                           args.concurrency)),
+    ("notification", lambda args: bench_notification(
+        args.websocket_url, args.duration, args.concurrency)),
+    ("idle_rss", lambda args: bench_idle_rss(args.websocket_url,
+                                             args.idle_connections)),
+    ("processor_rss", lambda args: bench_processor_rss(
+        args.idle_processors)),
+])
+
+# Benchmarks that need a push server
+SERVER_BENCHMARKS = ("connect", "notification", "idle_rss")
+
+
+@defer.inlineCallbacks
+def run_benchmarks(arguments):
+    """Run the benchmarks named in the arguments one after another
+
+    :returns: a deferred firing with a dict of results by benchmark name.
+
+    """
+    results = OrderedDict()
+    for name in arguments.benchmarks:
+        results[name] = yield defer.maybeDeferred(BENCHMARKS[name],
+                                                  arguments)
+        for key, value in results[name].items():
+            if isinstance(value, float):
+                value = round(value, 1)
+            print("{}.{}: {}".format(name, key, value))
+    defer.returnValue(results)
+
+
+def _free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def start_server(timeout=10):
+    """Start a local stand-in server in its own process
+
+    :returns: the process and its WebSocket URL, once it's listening.
+
+    """
+    port = _free_port()
+    with open("/dev/null", "w") as devnull:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "aplt.server", "--port={}".format(port),
+             "--endpoint_port={}".format(_free_port())],
+            stdout=devnull, stderr=devnull)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            break
+        except socket.error:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise Exception("Stand-in server didn't start")
+            time.sleep(0.1)
+    return process, "ws://127.0.0.1:{}/".format(port)
+
+
+def parse_bench_args(args):
+    parser = ArgumentParser(
+        description="Benchmark the load-tester",
+    )
+    parser.add_argument("--duration",
+                        help="seconds to run each benchmark for",
+                        type=float,
+                        default=3.0)
+    parser.add_argument("--concurrency",
+                        help="number of scenarios run at once",
+                        type=int,
+                        default=100)
+    parser.add_argument("--idle_connections",
+                        help="number of connections to measure memory use "
+                             "over",
+                        type=int,
+                        default=500)
+    parser.add_argument("--idle_processors",
+                        help="number of scenario processors to measure "
+                             "memory use over",
+                        type=int,
+                        default=50000)
+    parser.add_argument("-u", "--websocket_url",
+                        help="push server to benchmark against (default: "
+                             "start a local stand-in server)")
+    parser.add_argument("-o", "--output",
+                        help="file to write JSON results to, - for stdout")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run (default: all of them)")
+    arguments = parser.parse_args(args)
+    for name in arguments.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark: {}".format(name))
+    arguments.benchmarks = arguments.benchmarks or list(BENCHMARKS)
+    return arguments
+
+
+def write_results(arguments, results):
+    """Write the results of a run as JSON to the output named in the
+    arguments"""
+    report = OrderedDict([
+        ("aplt_version", __version__),
+        ("python", "{} {}".format(platform.python_implementation(),
+                                  platform.python_version())),
+        ("platform", platform.platform()),
+        ("json", JSON_LIBRARY),
+        ("time", int(time.time())),
+        ("duration", arguments.duration),
+        ("concurrency", arguments.concurrency),
+        ("results", results),
+    ])
+    output = json.dumps(report, indent=2)
+    if arguments.output == "-":
+        print(output)
+    else:
+        with open(arguments.output, "w") as f:
+            f.write(output + "\n")
+    return report
+
+
+def run_bench(args=None, run=True):
+    """Run benchmarks
+
+    Usage:
+        aplt_bench [BENCHMARK ...]
+                   [--duration=DURATION]
+                   [--concurrency=CONCURRENCY]
+                   [--idle_connections=IDLE_CONNECTIONS]
+                   [--idle_processors=IDLE_PROCESSORS]
+                   [-u WEBSOCKET_URL --websocket_url=WEBSOCKET_URL]
+                   [-o OUTPUT --output=OUTPUT]
+
+    BENCHMARK is one of:
+        vapid:        VAPID signatures/sec for each crypto backend
+        command:      scenario commands/sec, without any connection
+        dispatch:     nanoseconds to run a counter, timer or nested scenario
+                      command
+        connect:      WebSocket connections/sec
+        notification: notifications/sec sent, received and acked
+        idle_rss:     memory per idle connection
+        processor_rss: memory per idle scenario processor, without its
+                      connection
+
+    """
+    arguments = parse_bench_args(args)
+    server = None
+    if not arguments.websocket_url and \
+            set(arguments.benchmarks) & set(SERVER_BENCHMARKS):
+        server, arguments.websocket_url = start_server()
+
+    d = run_benchmarks(arguments)
+    if arguments.output:
+        d.addCallback(lambda results: write_results(arguments, results))
+    d.addErrback(log.err)
+
+    def finish(result):
+        if server:
+            server.terminate()
+            server.wait()
+        if run:
+            reactor.stop()
+        return result
+    d.addBoth(finish)
+    if run:
+        reactor.run()
+    else:
+        return d
@@ -3,16 +3,31 @@
 Handles interactions on behalf of a single client.
 
 """
-import json
+import itertools
 import time
 import types
 import sys
 import urlparse
+from collections import deque
 
 from autobahn.twisted.websocket import WebSocketClientProtocol
 from twisted.internet import reactor
-from twisted.protocols import policies
-from twisted.python import log
+from twisted.logger import Logger
+
+import aplt.codec as codec
+import aplt.commands as commands
+from aplt.logobserver import DEBUG, log_error, tracing
+from aplt.timers import get_wheel
+
+logger = Logger()
+
+# Orders stored notifications across channels
+_arrivals = itertools.count()
+
+# Commands a processor runs directly inside one another before handing the
+# next one to the reactor, bounding the stack used by runs of synchronous
+# commands and nested scenarios
+MAX_DEPTH = 50
 
 
 class WSClientProtocol(WebSocketClientProtocol):
@@ -25,7 +40,7 @@ class WSClientProtocol(WebSocketClientProtocol):
 
     def onMessage(self, payload, isBinary):
         try:
-            data = json.loads(payload)
+            data = codec.loads(payload, self.processor.skip_fields)
         except Exception as exc:
             self.processor.handle(dict(messageType="error", exception=exc))
         else:
@@ -42,30 +57,85 @@ class WSClientProtocol(WebSocketClientProtocol):
             pass
 
 
-class CommandProcessor(object, policies.TimeoutMixin):
+class CommandProcessor(object):
     """Created per Virtual Client to run a client scenario"""
     valid_commands = ["spawn", "connect", "disconnect", "register", "hello",
-                      "unregister", "send_notification", "expect_notification",
-                      "expect_notifications", "ack", "wait", "timer_start",
-                      "timer_end", "counter"]
+                      "unregister", "send_notification", "send_notifications",
+                      "expect_notification", "expect_notifications", "ack",
+                      "wait", "timer_start", "timer_end", "counter"]
     valid_handlers = ["connect", "disconnect", "error", "hello",
                       "notification", "register", "unregister"]
-
-    def __init__(self, scenario, scenario_args, scenario_kw, harness):
+    # Command class to the name of the method running it
+    dispatch = dict((getattr(commands, name), name)
+                    for name in valid_commands)
+    # Kept small, as there's one of these per virtual client
+    __slots__ = ("_harness", "_retries", "_current_tries", "_scenario_func",
+                 "_scenario_args", "_scenario_kw", "_scenario",
+                 "_last_command", "_expecting", "_waiting", "_connected",
+                 "_ws_client", "_notifications", "_timers",
+                 "_launch_lag", "_timeout", "_depth", "_run_id",
+                 "_finished", "_pending_sends")
+
+    def __init__(self, scenario, scenario_args, scenario_kw, harness,
+                 intended_start=None):
         self._harness = harness
-        self._retries = getattr(scenario, "_retries", None)
-        self._current_tries = 0
         self._scenario_func = scenario
         self._scenario_args = scenario_args
         self._scenario_kw = scenario_kw
+        self._retries = getattr(scenario, "_retries", None)
+        self._current_tries = 0
+        self._scenario = []
+        # Only allocated once the scenario needs them
+        self._notifications = None
+        self._timers = None
+        self._timeout = None
+        self._depth = 0
+        # Bumped for every run of the scenario, so results meant for an
+        # earlier one are dropped
+        self._run_id = 0
+        self._finished = False
+        self._pending_sends = 0
 
         self._reset()
+        self._launched(intended_start)
+
+    def restart(self, intended_start=None):
+        """Reuse a processor whose scenario has ended for a new instance of
+        it, ready to :meth:`run`"""
+        self._current_tries = 0
+        self._finished = False
+        self._reset()
+        self._launched(intended_start)
+
+    def _launched(self, intended_start):
+        # How late the launch was, added to the first timer the scenario
+        # starts so launch delays aren't omitted from its latencies
+        if intended_start is None:
+            self._launch_lag = 0
+        else:
+            self._launch_lag = max(time.time() - intended_start, 0)
+
+    @property
+    def skip_fields(self):
+        """Message fields the scenario doesn't read, set with
+        :func:`aplt.decorators.skip_notification_fields`"""
+        return getattr(self._scenario_func, "_skip_fields", ())
+
+    @property
+    def reusable(self):
+        """Indicates whether the scenario has ended with nothing left that
+        could still call back into the processor"""
+        return (self._finished and not self._connected and
+                self._ws_client is None and self._timeout is None and
+                not self._pending_sends)
 
     def _reset(self):
         """Reset for a startover or initialization"""
-        # Setup the scenario
-        self._scenario = [self._scenario_func(*self._scenario_args,
-                                              **self._scenario_kw)]
+        self._run_id += 1
+        # Setup the scenario, reusing the containers from any previous run
+        del self._scenario[:]
+        self._scenario.append(self._scenario_func(*self._scenario_args,
+                                                  **self._scenario_kw))
 
         # Command processing
         self._last_command = None
@@ -75,33 +145,61 @@ class CommandProcessor(object, policies.TimeoutMixin):
         # Websocket attributes
         self._connected = False
         self._ws_client = None
-        self._notifications = []
-        self._timers = {}
+        if self._notifications:
+            self._notifications.clear()
+        if self._timers:
+            self._timers.clear()
+        self._launch_lag = 0
 
         # Ensure no timers are set
         self.setTimeout(None)
 
     def run(self):
         """Start the scenario"""
-        self._run_safely(lambda: self._scenario[-1].next())
+        self._run_safely(self._scenario[-1].next)
 
     def shutdown(self, ended):
         """Shutdown the scenario after it's over, if needed"""
+        if self._finished:
+            return
         self._current_tries += 1
         retry = self._retries == 0 or (self._current_tries <= self._retries)
         if ended or (not retry):
-            self._harness.remove_processor()
+            self._finished = True
+            self._harness.remove_processor(self)
         else:
             # Start it back up again!
             self._reset()
             self.run()
 
     def _send_command_result(self, result):
-        self._run_safely(lambda: self._scenario[-1].send(result))
+        if self._finished:
+            return
+        if self._depth >= MAX_DEPTH:
+            # Unwind the stack before carrying on
+            reactor.callLater(0, self._resume, self._run_id, result)
+            return
+        self._run_safely(self._scenario[-1].send, result)
+
+    def _resume(self, run_id, result):
+        if run_id == self._run_id:
+            self._send_command_result(result)
+
+    def _sending(self):
+        """Note a send in flight for the current run, returning the callback
+        to give the scenario its result"""
+        self._pending_sends += 1
+        run_id = self._run_id
+
+        def sent(result):
+            self._pending_sends -= 1
+            self._resume(run_id, result)
+        return sent
 
     def _send_exception(self):
         """Send the current exception being handled into a generator and drop
         any active connection"""
+        exc_info = sys.exc_info()
         if self._connected:
             self._connected = False
             # Remove ourselves as a processor so we don't get the closed event
@@ -111,32 +209,43 @@ class CommandProcessor(object, policies.TimeoutMixin):
             self._ws_client.sendClose()
             self._ws_client = None
 
-        def throw():
-            self._scenario[-1].throw(*sys.exc_info())
-        self._run_safely(throw)
+        self._run_safely(self._scenario[-1].throw, *exc_info)
 
-    def _run_safely(self, func, throw=False):
+    def _run_safely(self, func, *args):
+        """Resume the current generator with ``func`` and run the command it
+        yields"""
+        self._depth += 1
         try:
-            self._run_command(func())
+            self._run_command(func(*args))
         except StopIteration:
             if len(self._scenario) == 1:
                 self.shutdown(ended=True)
             else:
+                # Back to the generator that yielded the finished one
                 self._scenario.pop()
-                reactor.callLater(0, self._send_command_result, None)
+                self._send_command_result(None)
         except Exception:
-            log.err()
+            log_error(self._harness.counter)
             self.shutdown(ended=False)
+        finally:
+            self._depth -= 1
 
     def _run_command(self, command):
         if isinstance(command, types.GeneratorType):
             self._scenario.append(command)
-            reactor.callLater(0, self.run)
+            if self._depth >= MAX_DEPTH:
+                reactor.callLater(0, self.run)
+            else:
+                self.run()
             return
-        log.msg("Running command: ", command)
-        command_name = command.__class__.__name__
-        if command_name not in self.valid_commands:
-            raise Exception("Invalid command: %s" % command_name)
+        if tracing(DEBUG, "command"):
+            logger.debug("Running command: {command!r}", command=command)
+        command_name = self.dispatch.get(type(command))
+        if command_name is None:
+            # Not one of ours, but may be a look-alike from elsewhere
+            command_name = command.__class__.__name__
+            if command_name not in self.valid_commands:
+                raise Exception("Invalid command: %s" % command_name)
 
         self._last_command = command_name
         command_func = getattr(self, command_name)
@@ -187,44 +296,53 @@ class CommandProcessor(object, policies.TimeoutMixin):
                                         headers=command.headers,
                                         claims=command.claims)
 
+    def send_notifications(self, command):
+        """Send a batch of notifications, a window of them at a time"""
+        if command.window < 1:
+            raise Exception("Invalid window: %s" % command.window)
+        self._harness.send_notifications(self, command.notifications,
+                                         command.window)
+
     def expect_notification(self, command):
         """Expect a notification to arrive, if its already arrived then act
         on that"""
-        notifs = filter(lambda x: x["channelID"] == command.channel_id,
-                        self._notifications)
-        if notifs:
-            notif = notifs[0]
-            self._notifications.remove(notif)
-            self._expecting = None
-            self.setTimeout(None)
-            return self._send_command_result(notif)
-
-        # If we're already expecting a notification, the timeout is set
-        # already. This can occur when we've called for an incoming client
-        # message vs. a command run from a yield.
-        if self._expecting:
-            return
-
-        # Notification not found, set a timeout waiting for it
-        self._expecting = lambda: self.expect_notification(command)
-        self.setTimeout(command.time)
+        self._expect((command.channel_id,), command.time)
 
     def expect_notifications(self, command):
         """Expect one of many notifications, if one has already arrived that
         is in the set then act on that"""
-        if self._notifications:
-            for idx, notif in enumerate(self._notifications):
-                if notif["channelID"] in command.channel_ids:
-                    self._notifications.pop(idx)
-                    self._expecting = None
-                    self.setTimeout(None)
-                    return self._send_command_result(notif)
+        self._expect(command.channel_ids, command.time)
 
-        if self._expecting:
-            return
+    def _expect(self, channel_ids, timeout):
+        notif = self._pop_notification(channel_ids)
+        if notif:
+            return self._send_command_result(notif)
 
-        self._expecting = lambda: self.expect_notifications(command)
-        self.setTimeout(command.time)
+        # Notification not found, set a timeout waiting for it
+        self._expecting = frozenset(channel_ids)
+        self.setTimeout(timeout)
+
+    def _pop_notification(self, channel_ids):
+        """Remove and return the earliest stored notification for any of
+        the channels"""
+        if not self._notifications:
+            return None
+        if len(channel_ids) > len(self._notifications):
+            # Fewer channels stored than asked for, so check those instead
+            wanted = set(channel_ids)
+            channel_ids = [channel_id for channel_id in self._notifications
+                           if channel_id in wanted]
+        earliest = None
+        for channel_id in channel_ids:
+            queue = self._notifications.get(channel_id)
+            if queue and (earliest is None or queue[0][0] < earliest[0][0]):
+                earliest, earliest_id = queue, channel_id
+        if earliest is None:
+            return None
+        notif = earliest.popleft()[1]
+        if not earliest:
+            del self._notifications[earliest_id]
+        return notif
 
     def wait(self, command):
         """Wait for a period of time"""
@@ -243,16 +361,20 @@ class CommandProcessor(object, policies.TimeoutMixin):
 
     def timer_start(self, command):
         """Start a metric timer"""
+        if self._timers is None:
+            self._timers = {}
         if command.name in self._timers:
             raise Exception("Can't start a timer that was already started: %s"
                             % command.name)
 
-        self._timers[command.name] = time.time()
+        # The first timer of a launch also covers how late it was launched
+        self._timers[command.name] = time.time() - self._launch_lag
+        self._launch_lag = 0
         self._send_command_result(None)
 
     def timer_end(self, command):
         """End a metric timer, handle its submission"""
-        start = self._timers.pop(command.name, None)
+        start = self._timers.pop(command.name, None) if self._timers else None
         if not start:
             raise Exception("Can't end a timer that wasn't started: %s" %
                             command.name)
@@ -265,6 +387,19 @@ class CommandProcessor(object, policies.TimeoutMixin):
         self._harness.counter(command.name, command.count)
         self._send_command_result(None)
 
+    def setTimeout(self, period):
+        """Set the timeout for the command being run on the shared timer
+        wheel, replacing any previous one, or cancel it with None"""
+        if self._timeout is not None:
+            self._timeout.cancel()
+            self._timeout = None
+        if period is not None:
+            self._timeout = get_wheel().call_later(period, self._timed_out)
+
+    def _timed_out(self):
+        self._timeout = None
+        self.timeoutConnection()
+
     def timeoutConnection(self):
         """Called by the timer when a timeout has hit"""
         self.setTimeout(None)
@@ -279,7 +414,7 @@ class CommandProcessor(object, policies.TimeoutMixin):
     def _send_json(self, data):
         if not self._ws_client:
             raise Exception("Not connected")
-        self._ws_client.sendMessage(json.dumps(data).encode('utf8'), False)
+        self._ws_client.sendMessage(codec.dumps(data), False)
 
     def _raise_unexpected_event(self, data):
         """Helper for raising an error when an unexpected event is handled"""
@@ -307,7 +442,8 @@ class CommandProcessor(object, policies.TimeoutMixin):
         if message_type not in self.valid_handlers:
             raise Exception("Unexpected data payload: %s", data)
 
-        log.msg("Handling websocket data: ", data)
+        if tracing(DEBUG, "message"):
+            logger.debug("Handling websocket data: {data!r}", data=data)
 
         if message_type == "register":
             # Explicitly return the endpoint: it may be overridden by
@@ -316,26 +452,38 @@ class CommandProcessor(object, policies.TimeoutMixin):
             self._send_command_result((data, endpoint))
             return
         elif message_type == "notification":
-            # Notifications are stored for expect notification calls
-            self._notifications.append(data)
-            # If we are expecting, trigger it to check
-            if self._expecting:
-                self._expecting()
+            channel_id = data.get("channelID")
+            if self._expecting and channel_id in self._expecting:
+                # Nothing stored matched when the expect began, so this is
+                # the one it's waiting for
+                self._expecting = None
+                self.setTimeout(None)
+                self._send_command_result(data)
+                return
+            # Notifications are stored for expect notification calls, by
+            # channel and in order of arrival
+            if self._notifications is None:
+                self._notifications = {}
+            queue = self._notifications.get(channel_id)
+            if queue is None:
+                queue = self._notifications[channel_id] = deque()
+            queue.append((next(_arrivals), data))
             return
 
+        if "connect" in message_type:
+            # If this is a connect/disconnect, set the connected appropriately
+            self._connected = message_type == "connect"
+            self._ws_client = data.pop("client", None)
+
         if self._last_command != message_type:
             # All websocket events except the notification need the command
             # preceding them. Otherwise we throw an exception into the
-            # scenario.
+            # scenario instead of passing on the event.
             try:
                 self._raise_unexpected_event(data)
             except Exception:
                 self._send_exception()
-
-        if "connect" in message_type:
-            # If this is a connect/disconnect, set the connected appropriately
-            self._connected = message_type == "connect"
-            self._ws_client = data.pop("client", None)
+            return
 
         # Otherwise pass on the result as is to the scenario
         self._send_command_result(data)
@@ -0,0 +1,41 @@
+"""JSON encoding and decoding for WebSocket messages
+
+Uses ``ujson`` or ``simplejson`` when either is installed, as both are
+considerably faster than the standard library's ``json``, which is used
+otherwise.
+
+Decoding can leave out top-level fields of notifications that a scenario
+never reads, such as a notification's base64 ``data``, so they aren't kept
+around for as long as the scenario holds on to the message. They're still
+decoded: blanking them out beforehand costs more than the parser saves.
+
+"""
+try:
+    import ujson as _json
+except ImportError:  # pragma: nocover
+    try:
+        import simplejson as _json
+    except ImportError:
+        import json as _json
+
+# Name of the JSON library in use
+LIBRARY = _json.__name__
+
+
+def loads(data, skip=()):
+    """Decode a JSON message, leaving out the top-level fields in ``skip``
+    if it's a notification"""
+    message = _json.loads(data)
+    if (skip and isinstance(message, dict) and
+            message.get("messageType") == "notification"):
+        for name in skip:
+            message.pop(name, None)
+    return message
+
+
+def dumps(message):
+    """Encode a message as UTF-8 JSON"""
+    data = _json.dumps(message)
+    if isinstance(data, unicode):
+        data = data.encode("utf8")
+    return data
@@ -1,9 +1,9 @@
 """Commands to run per tester"""
-import os
-import random
 import uuid
 from collections import namedtuple
 
+from aplt.payloads import random_payload
+
 
 # Command types are basic named tuples to encapsulate possible arguments and
 # enforce argument checking
@@ -42,6 +42,15 @@ class send_notification(namedtuple("SendNotification",
 send_notification.__new__.__defaults__ = (None, None, None, None)
 
 
+class send_notifications(namedtuple("SendNotifications",
+                                    "notifications window")):
+    pass
+
+
+# at most this many of a batch are sent at once by default
+send_notifications.__new__.__defaults__ = (8,)
+
+
 class expect_notification(namedtuple("ExpectNotification", "channel_id time")):
     pass
 
@@ -80,9 +89,13 @@ def random_channel_id():
     return str(uuid.uuid4())
 
 
-def random_data(min_length, max_length=4096):
-    if min_length == max_length:
-        length = min_length
-    else:
-        length = random.randrange(min_length, max_length)
-    return length, os.urandom(length)
+def random_data(min_length=None, max_length=4096):
+    """Return the length and a string of random payload data, sized from
+    the payload size histogram unless ``min_length`` is given
+
+    :func:`random_payload` returns the data as a ``memoryview`` instead,
+    copied only when it's sent.
+
+    """
+    data = random_payload(min_length, max_length).tobytes()
+    return len(data), data
@@ -0,0 +1,402 @@
+"""Distributed load generation
+
+A coordinator parses a test plan once, waits for a set number of agents to
+connect to it over TCP, and then hands each agent an equal share of every
+test plan tuple's quantity and stagger along with a wall-clock time at which
+all of them should start. Agents report their aggregated counters and timers
+back to the coordinator, which merges them into one set of totals.
+
+Each metric reaches the metrics client from one side only: agents send
+their timings and gauges themselves, as the coordinator only sees timing
+summaries, while counters are sent on by the coordinator alone.
+
+Messages in either direction are single lines of JSON with a ``type`` key.
+
+"""
+import json
+import logging
+import time
+
+from configargparse import ArgumentParser
+from twisted.internet import defer, protocol, reactor, task
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+import aplt.metrics as metrics
+from aplt.runner import (
+    LoadRunner,
+    parse_common_args,
+    parse_endpoint_args,
+    parse_http_args,
+    parse_log_args,
+    parse_payload_args,
+    parse_statsd_args,
+    parse_testplan,
+    parse_timer_args,
+    parse_vapid_args,
+    slice_testplan,
+    split_quantity,
+)
+
+
+class JSONLineProtocol(LineReceiver):
+    """Exchanges JSON messages, one per line"""
+    delimiter = "\n"
+    MAX_LENGTH = 1024 * 1024
+
+    def send_message(self, **message):
+        self.sendLine(json.dumps(message))
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+            handler = getattr(self, "handle_" + message["type"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            log.msg("Invalid message: {!r}".format(line))
+            self.transport.loseConnection()
+            return
+        handler(message)
+
+
+class CoordinatorProtocol(JSONLineProtocol):
+    """A connection from an agent to the coordinator"""
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+        self.clock_offset = None
+        self.finished = False
+
+    def connectionMade(self):
+        self.coordinator.agent_connected(self)
+
+    def connectionLost(self, reason):
+        self.coordinator.agent_lost(self)
+
+    def handle_hello(self, message):
+        # Estimate how far the agent clock is from ours
+        self.send_message(type="sync", time=time.time())
+
+    def handle_sync(self, message):
+        now = time.time()
+        self.clock_offset = message["agent_time"] - (message["time"] + now) / 2
+        self.coordinator.agent_ready(self)
+
+    def handle_stats(self, message):
+        self.coordinator.stats_received(message["counters"],
+                                        message["timers"])
+
+    def handle_finished(self, message):
+        self.finished = True
+        self.coordinator.agent_finished(self)
+
+
+class Coordinator(protocol.Factory):
+    """Distributes a test plan across connecting agents
+
+    Once ``agents`` agents are connected and their clock offsets measured,
+    all of them are told to start ``start_delay`` seconds later. The
+    :attr:`done` deferred fires with the merged counters and timers once
+    every agent has finished or disconnected.
+
+    """
+    def __init__(self, test_plan, agents, metrics, start_delay=5):
+        self._test_plan = test_plan
+        self._testplans = parse_testplan(test_plan)
+        self._expected = agents
+        self._start_delay = start_delay
+        self.metrics = metrics
+        self.agents = []
+        self.started = False
+        self.counters = {}
+        self.timers = {}
+        self.done = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        if self.started or len(self.agents) >= self._expected:
+            log.msg("Refusing extra agent from {}".format(addr))
+            return None
+        return CoordinatorProtocol(self)
+
+    def agent_connected(self, agent):
+        self.agents.append(agent)
+        log.msg("Agent connected ({}/{})".format(len(self.agents),
+                                                 self._expected))
+
+    def agent_ready(self, agent):
+        ready = [a for a in self.agents if a.clock_offset is not None]
+        if len(ready) == self._expected and not self.started:
+            self.start()
+
+    def start(self):
+        """Send every agent its share of the test plan and start time"""
+        self.started = True
+        start_at = time.time() + self._start_delay
+        count = len(self.agents)
+        for index, agent in enumerate(self.agents):
+            shares = [split_quantity(plan[1], plan[2], count, index)
+                      for plan in self._testplans]
+            agent.send_message(type="start", test_plan=self._test_plan,
+                               shares=shares,
+                               start_at=start_at + agent.clock_offset)
+        log.msg("Starting {} agents at {}".format(count, start_at))
+
+    def stats_received(self, counters, timers):
+        for name, count in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + count
+            self.metrics.increment(name, count)
+        metrics.merge_timers(self.timers, timers)
+
+    def agent_finished(self, agent):
+        agent.transport.loseConnection()
+
+    def agent_lost(self, agent):
+        if not agent.finished:
+            log.msg("Agent lost before finishing")
+        if agent in self.agents:
+            self.agents.remove(agent)
+        if self.started and not self.agents and not self.done.called:
+            self.done.callback((self.counters, self.timers))
+
+
+class AgentProtocol(JSONLineProtocol):
+    """An agent's connection to the coordinator"""
+    def __init__(self, agent):
+        self.agent = agent
+
+    def connectionMade(self):
+        self.send_message(type="hello")
+
+    def connectionLost(self, reason):
+        self.agent.coordinator_lost()
+
+    def handle_sync(self, message):
+        self.send_message(type="sync", time=message["time"],
+                          agent_time=time.time())
+
+    def handle_start(self, message):
+        self.agent.schedule(message["test_plan"], message["shares"],
+                            message["start_at"])
+
+
+class LoadAgent(protocol.ClientFactory):
+    """Runs the share of a test plan handed out by a coordinator"""
+    protocol = AgentProtocol
+
+    def __init__(self, websocket_url, endpoint, endpoint_ssl_cert,
+                 endpoint_ssl_key, metrics, report_interval=5,
+                 vapid_pool=None):
+        self._websocket_url = websocket_url
+        self._endpoint = endpoint
+        self._endpoint_ssl_cert = endpoint_ssl_cert
+        self._endpoint_ssl_key = endpoint_ssl_key
+        self._vapid_pool = vapid_pool
+        self.metrics = metrics
+        self._report_interval = report_interval
+        self._connection = None
+        self._load_runner = None
+        self._report_loop = None
+        self.done = defer.Deferred()
+
+    def buildProtocol(self, addr):
+        self._connection = AgentProtocol(self)
+        return self._connection
+
+    def clientConnectionFailed(self, connector, reason):
+        self._finish(reason)
+
+    def schedule(self, test_plan, shares, start_at):
+        """Set up a load runner to start at the coordinator's start time"""
+        testplans = [slice_testplan(plan, *share)
+                     for plan, share in zip(parse_testplan(test_plan), shares)
+                     if share[0]]
+        self._load_runner = LoadRunner(testplans, self.metrics,
+                                       self._websocket_url, self._endpoint,
+                                       self._endpoint_ssl_cert,
+                                       self._endpoint_ssl_key,
+                                       self._vapid_pool)
+        self._load_runner.metrics = self.metrics
+        delay = max(0, start_at - time.time())
+        log.msg("Starting in {:.3f} seconds".format(delay))
+        reactor.callLater(delay, self._start)
+
+    def _start(self):
+        self._load_runner.start()
+        self._report_loop = task.LoopingCall(self.report)
+        self._report_loop.start(self._report_interval, now=False)
+
+    def report(self):
+        """Send the stats aggregated so far to the coordinator, and let it
+        know once the load runner has finished"""
+        counters, timers = self.metrics.collect()
+        if counters or timers:
+            self._connection.send_message(type="stats", counters=counters,
+                                          timers=timers)
+        if self._load_runner.finished:
+            self._report_loop.stop()
+            self._connection.send_message(type="finished")
+
+    def coordinator_lost(self):
+        self._finish(None)
+
+    def _finish(self, result):
+        if self._report_loop and self._report_loop.running:
+            self._report_loop.stop()
+        if not self.done.called:
+            self.done.callback(result)
+
+
+def parse_coordinator_args(args):
+    parser = ArgumentParser(
+        description="Coordinate a test plan across agents",
+        default_config_files=["config.ini"],
+        args_for_setting_config_path=["-c", "--config"],
+    )
+    parse_common_args(parser)
+    parser.add_argument("--agents",
+                        help="number of agents to wait for before starting",
+                        type=int,
+                        env_var="AGENTS",
+                        required=True)
+    parser.add_argument("--port",
+                        help="port to listen for agents on",
+                        type=int,
+                        env_var="COORDINATOR_PORT",
+                        default=8090)
+    parser.add_argument("--start_delay",
+                        help="seconds between all agents connecting and the "
+                             "test plan starting",
+                        type=float,
+                        env_var="START_DELAY",
+                        default=5)
+    parser.add_argument("test_plan")
+    return parser.parse_args(args)
+
+
+def run_coordinator(args=None, run=True):
+    """Coordinate a testplan across multiple agents
+
+    Usage:
+        aplt_coordinator TEST_PLAN --agents=AGENTS
+                         [--port=PORT]
+                         [--start_delay=START_DELAY]
+                         [--metric_namespace=METRIC_NAMESPACE]
+                         [--statsd_host=STATSD_HOST]
+                         [--statsd_port=STATSD_PORT]
+                         [--statsd_flush_interval=STATSD_FLUSH_INTERVAL]
+                         [--statsd_packet_size=STATSD_PACKET_SIZE]
+                         [--datadog_api_key=DD_API_KEY]
+                         [--datadog_app_key=DD_APP_KEY]
+                         [--datadog_flush_interval=DD_FLUSH_INTERVAL]
+                         [--histogram_interval=HISTOGRAM_INTERVAL]
+
+    test_plan is in the same format accepted by aplt_testplan. Each agent
+    runs an equal share of every test plan tuple's quantity and stagger.
+    Counters reported by the agents are sent on to the metrics client, which
+    agents leave to the coordinator, and the merged counters and timers are
+    printed as JSON once every agent has finished.
+
+    """
+    arguments = parse_coordinator_args(args)
+    statsd_client = parse_statsd_args(arguments)
+    coordinator = Coordinator(arguments.test_plan, arguments.agents,
+                              statsd_client, arguments.start_delay)
+    observer = log.PythonLoggingObserver()
+    log.startLoggingWithObserver(observer.emit, False)
+    logging.basicConfig(level=logging.INFO)
+    statsd_client.start()
+
+    def report(result):
+        counters, timers = result
+        print(json.dumps(dict(counters=counters, timers=timers), indent=2))
+        statsd_client.stop()
+        reactor.stop()
+    coordinator.done.addCallback(report)
+
+    reactor.listenTCP(arguments.port, coordinator)
+    if run:
+        reactor.run()
+    else:
+        return coordinator
+
+
+def parse_agent_args(args):
+    parser = ArgumentParser(
+        description="Run test plans handed out by a coordinator",
+        default_config_files=["config.ini"],
+        args_for_setting_config_path=["-c", "--config"],
+    )
+    parse_common_args(parser)
+    parser.add_argument("--report_interval",
+                        help="period (in secs) between stats reports to the "
+                             "coordinator",
+                        type=float,
+                        env_var="REPORT_INTERVAL",
+                        default=5)
+    parser.add_argument("coordinator",
+                        help="host:port of the coordinator")
+    return parser.parse_args(args)
+
+
+def run_agent(args=None, run=True):
+    """Run a share of a coordinated test plan
+
+    Usage:
+        aplt_agent COORDINATOR
+                   [--report_interval=REPORT_INTERVAL]
+                   [-u WEBSOCKET_URL --websocket_url=WEBSOCKET_URL]
+                   [--metric_namespace=METRIC_NAMESPACE]
+                   [--statsd_host=STATSD_HOST]
+                   [--statsd_port=STATSD_PORT]
+                   [--statsd_flush_interval=STATSD_FLUSH_INTERVAL]
+                   [--statsd_packet_size=STATSD_PACKET_SIZE]
+                   [--endpoint=URL]
+                   [--endpoint_ssl_cert=SSL_CERT]
+                   [--endpoint_ssl_key=SSL_KEY]
+                   [--vapid_processes=VAPID_PROCESSES]
+                   [--vapid_backend=VAPID_BACKEND]
+                   [--http_connections=HTTP_CONNECTIONS]
+                   [--http_idle_timeout=HTTP_IDLE_TIMEOUT]
+                   [--http_discard_bodies]
+                   [--http2]
+                   [--http2_connections=HTTP2_CONNECTIONS]
+                   [--http2_streams=HTTP2_STREAMS]
+                   [--payload_pool_size=PAYLOAD_POOL_SIZE]
+                   [--payload_sizes=PAYLOAD_SIZES]
+                   [--timer_resolution=TIMER_RESOLUTION]
+                   [--log_level=LOG_LEVEL]
+                   [--log_sample=LOG_SAMPLE]
+                   [--error_burst=ERROR_BURST]
+                   [--error_interval=ERROR_INTERVAL]
+
+    COORDINATOR is the host:port an aplt_coordinator is listening on.
+
+    """
+    arguments = parse_agent_args(args)
+    host, _, port = arguments.coordinator.rpartition(":")
+    if not host or not port.isdigit():
+        raise Exception("Invalid coordinator: " + arguments.coordinator)
+    # Counters are sent on by the coordinator, so they aren't counted twice
+    statsd_client = metrics.AggregateMetrics(parse_statsd_args(arguments),
+                                             forward_counters=False)
+    endpoint, ssl_cert, ssl_key = parse_endpoint_args(arguments)
+    parse_timer_args(arguments)
+    parse_log_args(arguments)
+    parse_http_args(arguments)
+    parse_payload_args(arguments)
+    agent = LoadAgent(arguments.websocket_url, endpoint, ssl_cert, ssl_key,
+                      statsd_client, arguments.report_interval,
+                      parse_vapid_args(arguments))
+    observer = log.PythonLoggingObserver()
+    log.startLoggingWithObserver(observer.emit, False)
+    logging.basicConfig(level=logging.INFO)
+    statsd_client.start()
+
+    def finish(result):
+        statsd_client.stop()
+        reactor.stop()
+    agent.done.addBoth(finish)
+
+    reactor.connectTCP(host, int(port), agent)
+    if run:
+        reactor.run()
+    else:
+        return agent
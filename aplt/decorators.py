@@ -8,3 +8,12 @@ def restart(tries=3):
         f._retries = tries
         return f
     return _restart_decorator
+
+
+def skip_notification_fields(*fields):
+    """Leaves the given fields out of notifications the scenario receives,
+    for fields it never reads such as ``data``"""
+    def _skip_decorator(f):
+        f._skip_fields = fields
+        return f
+    return _skip_decorator
@@ -0,0 +1,359 @@
+"""HTTP/2 notification sending
+
+With ``h2`` installed, a :class:`aplt.runner.RunnerHarness` can send its
+notifications with an :class:`H2Client` instead of treq: concurrent pushes
+to an endpoint host are multiplexed as streams over a few connections, up to
+a limit of concurrent streams per connection, instead of each taking a
+connection of its own for its round trip.
+
+``https`` endpoints must negotiate HTTP/2 with ALPN; ``http`` endpoints are
+assumed to speak HTTP/2 without an upgrade.
+
+"""
+import urlparse
+import weakref
+from collections import deque
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.endpoints import (
+    HostnameEndpoint,
+    connectProtocol,
+    wrapClientTLS,
+)
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.python.failure import Failure
+from twisted.web.client import BrowserLikePolicyForHTTPS, ResponseDone
+from twisted.web.http_headers import Headers
+from zope.interface import implementer
+
+try:
+    from h2.config import H2Configuration
+    from h2.connection import H2Connection
+    from h2 import events
+except ImportError:  # pragma: nocover
+    H2Connection = None
+
+# Options for the clients created from now on
+_options = dict(enabled=False, connections=2, streams=100)
+
+# Every client still in use, so their connections can all be closed
+_clients = weakref.WeakSet()
+
+
+class H2Error(Exception):
+    pass
+
+
+class H2Response(object):
+    """The parts of a :class:`twisted.web.iweb.IResponse`, with treq's
+    ``content()``, that notification sends use"""
+    version = ("HTTP", 2, 0)
+    phrase = ""
+
+    def __init__(self, code, headers, body):
+        self.code = code
+        self.headers = headers
+        self.length = len(body)
+        self._body = body
+
+    def content(self):
+        return defer.succeed(self._body)
+
+    def deliverBody(self, body_protocol):
+        body_protocol.makeConnection(None)
+        body_protocol.dataReceived(self._body)
+        body_protocol.connectionLost(Failure(ResponseDone()))
+
+
+class _Stream(object):
+    __slots__ = ("deferred", "body", "code", "headers", "chunks")
+
+    def __init__(self, deferred, body):
+        self.deferred = deferred
+        self.body = body
+        self.code = None
+        self.headers = Headers()
+        self.chunks = []
+
+
+class H2ClientProtocol(protocol.Protocol):
+    """A client HTTP/2 connection running up to ``max_streams`` requests at
+    once, queueing the rest"""
+    def __init__(self, max_streams=100, tls=False):
+        self._conn = H2Connection(H2Configuration(client_side=True))
+        self._max_streams = max_streams
+        # Whether ALPN is still to be checked
+        self._checked = not tls
+        self._streams = {}
+        self._waiting = deque()
+        self._connected = False
+        self.closed = False
+        # Fires once the connection is closed
+        self.lost = defer.Deferred()
+
+    @property
+    def load(self):
+        """Requests running or waiting on this connection"""
+        return len(self._streams) + len(self._waiting)
+
+    @property
+    def busy(self):
+        return self.load >= self._stream_limit()
+
+    def _stream_limit(self):
+        return min(self._max_streams,
+                   self._conn.remote_settings.max_concurrent_streams)
+
+    def request(self, headers, body):
+        """Send a request, returning a deferred firing with its
+        :class:`H2Response`"""
+        d = defer.Deferred()
+        self._waiting.append((headers, body, d))
+        if self._connected:
+            self._start_waiting()
+            self._flush()
+        return d
+
+    def connectionMade(self):
+        self._connected = True
+        self._conn.initiate_connection()
+        self._start_waiting()
+        self._flush()
+
+    def connection_failed(self, reason):
+        self.connectionLost(reason)
+
+    def connectionLost(self, reason=None):
+        self.closed = True
+        self._connected = False
+        reason = reason or Failure(H2Error("Connection closed"))
+        streams, self._streams = self._streams, {}
+        waiting, self._waiting = self._waiting, deque()
+        for stream in streams.values():
+            stream.deferred.errback(reason)
+        for _, _, d in waiting:
+            d.errback(reason)
+        if not self.lost.called:
+            self.lost.callback(None)
+
+    def dataReceived(self, data):
+        if not self._checked:
+            # The TLS handshake is over by the time any data arrives
+            self._checked = True
+            if self.transport.negotiatedProtocol != b"h2":
+                self.transport.abortConnection()
+                self.connectionLost(Failure(H2Error(
+                    "Endpoint didn't negotiate HTTP/2")))
+                return
+        try:
+            received = self._conn.receive_data(data)
+        except Exception:
+            self.transport.abortConnection()
+            self.connectionLost(Failure())
+            return
+        for event in received:
+            handler = self._handlers.get(type(event))
+            if handler is not None:
+                handler(self, event)
+        self._start_waiting()
+        self._flush()
+
+    def _flush(self):
+        data = self._conn.data_to_send()
+        if data and self.transport:
+            self.transport.write(data)
+
+    def _start_waiting(self):
+        while self._waiting and not self.closed and \
+                len(self._streams) < self._stream_limit():
+            headers, body, d = self._waiting.popleft()
+            stream_id = self._conn.get_next_available_stream_id()
+            self._conn.send_headers(stream_id, headers, end_stream=not body)
+            self._streams[stream_id] = _Stream(d, body)
+            if body:
+                self._send_body(stream_id)
+
+    def _send_body(self, stream_id):
+        stream = self._streams[stream_id]
+        while stream.body:
+            size = min(self._conn.local_flow_control_window(stream_id),
+                       self._conn.max_outbound_frame_size, len(stream.body))
+            if size <= 0:
+                # Carried on once the server opens the window again
+                return
+            chunk, stream.body = stream.body[:size], stream.body[size:]
+            self._conn.send_data(stream_id, chunk,
+                                 end_stream=not stream.body)
+
+    def _response_received(self, event):
+        stream = self._streams.get(event.stream_id)
+        if stream is None:
+            return
+        for name, value in event.headers:
+            if name == b":status":
+                stream.code = int(value)
+            else:
+                stream.headers.addRawHeader(name, value)
+
+    def _data_received(self, event):
+        self._conn.acknowledge_received_data(event.flow_controlled_length,
+                                             event.stream_id)
+        stream = self._streams.get(event.stream_id)
+        if stream is not None:
+            stream.chunks.append(event.data)
+
+    def _stream_ended(self, event):
+        stream = self._streams.pop(event.stream_id, None)
+        if stream is not None:
+            stream.deferred.callback(H2Response(
+                stream.code, stream.headers, b"".join(stream.chunks)))
+
+    def _stream_reset(self, event):
+        stream = self._streams.pop(event.stream_id, None)
+        if stream is not None:
+            stream.deferred.errback(H2Error(
+                "Stream reset with error {}".format(event.error_code)))
+
+    def _window_updated(self, event):
+        if event.stream_id:
+            stream_ids = [event.stream_id]
+        else:
+            stream_ids = list(self._streams)
+        for stream_id in stream_ids:
+            if stream_id in self._streams and self._streams[stream_id].body:
+                self._send_body(stream_id)
+
+    def _connection_terminated(self, event):
+        self.closed = True
+        self.transport.loseConnection()
+
+    if H2Connection is not None:
+        _handlers = {
+            events.ResponseReceived: _response_received,
+            events.DataReceived: _data_received,
+            events.StreamEnded: _stream_ended,
+            events.StreamReset: _stream_reset,
+            events.WindowUpdated: _window_updated,
+            events.ConnectionTerminated: _connection_terminated,
+        }
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _ALPNConnectionCreator(object):
+    """Offers HTTP/2 with ALPN on the connections of another creator"""
+    def __init__(self, creator):
+        self._creator = creator
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = self._creator.clientConnectionForTLS(tlsProtocol)
+        connection.set_alpn_protos([b"h2"])
+        return connection
+
+
+class H2Client(object):
+    """Sends requests over up to ``connections`` HTTP/2 connections per
+    host, each running up to ``streams`` requests at once
+
+    A request goes to the host's least loaded connection, and a new
+    connection is only opened once every open one is running its limit of
+    streams.
+
+    :param policy: :class:`twisted.web.iweb.IPolicyForHTTPS` for ``https``
+        connections.
+    :param counter: Optional callable taking a metric name, called with
+        ``http2.connection.new`` for every connection opened.
+
+    """
+    def __init__(self, reactor=reactor, connections=2, streams=100,
+                 policy=None, counter=None):
+        if H2Connection is None:
+            raise H2Error("HTTP/2 needs the h2 package")
+        self._reactor = reactor
+        self._connections = connections
+        self._streams = streams
+        self._policy = policy or BrowserLikePolicyForHTTPS()
+        self._counter = counter
+        self._hosts = {}
+        _clients.add(self)
+
+    def post(self, url, data=None, headers=None):
+        """POST ``data`` to ``url``, returning a deferred firing with an
+        :class:`H2Response` once it's been read"""
+        parsed = urlparse.urlparse(url)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        request_headers = [(":method", "POST"),
+                           (":scheme", parsed.scheme),
+                           (":authority", parsed.netloc),
+                           (":path", path)]
+        for name, value in (headers or {}).items():
+            request_headers.append((name.lower(), str(value)))
+        request_headers.append(("content-length", str(len(data or b""))))
+        connection = self._connection(parsed)
+        return connection.request(request_headers, data or b"")
+
+    def _connection(self, parsed):
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        connections = self._hosts.setdefault(key, [])
+        connections[:] = [c for c in connections if not c.closed]
+        if connections:
+            connection = min(connections, key=lambda c: c.load)
+            if not connection.busy or \
+                    len(connections) >= self._connections:
+                return connection
+        connection = self._connect(parsed)
+        connections.append(connection)
+        return connection
+
+    def _connect(self, parsed):
+        tls = parsed.scheme == "https"
+        port = parsed.port or (443 if tls else 80)
+        endpoint = HostnameEndpoint(self._reactor, parsed.hostname, port)
+        if tls:
+            creator = self._policy.creatorForNetloc(parsed.hostname, port)
+            endpoint = wrapClientTLS(_ALPNConnectionCreator(creator),
+                                     endpoint)
+        connection = H2ClientProtocol(self._streams, tls)
+        d = connectProtocol(endpoint, connection)
+        d.addErrback(connection.connection_failed)
+        if self._counter is not None:
+            self._counter("http2.connection.new")
+        return connection
+
+    def close(self):
+        """Close every connection, returning a deferred firing once they're
+        closed"""
+        lost = []
+        for connections in self._hosts.values():
+            for connection in connections:
+                if connection.transport and not connection.closed:
+                    connection.transport.loseConnection()
+                lost.append(connection.lost)
+        self._hosts = {}
+        return defer.DeferredList(lost)
+
+
+def set_http2_options(enabled=False, connections=2, streams=100):
+    """Set whether harnesses created from now on send notifications over
+    HTTP/2, with up to ``connections`` per host each running up to
+    ``streams`` requests at once"""
+    if enabled and H2Connection is None:
+        raise H2Error("HTTP/2 needs the h2 package")
+    _options.update(enabled=enabled, connections=connections,
+                    streams=streams)
+
+
+def new_client(policy=None, counter=None):
+    """Return an :class:`H2Client` with the current options, or None if
+    HTTP/2 isn't enabled"""
+    if not _options["enabled"]:
+        return None
+    return H2Client(connections=_options["connections"],
+                    streams=_options["streams"], policy=policy,
+                    counter=counter)
+
+
+def close_clients():
+    """Close the connections of every client"""
+    return defer.DeferredList([client.close() for client in list(_clients)])
@@ -0,0 +1,98 @@
+"""HTTP connection pools for notification sends
+
+Every :class:`aplt.runner.RunnerHarness` sends its notifications through its
+own :class:`MeteredConnectionPool`, keeping connections to the push
+endpoints open between requests rather than sharing treq's small global
+pool. How many connections are kept per host, how long an idle one is kept
+for, and whether response bodies are read at all are set for every pool
+created afterwards with :func:`set_pool_options`.
+
+"""
+import weakref
+
+import treq
+from twisted.internet import defer, reactor
+from twisted.web.client import HTTPConnectionPool
+
+# Options for the pools created from now on
+_options = dict(max_per_host=10, idle_timeout=240, discard_bodies=False)
+
+# Every pool still in use, so they can all be closed
+_pools = weakref.WeakSet()
+
+
+class MeteredConnectionPool(HTTPConnectionPool):
+    """A persistent connection pool counting how often it reuses a
+    connection
+
+    :param counter: Optional callable taking a metric name, called with
+        ``http.connection.reused`` or ``http.connection.new`` for every
+        request.
+
+    """
+    def __init__(self, reactor=reactor, counter=None, max_per_host=10,
+                 idle_timeout=240):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = max_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        self._counter = counter
+        self._connecting = False
+        self.reused = 0
+        self.created = 0
+
+    def getConnection(self, key, endpoint):
+        self._connecting = False
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if self._connecting:
+            self.created += 1
+            name = "http.connection.new"
+        else:
+            self.reused += 1
+            name = "http.connection.reused"
+        if self._counter is not None:
+            self._counter(name)
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self._connecting = True
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+
+def set_pool_options(max_per_host=10, idle_timeout=240,
+                     discard_bodies=False):
+    """Set the options of pools created from now on
+
+    :param max_per_host: Idle connections kept open per host.
+    :param idle_timeout: Seconds an idle connection is kept open for.
+    :param discard_bodies: Whether response bodies are dropped as they
+        arrive, with :func:`read_body` returning an empty string, instead of
+        being read into memory.
+
+    """
+    _options.update(max_per_host=max_per_host, idle_timeout=idle_timeout,
+                    discard_bodies=discard_bodies)
+
+
+def new_pool(counter=None):
+    """Return a :class:`MeteredConnectionPool` with the current options"""
+    pool = MeteredConnectionPool(counter=counter,
+                                 max_per_host=_options["max_per_host"],
+                                 idle_timeout=_options["idle_timeout"])
+    _pools.add(pool)
+    return pool
+
+
+def read_body(response):
+    """Return a deferred firing with the body of a response, or an empty
+    string once it's been discarded if pools discard bodies"""
+    if not _options["discard_bodies"]:
+        return response.content()
+    d = treq.collect(response, lambda data: None)
+    d.addCallback(lambda _: "")
+    return d
+
+
+def close_pools():
+    """Close the cached connections of every pool"""
+    return defer.DeferredList([pool.closeCachedConnections()
+                               for pool in list(_pools)])
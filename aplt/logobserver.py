@@ -1,8 +1,13 @@
+import gzip
 import io
 import json
+import Queue
+import random
 import sys
+import threading
 import time
 
+from twisted.internet import reactor, task
 from twisted.logger import (
     formatEventAsClassicLogText,
     formatEvent,
@@ -13,10 +18,168 @@ from twisted.logger import (
 
 )
 
+from twisted.python import log
 from zope.interface import implementer
 
 began_logging = False
 
+# Hot path logging is checked against these before an event is built, so
+# that it costs next to nothing when it's filtered out
+LEVELS = dict((level, index) for index, level in enumerate(
+    [LogLevel.debug, LogLevel.info, LogLevel.warn, LogLevel.error,
+     LogLevel.critical]))
+DEBUG = LEVELS[LogLevel.debug]
+INFO = LEVELS[LogLevel.info]
+_min_level = INFO
+# Fraction of the events of each type that are logged, by type
+_sample_rates = {}
+
+
+def set_trace_level(log_level="info", sample_rates=None):
+    """Set the minimum level, by name in any case, and the sampling rates by
+    event type that :func:`tracing` checks"""
+    global _min_level, _sample_rates
+    _min_level = LEVELS[LogLevel.lookupByName(log_level.lower())]
+    _sample_rates = dict(sample_rates or {})
+
+
+def parse_sample_rates(string):
+    """Parse ``type=rate,...`` into a dict of sampling rates by event
+    type"""
+    rates = {}
+    for item in filter(None, (string or "").split(",")):
+        event_type, _, rate = item.partition("=")
+        rate = float(rate)
+        if not event_type.strip() or not 0 <= rate <= 1:
+            raise ValueError("Invalid sampling rate: {}".format(item))
+        rates[event_type.strip()] = rate
+    return rates
+
+
+def tracing(level, event_type=None):
+    """Indicates whether a hot path event of ``level`` and ``event_type``
+    should be logged, sampling it if a rate is set for the type
+
+    Check this before building the event::
+
+        if tracing(DEBUG, "command"):
+            logger.debug("Running command: {command!r}", command=command)
+
+    """
+    if level < _min_level:
+        return False
+    if event_type is not None and event_type in _sample_rates:
+        return random.random() < _sample_rates[event_type]
+    return True
+
+
+class ErrorLimiter(object):
+    """Logs exceptions, collapsing storms of the same one into summaries
+
+    Exceptions are grouped by signature, their type and where they were
+    raised. Each signature has a token bucket letting ``burst`` tracebacks
+    through every ``interval`` seconds; past that, occurrences are only
+    counted, and logged as one summary line per signature every
+    ``interval`` seconds.
+
+    """
+    def __init__(self, burst=5, interval=10, clock=reactor):
+        self.burst = burst
+        self.interval = interval
+        self._clock = clock
+        # Signature to [tokens, last refill, suppressed, last exception]
+        self._buckets = {}
+        self._loop = task.LoopingCall(self.summarize)
+        self._loop.clock = clock
+
+    def err(self, counter=None):
+        """Log the exception being handled, unless its signature has used
+        up its tracebacks
+
+        :param counter: Optional callable taking a metric name, called with
+            ``error.<exception type>`` for every exception.
+
+        """
+        exc_type, exc, tb = sys.exc_info()
+        if counter is not None:
+            counter("error." + exc_type.__name__)
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+        if tb is None:
+            signature = (exc_type, None, None)
+        else:
+            signature = (exc_type, tb.tb_frame.f_code.co_filename,
+                         tb.tb_lineno)
+        now = self._clock.seconds()
+        bucket = self._buckets.get(signature)
+        if bucket is None:
+            bucket = self._buckets[signature] = [self.burst, now, 0, None]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) *
+                            self.burst / float(self.interval))
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            log.err()
+            return
+        bucket[2] += 1
+        bucket[3] = exc
+        if not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def summarize(self):
+        """Log how often every suppressed exception occurred since the last
+        summary"""
+        for signature, bucket in self._buckets.items():
+            suppressed, exc = bucket[2], bucket[3]
+            if not suppressed:
+                # Quiet for a whole interval, so its bucket is full again
+                del self._buckets[signature]
+                continue
+            exc_type, filename, lineno = signature
+            log.msg("{} occurrences of {} at {}:{} in the last {}s, "
+                    "most recently: {!r}".format(
+                        suppressed, exc_type.__name__, filename, lineno,
+                        self.interval, exc))
+            bucket[2], bucket[3] = 0, None
+        if not self._buckets and self._loop.running:
+            self._loop.stop()
+
+    def stop(self):
+        """Log the summaries of anything suppressed so far"""
+        self.summarize()
+        if self._loop.running:
+            self._loop.stop()
+
+
+_error_limiter = None
+
+
+def log_error(counter=None):
+    """Log the exception being handled through the shared
+    :class:`ErrorLimiter`"""
+    global _error_limiter
+    if _error_limiter is None:
+        _error_limiter = ErrorLimiter()
+    _error_limiter.err(counter)
+
+
+def set_error_limits(burst, interval):
+    """Replace the shared :class:`ErrorLimiter` with one letting ``burst``
+    tracebacks of each exception through every ``interval`` seconds"""
+    global _error_limiter
+    if _error_limiter is not None:
+        _error_limiter.stop()
+    _error_limiter = ErrorLimiter(burst, interval)
+    return _error_limiter
+
+
+def stop_error_limits():
+    """Log the summaries of anything the shared :class:`ErrorLimiter` has
+    suppressed so far, for when logging is about to stop"""
+    if _error_limiter is not None:
+        _error_limiter.stop()
+
 
 def begin_or_register(observer, redirectStandardIO=False, **kwargs):
     global began_logging
@@ -36,15 +199,87 @@ def stop(observer):
     globalLogPublisher.removeObserver(observer=observer)  # pragma nocover
 
 
+class LogWriter(threading.Thread):
+    """Writes lines to an output from a background thread
+
+    Lines are queued by :meth:`write` and written out in batches, the
+    output being flushed once ``batch_lines`` lines are waiting or
+    ``flush_interval`` seconds after the first of them was queued, so the
+    reactor thread never blocks on the output. Once ``max_lines`` lines are
+    queued :meth:`write` waits for the writer to catch up rather than
+    dropping lines.
+
+    """
+    _stop_writing = object()
+
+    def __init__(self, output, max_lines=10000, batch_lines=500,
+                 flush_interval=0.5):
+        super(LogWriter, self).__init__(name="LogWriter")
+        self.daemon = True
+        self._output = output
+        self._queue = Queue.Queue(max_lines)
+        self._batch_lines = batch_lines
+        self._flush_interval = flush_interval
+
+    def write(self, line):
+        self._queue.put(line)
+
+    def stop(self):
+        """Write out every queued line and wait for the thread to finish"""
+        self._queue.put(self._stop_writing)
+        self.join()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            line = self._queue.get()
+            deadline = time.time() + self._flush_interval
+            while line is not self._stop_writing:
+                batch.append(line)
+                remaining = deadline - time.time()
+                if len(batch) >= self._batch_lines or remaining <= 0:
+                    break
+                try:
+                    line = self._queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+            else:
+                stopping = True
+            if batch:
+                self._output.write(u"".join(batch))
+                self._output.flush()
+
+
+def open_log_file(filename):
+    """Open a log file for appending, gzip compressed if it ends in .gz"""
+    if filename.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(filename, "ab"), encoding="utf-8")
+    return io.open(filename, "a", encoding="utf-8")
+
+
 @implementer(ILogObserver)
 class AP_Logger(object):
+    """Writes log events to stdout, a file or a buffer
+
+    Once started, lines for stdout or a file are written from a
+    :class:`LogWriter` thread, which is drained by :meth:`stop`. A buffer is
+    written to directly, so :meth:`dump` always has every line. File
+    outputs ending in ``.gz`` are written gzip compressed.
 
+    """
     def __init__(self, logger_name, log_level="debug",
-                 log_format="json", log_output="stdout"):
+                 log_format="json", log_output="stdout", max_lines=10000,
+                 batch_lines=500, flush_interval=0.5):
         self._start = time.time()
         self.logger_name = logger_name
+        self._writer = None
+        self._writer_options = dict(max_lines=max_lines,
+                                    batch_lines=batch_lines,
+                                    flush_interval=flush_interval)
         self._filename = None
-        self._log_level = LogLevel.lookupByName(log_level)
+        self._buffered = False
+        self._log_level = LogLevel.lookupByName(log_level.lower())
         self._output = None
         if not isinstance(log_output, str):
             self._output = log_output
@@ -56,6 +291,7 @@ class AP_Logger(object):
                 self._output = sys.stdout
             elif log_output.lower() == "buffer":
                 self._output = io.StringIO()
+                self._buffered = True
             else:
                 self._filename = log_output
         try:
@@ -71,7 +307,9 @@ class AP_Logger(object):
             return
         text = self.format_event(event)
 
-        if self._output:
+        if self._writer:
+            self._writer.write(unicode(text)+"\n")
+        elif self._output:
             self._output.write(unicode(text)+"\n")
             self._output.flush()
 
@@ -108,6 +346,8 @@ class AP_Logger(object):
             raise
 
     def dump(self):
+        if self._buffered:
+            return self._output.getvalue().splitlines(True)
         try:
             self._output.seek(0)
             return self._output.readlines()
@@ -116,12 +356,18 @@ class AP_Logger(object):
 
     def start(self):
         if self._filename:
-            self._output = io.open(self._filename, "a", encoding="utf-8")
+            self._output = open_log_file(self._filename)
+        if self._output and not self._buffered:
+            self._writer = LogWriter(self._output, **self._writer_options)
+            self._writer.start()
         # we're already sending to stdout, so no need to duplicate.
         if self._output and self._output != sys.stdout:
             begin_or_register(self)
 
     def stop(self):
+        if self._writer:
+            self._writer.stop()
+            self._writer = None
         if self._output and self._output != sys.stdout:
             globalLogPublisher.removeObserver(self)
             if self._filename:
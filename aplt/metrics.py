@@ -1,7 +1,12 @@
 """Metrics interface and implementations"""
-from twisted.internet import reactor
+import errno
+import json
+import math
+import os
+
+from twisted.internet import reactor, task
+from twisted.python import log
 from txstatsd.client import StatsDClientProtocol, TwistedStatsDClient
-from txstatsd.metrics.metrics import Metrics
 
 try:
     import datadog
@@ -34,6 +39,10 @@ class IMetrics(object):
         """Record a timing in ms for a metric name"""
         raise NotImplementedError("No timing implemented")
 
+    def gauge(self, name, value, **kwargs):
+        """Record the current value of a metric name"""
+        raise NotImplementedError("No gauge implemented")
+
 
 class SinkMetrics(IMetrics):
     """Exists to ignore metrics when metrics are not active"""
@@ -43,29 +52,335 @@ class SinkMetrics(IMetrics):
     def timing(self, name, duration, **kwargs):
         pass
 
+    def gauge(self, name, value, **kwargs):
+        pass
+
+
+class PipeMetrics(IMetrics):
+    """Forwards metrics over a file descriptor to a supervising process
+
+    Each metric is written as a line of JSON, ``[method, name, value]``.
+    Lines are buffered and written out every ``flush_interval`` seconds.
+
+    """
+    def __init__(self, fd, flush_interval=1):
+        self._fd = fd
+        self._flush_interval = flush_interval
+        self._pending = []
+        self._loop = None
+
+    def start(self):
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.start(self._flush_interval, now=False)
+
+    def stop(self):
+        if self._loop and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        self.flush()
+
+    def flush(self):
+        """Write all pending metric lines to the pipe"""
+        if not self._pending:
+            return
+        data = "".join(self._pending)
+        self._pending = []
+        try:
+            while data:
+                data = data[os.write(self._fd, data):]
+        except OSError as exc:
+            if exc.errno != errno.EPIPE:
+                raise
+            # The supervisor went away, there's no one to report to
+            log.msg("Metrics pipe closed, stopping")
+            if reactor.running:
+                reactor.stop()
+
+    def increment(self, name, count=1, **kwargs):
+        self._pending.append(json.dumps(["increment", name, count]) + "\n")
+
+    def timing(self, name, duration, **kwargs):
+        self._pending.append(json.dumps(["timing", name, duration]) + "\n")
+
+    def gauge(self, name, value, **kwargs):
+        self._pending.append(json.dumps(["gauge", name, value]) + "\n")
+
+
+class AggregateMetrics(IMetrics):
+    """Passes metrics on to another client while aggregating them
+
+    Counters are summed and timings are kept as ``[count, total, min, max]``
+    summaries until :meth:`collect` is called. With ``forward_counters``
+    false, counters are only aggregated, for when whoever collects them
+    passes them on instead.
+
+    """
+    def __init__(self, client, forward_counters=True):
+        self.client = client
+        self._forward_counters = forward_counters
+        self._counters = {}
+        self._timers = {}
+
+    def start(self):
+        self.client.start()
+
+    def stop(self):
+        self.client.stop()
+
+    def increment(self, name, count=1, **kwargs):
+        if self._forward_counters:
+            self.client.increment(name, count, **kwargs)
+        self._counters[name] = self._counters.get(name, 0) + count
+
+    def timing(self, name, duration, **kwargs):
+        self.client.timing(name, duration, **kwargs)
+        timer = self._timers.get(name)
+        if timer is None:
+            self._timers[name] = [1, duration, duration, duration]
+        else:
+            timer[0] += 1
+            timer[1] += duration
+            timer[2] = min(timer[2], duration)
+            timer[3] = max(timer[3], duration)
+
+    def gauge(self, name, value, **kwargs):
+        self.client.gauge(name, value, **kwargs)
+
+    def collect(self):
+        """Return and reset the counters and timings aggregated so far"""
+        counters, timers = self._counters, self._timers
+        self._counters, self._timers = {}, {}
+        return counters, timers
+
+
+class Histogram(object):
+    """HDR-style histogram of non-negative integer values
+
+    Values are counted in buckets whose width grows with the magnitude of the
+    value, so every value is recorded to within ``significant_figures``
+    decimal digits of precision in constant time and memory, however many
+    samples are recorded.
+
+    """
+    def __init__(self, significant_figures=2):
+        # Values below this are counted exactly, each doubling after it
+        # halves the resolution
+        self._sub_bucket_bits = int(math.ceil(
+            math.log(2 * 10 ** significant_figures, 2)))
+        self._sub_bucket_count = 1 << self._sub_bucket_bits
+        self._half_count = self._sub_bucket_count >> 1
+        self.reset()
+
+    def reset(self):
+        """Forget all the recorded values"""
+        self.count = 0
+        self.max = 0
+        self._counts = {}
+
+    def _index(self, value):
+        shift = max(0, value.bit_length() - self._sub_bucket_bits)
+        return shift * self._half_count + (value >> shift)
+
+    def _highest_value(self, index):
+        """The highest value counted at an index"""
+        if index < self._sub_bucket_count:
+            return index
+        shift, sub_index = divmod(index - self._sub_bucket_count,
+                                  self._half_count)
+        shift += 1
+        return ((sub_index + self._half_count + 1) << shift) - 1
+
+    def record(self, value):
+        """Record a value, negative values are recorded as 0"""
+        value = max(int(value), 0)
+        index = self._index(value)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentiles(self, *percentiles):
+        """Return the values at or below which each percentage of the
+        recorded values fall"""
+        results = []
+        indexes = sorted(self._counts)
+        for percentile in percentiles:
+            target = max(1, int(math.ceil(self.count * percentile / 100.0)))
+            seen = 0
+            value = 0
+            for index in indexes:
+                seen += self._counts[index]
+                if seen >= target:
+                    value = self._highest_value(index)
+                    break
+            results.append(min(value, self.max))
+        return results
+
+
+class HistogramMetrics(IMetrics):
+    """Records timings into a histogram per metric name, passing on only
+    their percentiles
+
+    Sending every timing sample on its own floods a statsd or Datadog
+    collector at high rates. Instead, every ``flush_interval`` seconds each
+    timing name recorded since the last flush is sent as gauges of its
+    ``p50``, ``p90``, ``p99``, ``p999`` and ``max`` values, and a ``count``
+    counter, e.g. ``update.latency.p99``. The gauges are scaled the same
+    way the client scales timings, so they're in the same unit as the
+    samples would have been. Counters and gauges are passed on as is.
+
+    """
+    PERCENTILES = (("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9))
+
+    def __init__(self, client, flush_interval=10, significant_figures=2):
+        self.client = client
+        self._flush_interval = flush_interval
+        self._significant_figures = significant_figures
+        self._histograms = {}
+        self._loop = None
+
+    def start(self):
+        self.client.start()
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.start(self._flush_interval, now=False)
+
+    def stop(self):
+        if self._loop and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        self.flush()
+        self.client.stop()
+
+    def flush(self):
+        """Send the percentiles of the timings recorded since the last
+        flush"""
+        scale = getattr(self.client, "timing_scale", 1)
+        for name, histogram in self._histograms.items():
+            if not histogram.count:
+                continue
+            values = histogram.percentiles(
+                *[percentile for _, percentile in self.PERCENTILES])
+            for (suffix, _), value in zip(self.PERCENTILES, values):
+                self.client.gauge("{}.{}".format(name, suffix),
+                                  value * scale)
+            self.client.gauge(name + ".max", histogram.max * scale)
+            self.client.increment(name + ".count", histogram.count)
+            histogram.reset()
+
+    def increment(self, name, count=1, **kwargs):
+        self.client.increment(name, count, **kwargs)
+
+    def timing(self, name, duration, **kwargs):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = Histogram(
+                self._significant_figures)
+        histogram.record(duration)
+
+    def gauge(self, name, value, **kwargs):
+        self.client.gauge(name, value, **kwargs)
+
+
+def merge_timers(timers, other):
+    """Merge the ``[count, total, min, max]`` timing summaries of ``other``
+    into ``timers``"""
+    for name, (count, total, low, high) in other.items():
+        timer = timers.get(name)
+        if timer is None:
+            timers[name] = [count, total, low, high]
+        else:
+            timer[0] += count
+            timer[1] += total
+            timer[2] = min(timer[2], low)
+            timer[3] = max(timer[3], high)
+    return timers
+
+
+def pack_lines(lines, max_size):
+    """Join metric lines into as few newline separated datagrams of at most
+    ``max_size`` bytes as possible
+
+    A line longer than ``max_size`` is sent in a datagram of its own.
+
+    """
+    datagrams = []
+    packet = []
+    size = 0
+    for line in lines:
+        if packet and size + 1 + len(line) > max_size:
+            datagrams.append("\n".join(packet))
+            packet = []
+            size = 0
+        size += len(line) + (1 if packet else 0)
+        packet.append(line)
+    if packet:
+        datagrams.append("\n".join(packet))
+    return datagrams
+
 
 class TwistedMetrics(object):
-    """Twisted implementation of statsd output"""
+    """Twisted implementation of statsd output
+
+    Rather than a datagram per metric, counters are summed and gauges keep
+    their last value in memory, and every ``flush_interval`` seconds they're
+    sent along with the timings recorded since the last flush, packed into
+    datagrams of up to ``max_packet_size`` bytes.
+
+    """
+    # Timings are multiplied by this when sent
+    timing_scale = 1000
+
     def __init__(self, statsd_host="localhost", statsd_port=8125,
-                 namespace="aplt"):
+                 namespace="aplt", flush_interval=1, max_packet_size=1432):
         self.client = TwistedStatsDClient.create(statsd_host, statsd_port)
-        self._metric = Metrics(connection=self.client, namespace=namespace)
+        self._prefix = namespace + "." if namespace else ""
+        self._flush_interval = flush_interval
+        self._max_packet_size = max_packet_size
+        self._counters = {}
+        self._gauges = {}
+        self._timings = []
         self._stat_protocol = None
+        self._loop = None
 
     def start(self):
         protocol = StatsDClientProtocol(self.client)
         self._stat_protocol = reactor.listenUDP(0, protocol)
+        self._loop = task.LoopingCall(self.flush)
+        self._loop.start(self._flush_interval, now=False)
 
     def stop(self):
+        if self._loop and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        self.flush()
         if self._stat_protocol:  # pragma: nocover
             self._stat_protocol.stopListening()
             self._stat_protocol = None
 
+    def flush(self):
+        """Send all the metrics recorded since the last flush"""
+        prefix = self._prefix
+        lines = ["{}{}:{}|c".format(prefix, name, count)
+                 for name, count in self._counters.items()]
+        lines.extend(self._timings)
+        lines.extend("{}{}:{}|g".format(prefix, name, value)
+                     for name, value in self._gauges.items())
+        self._counters = {}
+        self._gauges = {}
+        self._timings = []
+        for datagram in pack_lines(lines, self._max_packet_size):
+            self.client.write(datagram)
+
     def increment(self, name, count=1, **kwargs):
-        self._metric.increment(name, count)
+        self._counters[name] = self._counters.get(name, 0) + count
 
     def timing(self, name, duration, **kwargs):
-        self._metric.timing(name, duration)
+        # Durations are in seconds, sent in ms as txstatsd's Metrics did
+        self._timings.append("{}{}:{}|ms".format(
+            self._prefix, name, duration * self.timing_scale))
+
+    def gauge(self, name, value, **kwargs):
+        self._gauges[name] = value
 
 
 class DatadogMetrics(object):
@@ -86,6 +401,9 @@ class DatadogMetrics(object):
         self._client.start(flush_interval=self._flush_interval,
                            roll_up_interval=self._flush_interval)
 
+    def stop(self):
+        self._client.flush()
+
     def increment(self, name, count=1, **kwargs):
         self._client.increment(self._prefix_name(name), count, host=self._host,
                                **kwargs)
@@ -93,3 +411,7 @@ class DatadogMetrics(object):
     def timing(self, name, duration, **kwargs):
         self._client.timing(self._prefix_name(name), value=duration,
                             host=self._host, **kwargs)
+
+    def gauge(self, name, value, **kwargs):
+        self._client.gauge(self._prefix_name(name), value=value,
+                           host=self._host, **kwargs)
@@ -0,0 +1,157 @@
+"""Pre-generated notification payloads
+
+Reading fresh randomness from ``os.urandom`` for every notification is a
+syscall and an allocation per send, which adds up at high send rates.
+Instead, one :class:`RandomPool` of random bytes is generated at startup,
+and every payload is a slice of it at a random offset: a ``memoryview``
+from :func:`random_payload`, with no bytes copied until it's sent, or a
+string from :func:`aplt.commands.random_data`.
+
+Payload sizes are drawn from a :class:`SizeHistogram` of weighted ranges,
+set for the whole process with :func:`set_payload_options`.
+
+"""
+import os
+import random
+import string
+from bisect import bisect_right
+
+# Payload sizes used unless set otherwise, as sent by the stock scenarios
+DEFAULT_SIZES = "2048-4096"
+
+# Characters string_generator picks from, mapped from the pool's bytes.
+# Bytes past the last whole multiple of the alphabet are dropped, so every
+# character is as likely.
+_CHARACTERS = string.ascii_lowercase + string.digits
+_USABLE = 256 - 256 % len(_CHARACTERS)
+_CHARACTER_TABLE = "".join(_CHARACTERS[i % len(_CHARACTERS)]
+                           for i in range(256))
+_REJECTED = "".join(chr(i) for i in range(_USABLE, 256))
+
+
+class RandomPool(object):
+    """A buffer of random bytes handing out slices of itself
+
+    :param size: Bytes of randomness generated up front, which is also the
+        longest slice that can be taken.
+
+    """
+    def __init__(self, size=1 << 20, urandom=os.urandom):
+        if size < 1:
+            raise ValueError("Invalid pool size: %s" % size)
+        self._view = memoryview(urandom(size))
+        self.size = size
+
+    def slice(self, length):
+        """Return a ``memoryview`` of ``length`` random bytes"""
+        if not 0 <= length <= self.size:
+            raise ValueError("Can't take %s bytes from a pool of %s" %
+                             (length, self.size))
+        offset = random.randint(0, self.size - length)
+        return self._view[offset:offset + length]
+
+    def string(self, length):
+        """Return a random string of ``length`` lowercase letters and
+        digits"""
+        chunks = []
+        while length > 0:
+            # Enough extra bytes that one slice usually suffices
+            size = min(length + length // 8 + 8, self.size)
+            chunk = self.slice(size).tobytes().translate(_CHARACTER_TABLE,
+                                                         _REJECTED)
+            chunks.append(chunk[:length])
+            length -= len(chunks[-1])
+        return "".join(chunks)
+
+
+class SizeHistogram(object):
+    """Draws sizes from weighted ranges
+
+    :param buckets: List of ``(weight, min_length, max_length)``. A range
+        is picked with the odds of its weight, then a length within it from
+        ``min_length`` up to but not including ``max_length``, or exactly
+        ``min_length`` when they're equal.
+
+    """
+    def __init__(self, buckets):
+        if not buckets:
+            raise ValueError("No payload sizes")
+        self._totals = []
+        self._ranges = []
+        total = 0
+        for weight, min_length, max_length in buckets:
+            if weight <= 0 or not 0 <= min_length <= max_length:
+                raise ValueError("Invalid payload size: %s-%s:%s" %
+                                 (min_length, max_length, weight))
+            total += weight
+            self._totals.append(total)
+            self._ranges.append((min_length, max_length))
+        self.max_length = max(max_length for _, max_length in self._ranges)
+
+    def draw(self):
+        """Return a size"""
+        point = random.random() * self._totals[-1]
+        index = min(bisect_right(self._totals, point), len(self._totals) - 1)
+        min_length, max_length = self._ranges[index]
+        if min_length == max_length:
+            return min_length
+        return random.randrange(min_length, max_length)
+
+
+def parse_sizes(string):
+    """Parse a size histogram from a comma separated list of
+    ``min_length[-max_length][:weight]``, e.g. ``"2048-4096:3,32768"``"""
+    buckets = []
+    for part in string.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        lengths, _, weight = part.partition(":")
+        min_length, _, max_length = lengths.partition("-")
+        try:
+            min_length = int(min_length)
+            max_length = int(max_length) if max_length else min_length
+            weight = float(weight) if weight else 1
+        except ValueError:
+            raise ValueError("Invalid payload size: %s" % part)
+        buckets.append((weight, min_length, max_length))
+    return SizeHistogram(buckets)
+
+
+_pool = None
+_pool_size = 1 << 20
+_sizes = parse_sizes(DEFAULT_SIZES)
+
+
+def get_pool():
+    """Return the shared pool, generating it on first use"""
+    global _pool
+    if _pool is None:
+        _pool = RandomPool(_pool_size)
+    return _pool
+
+
+def set_payload_options(pool_size=1 << 20, sizes=DEFAULT_SIZES):
+    """Set the shared pool to hold ``pool_size`` random bytes, generated
+    when it's next used, and draw payload sizes from the ``sizes``
+    histogram (see :func:`parse_sizes`)"""
+    global _pool, _pool_size, _sizes
+    histogram = parse_sizes(sizes)
+    if histogram.max_length > pool_size:
+        raise ValueError("Payload sizes up to %s don't fit a pool of %s" %
+                         (histogram.max_length, pool_size))
+    _pool = None
+    _pool_size = pool_size
+    _sizes = histogram
+
+
+def random_payload(min_length=None, max_length=None):
+    """Return a ``memoryview`` of random bytes from the shared pool, sized
+    from the payload size histogram unless ``min_length`` is given"""
+    if min_length is None:
+        length = _sizes.draw()
+    elif max_length is None or min_length == max_length:
+        length = min_length
+    else:
+        length = random.randrange(min_length, max_length)
+    return get_pool().slice(length)
@@ -4,7 +4,9 @@ import importlib
 import inspect
 import json
 import re
+import sys
 import urlparse
+from argparse import SUPPRESS
 from collections import deque
 from StringIO import StringIO
 
@@ -14,8 +16,7 @@ from autobahn.twisted.websocket import (
     WebSocketClientFactory
 )
 from configargparse import ArgumentParser
-from py_vapid import Vapid
-from twisted.internet import reactor, ssl, task
+from twisted.internet import defer, reactor, task
 from twisted.python import log
 from twisted.web.client import Agent
 
@@ -24,8 +25,43 @@ from aplt.client import (
     CommandProcessor,
     WSClientProtocol
 )
+from aplt.http2 import H2Error, close_clients, set_http2_options
+from aplt.http2 import new_client as new_h2_client
+from aplt.httpclient import (
+    close_pools,
+    new_pool,
+    read_body,
+    set_pool_options,
+)
+from aplt.payloads import DEFAULT_SIZES, get_pool, set_payload_options
 from aplt.utils import UnverifiedHTTPS
-from aplt.logobserver import AP_Logger
+from aplt.logobserver import (
+    INFO,
+    AP_Logger,
+    parse_sample_rates,
+    set_error_limits,
+    set_trace_level,
+    stop_error_limits,
+    tracing,
+)
+from aplt.scheduler import (
+    ARRIVALS,
+    DEFAULT_ARRIVAL,
+    RAMPS,
+    Launcher,
+    curve_arrivals,
+    load_rate_file,
+)
+from aplt.timers import set_resolution
+from aplt.tls import ResumingClientContextFactory
+from aplt.vapid import (
+    BACKENDS,
+    Vapid,
+    VapidCache,
+    VapidPool,
+    set_default_backend,
+)
+from aplt.workers import METRICS_FD, WorkerSupervisor
 
 
 # Necessary for latest version of txaio
@@ -34,6 +70,12 @@ txaio.use_twisted()
 
 STATS_PROTOCOL = None
 
+# Test plan options, taken out of a test plan tuple's keyword arguments
+# rather than passed on to its scenario
+RAMP_OPTIONS = ("ramp_from", "ramp_time", "ramp_steps", "spike_rate",
+                "spike_at", "spike_time")
+PLAN_OPTIONS = ("arrival", "ramp") + RAMP_OPTIONS
+
 PEM_FILE_HEADER = "-----BEGIN "
 
 
@@ -52,6 +94,7 @@ class RunnerHarness(object):
                  endpoint=None,
                  endpoint_ssl_cert=None,
                  endpoint_ssl_key=None,
+                 vapid_pool=None,
                  *scenario_args,
                  **scenario_kw):
         logging.debug("Connecting to {}".format(websocket_url))
@@ -61,7 +104,9 @@ class RunnerHarness(object):
         self._factory.protocol = WSClientProtocol
         self._factory.harness = self
         if websocket_url.startswith("wss"):
-            self._factory_context = ssl.ClientContextFactory()
+            # Shared by every connection, so their TLS sessions are resumed
+            self._factory_context = ResumingClientContextFactory(
+                self._factory.host, self.counter)
         else:
             self._factory_context = None
 
@@ -74,41 +119,65 @@ class RunnerHarness(object):
         self._scenario_args = scenario_args
         self._scenario_kw = scenario_kw
         self._processors = 0
+        # Processors whose scenario ended, reused for later runs
+        self._idle_processors = set()
         self._ws_clients = {}
         self._connect_waiters = deque()
         self._load_runner = load_runner
         self._stat_client = statsd_client
         self._vapid = Vapid()
+        self._vapid_pool = vapid_pool
+        self._vapid_waiters = []
         if "vapid_private_key" in self._scenario_kw:
             self._vapid = Vapid(
                 private_key=self._scenario_kw.get(
                     "vapid_private_key"))
+        elif vapid_pool:
+            # Signing will wait for the keys to be generated
+            self._vapid = None
+            d = vapid_pool.generate_keys()
+            d.addCallback(self._vapid_generated)
+            d.addErrback(log.err)
         else:
             self._vapid.generate_keys()
+        self._vapid_cache = VapidCache(metrics=statsd_client)
         self._claims = ()
         if "vapid_claims" in self._scenario_kw:
             self._claims = self._scenario_kw.get("vapid_claims")
 
         self._endpoint = urlparse.urlparse(endpoint) if endpoint else None
-        self._agent = None
+        self._pool = new_pool(self.counter)
+        policy = None
         if endpoint_ssl_cert:
-            self._agent = Agent(
-                reactor,
-                contextFactory=UnverifiedHTTPS(
-                    endpoint_ssl_cert,
-                    endpoint_ssl_key))
+            policy = UnverifiedHTTPS(endpoint_ssl_cert, endpoint_ssl_key)
+            self._agent = Agent(reactor, contextFactory=policy,
+                                pool=self._pool)
             if hasattr(endpoint_ssl_cert, 'seek'):
                 endpoint_ssl_cert.seek(0)
             if endpoint_ssl_key and hasattr(endpoint_ssl_key, 'seek'):
                 endpoint_ssl_key.seek(0)
+        else:
+            self._agent = Agent(reactor, pool=self._pool)
+        # Sends notifications instead of treq when HTTP/2 is enabled
+        self._h2_client = new_h2_client(policy, self.counter)
+
+    def run(self, intended_start=None):
+        """Start registered scenario
+
+        :param intended_start: The time the scenario was scheduled to start
+            at. How late it started is added to the first timer it starts.
 
-    def run(self):
-        """Start registered scenario"""
-        # Create the processor and start it
-        processor = CommandProcessor(self._scenario,
-                                     self._scenario_args,
-                                     self._scenario_kw,
-                                     self)
+        """
+        # Reuse or create the processor and start it
+        if self._idle_processors:
+            processor = self._idle_processors.pop()
+            processor.restart(intended_start)
+        else:
+            processor = CommandProcessor(self._scenario,
+                                         self._scenario_args,
+                                         self._scenario_kw,
+                                         self,
+                                         intended_start)
         processor.run()
         self._processors += 1
 
@@ -129,6 +198,29 @@ class RunnerHarness(object):
         This uses the older `aesgcm` format.
 
         """
+        sent = processor._sending()
+        d = self._notify(url, data, headers, claims)
+        d.addCallback(sent)
+
+    def send_notifications(self, processor, notifications, window):
+        """Send out a batch of notifications for a processor, with at most
+        ``window`` of them in flight at once
+
+        The processor is sent the ``(response, content)`` of every
+        notification, in the order of the batch.
+
+        """
+        sent = processor._sending()
+        semaphore = defer.DeferredSemaphore(window)
+        d = defer.gatherResults([
+            semaphore.run(self._notify, n.endpoint_url, n.data, n.headers,
+                          n.claims)
+            for n in notifications])
+        d.addCallback(sent)
+
+    def _notify(self, url, data, headers=None, claims=None):
+        """Return a deferred firing with the ``(response, content)`` of a
+        notification, or ``(None, failure)`` if it failed"""
         if not headers:
             headers = {}
         url = url.encode("utf-8")
@@ -138,7 +230,7 @@ class RunnerHarness(object):
         if claims is None:
             claims = ()
         claims = claims or self._claims
-        if self._vapid and claims:
+        if claims:
             if isinstance(claims, str):
                 claims = json.loads(claims)
             if "aud" not in claims:
@@ -148,8 +240,11 @@ class RunnerHarness(object):
                     scheme=parsed.scheme,
                     netloc=parsed.netloc
                 )
-                log.msg("Setting VAPID 'aud' to {}".format(claims["aud"]))
-            headers.update(self._vapid.sign(claims, self._crypto_key))
+                if tracing(INFO, "vapid"):
+                    log.msg("Setting VAPID 'aud' to {}".format(claims["aud"]))
+            d = self._sign_claims(claims)
+        else:
+            d = defer.succeed({})
         if data:
             headers.update({
                 "Content-Type": "application/octet-stream",
@@ -158,26 +253,61 @@ class RunnerHarness(object):
                 "Encryption": self._encryption,
             })
 
-        d = treq.post(url,
-                      data=data,
-                      headers=headers,
-                      allow_redirects=False,
-                      agent=self._agent)
-        d.addCallback(self._sent_notification, processor)
-        d.addErrback(self._error_notif, processor)
+        d.addCallback(self._post_notification, url, data, headers)
+        d.addCallback(self._sent_notification)
+        d.addErrback(self._error_notif)
+        return d
 
-    def _sent_notification(self, result, processor):
-        d = result.content()
-        d.addCallback(self._finished_notification, result, processor)
-        d.addErrback(self._error_notif, result, processor)
+    def _vapid_generated(self, vapid):
+        self._vapid = vapid
+        waiters, self._vapid_waiters = self._vapid_waiters, []
+        for d in waiters:
+            d.callback(vapid)
 
-    def _finished_notification(self, result, response, processor):
-        # Give the fully read content and response to the processor
-        processor._send_command_result((response, result))
+    def _sign_claims(self, claims):
+        """Return a deferred firing with the VAPID headers for the claims
 
-    def _error_notif(self, failure, processor):
-        # Send the failure back
-        processor._send_command_result((None, failure))
+        Signing happens immediately, unless a VAPID pool was supplied in
+        which case it happens in a pool process.
+
+        """
+        if self._vapid is None:
+            d = defer.Deferred()
+            d.addCallback(lambda _: self._sign_claims(claims))
+            self._vapid_waiters.append(d)
+            return d
+        vapid, crypto_key = self._vapid, self._crypto_key
+        if self._vapid_pool:
+            def sign(claims):
+                return self._vapid_pool.sign(vapid, claims, crypto_key)
+        else:
+            def sign(claims):
+                return vapid.sign(claims, crypto_key)
+        return self._vapid_cache.sign_later(vapid, claims, crypto_key, sign)
+
+    def _post_notification(self, vapid_headers, url, data, headers):
+        headers.update(vapid_headers)
+        if isinstance(data, memoryview):
+            # Copied out of the payload pool only now it's sent, as
+            # transports only take strings
+            data = data.tobytes()
+        if self._h2_client is not None:
+            return self._h2_client.post(url, data, headers)
+        return treq.post(url,
+                         data=data,
+                         headers=headers,
+                         allow_redirects=False,
+                         agent=self._agent)
+
+    def _sent_notification(self, response):
+        # Pair the fully read content with the response
+        d = read_body(response)
+        d.addCallback(lambda content: (response, content))
+        return d
+
+    def _error_notif(self, failure):
+        # Give the failure back in place of the response
+        return (None, failure)
 
     def add_client(self, ws_client):
         """Register a new websocket connection and return a waiting
@@ -201,9 +331,13 @@ class RunnerHarness(object):
                 connectWS(self._factory, contextFactory=self._factory_context)
             return
 
-    def remove_processor(self):
-        """Remove a completed processor"""
+    def remove_processor(self, processor=None):
+        """Remove a completed processor, keeping it for reuse if nothing
+        still refers to it"""
         self._processors -= 1
+        if processor is not None and processor.reusable:
+            # A set, so a processor can never be idle twice
+            self._idle_processors.add(processor)
 
     def timer(self, name, duration):
         """Record a metric timer if we have a statsd client"""
@@ -222,11 +356,13 @@ class LoadRunner(object):
                      websocket_url,
                      endpoint,
                      endpoint_ssl_cert,
-                     endpoint_ssl_key):
+                     endpoint_ssl_key,
+                     vapid_pool=None):
             """Initializes a LoadRunner
 
             Takes a list of tuples indicating scenario to run, quantity,
-            stagger delay, and overall delay.
+            stagger delay, and overall delay, scenario arguments and
+            optionally a dict of test plan options.
 
             Stagger delay is a number indicating how many of the scenario to
             launch per second.
@@ -234,38 +370,42 @@ class LoadRunner(object):
             Overall delay is how many seconds after the start of the load-run
             before the scenario should begin.
 
+            The ``arrival`` test plan option picks the
+            :data:`aplt.scheduler.ARRIVALS` schedule launches are made on,
+            evenly spaced ``constant`` by default. With a ``ramp`` option, an
+            :class:`aplt.scheduler.RateCurve`, launches follow its rate
+            instead of the stagger.
+
             Example::
 
                 lr = LoadRunner([
                     (basic, 1000, 100, 0, *scenario_args),
                 ], "wss://somepushservice/")
 
-            .. note::
-
-                Any leftover quantity not cleanly divided into the stagger
-                delay will not be started. The quantity should be cleanly
-                divided into stagger delay.
-
             """
             self._harnesses = []
             self._testplans = scenario_list
             self._started = False
-            self._queued_calls = 0
+            self._launchers = []
             self._statsd_client = statsd_client
             self._websocket_url = websocket_url
             self._endpoint = endpoint
             self._endpoint_ssl_cert = endpoint_ssl_cert
             self._endpoint_ssl_key = endpoint_ssl_key
+            self._vapid_pool = vapid_pool
 
         def start(self):
             """Schedules all the scenarios supplied"""
+            # Generated up front rather than by the first notification sent
+            get_pool()
             for testplan in self._testplans:
                 self._run_testplan(testplan)
             self._started = True
 
         def _run_testplan(self, test_plan):
             scenario, quantity, stagger, overall_delay, scenario_args = \
-                test_plan
+                test_plan[:5]
+            options = test_plan[5] if len(test_plan) > 5 else {}
             harness = RunnerHarness(
                 self,
                 self._websocket_url,
@@ -274,18 +414,21 @@ class LoadRunner(object):
                 self._endpoint,
                 self._endpoint_ssl_cert,
                 self._endpoint_ssl_key,
+                self._vapid_pool,
                 *scenario_args[0],
                 **scenario_args[1]
             )
             self._harnesses.append(harness)
-            iterations = quantity / stagger
-            for delay in range(iterations):
-                def runall():
-                    for _ in range(stagger):
-                        harness.run()
-                    self._queued_calls -= 1
-                self._queued_calls += 1
-                reactor.callLater(overall_delay+delay, runall)
+            arrival = options.get("arrival", DEFAULT_ARRIVAL)
+            if options.get("ramp"):
+                offsets = curve_arrivals(quantity, options["ramp"], arrival)
+            else:
+                offsets = ARRIVALS[arrival](quantity, stagger)
+            launcher = Launcher(harness.run, offsets,
+                                reactor.seconds() + overall_delay,
+                                self._statsd_client)
+            self._launchers.append(launcher)
+            launcher.start()
 
         @property
         def finished(self):
@@ -298,7 +441,7 @@ class LoadRunner(object):
             """
             return all([
                 self._started,
-                self._queued_calls == 0,
+                all([x.finished for x in self._launchers]),
                 all([x._processors <= 0 for x in self._harnesses])
             ])
 
@@ -393,13 +536,81 @@ def parse_testplan(testplan):
         int_args, kw_args = group_kw_args(*parts)
         int_args = try_int_list_coerce(int_args)
         func_args = int_args[3:]
+        options = dict((name, kw_args.pop(name)) for name in PLAN_OPTIONS
+                       if name in kw_args)
+        if options.get("arrival", DEFAULT_ARRIVAL) not in ARRIVALS:
+            raise Exception("Error parsing test plan. Unknown arrival for "
+                            "%s: %s" % (func_name, options["arrival"]))
+        parse_ramp(func_name, int_args[1], options)
         verify_arguments(func, *func_args, **kw_args)
         args = [func] + int_args[:3]
         args.append((func_args, kw_args))
+        args.append(options)
         result.append(tuple(args))
     return result
 
 
+def parse_ramp(func_name, stagger, options):
+    """Replace the ramp options of a test plan tuple with the
+    :class:`aplt.scheduler.RateCurve` they describe"""
+    ramp_options = dict((name, options.pop(name)) for name in RAMP_OPTIONS
+                        if name in options)
+    ramp = options.get("ramp")
+    if not ramp:
+        if ramp_options:
+            raise Exception("Error parsing test plan. Ramp options for %s "
+                            "without a ramp: %s" % (func_name,
+                                                    sorted(ramp_options)))
+        return
+    try:
+        if ramp in RAMPS:
+            options["ramp"] = RAMPS[ramp](stagger, **ramp_options)
+        elif ramp_options:
+            raise TypeError("Ramp options given for a rate file")
+        else:
+            options["ramp"] = load_rate_file(ramp)
+    except (TypeError, ValueError, IOError) as exc:
+        raise Exception("Error parsing test plan. Invalid ramp for %s: %s" %
+                        (func_name, exc))
+
+
+def split_quantity(quantity, stagger, count, index):
+    """Return the quantity and stagger for slice ``index`` of a test plan
+    tuple divided into ``count`` slices
+
+    Slices are kept to at least one launch per second, so a stagger smaller
+    than ``count`` leaves the trailing slices empty.
+
+    """
+    active = min(count, stagger)
+    if index >= active:
+        return 0, 0
+    return (quantity // active + (1 if index < quantity % active else 0),
+            stagger // active + (1 if index < stagger % active else 0))
+
+
+def split_testplan(testplans, count, index):
+    """Return slice ``index`` of every test plan tuple divided into ``count``
+    slices, dropping any that end up empty"""
+    result = []
+    for plan in testplans:
+        quantity, stagger = split_quantity(plan[1], plan[2], count, index)
+        if quantity:
+            result.append(slice_testplan(plan, quantity, stagger))
+    return result
+
+
+def slice_testplan(plan, quantity, stagger):
+    """Return a test plan tuple with its quantity and stagger replaced by a
+    share of them, scaling any ramp down to the same share"""
+    sliced = (plan[0], quantity, stagger) + tuple(plan[3:])
+    options = sliced[5] if len(sliced) > 5 else {}
+    if options.get("ramp"):
+        ramp = options["ramp"].scaled(float(stagger) / plan[2])
+        sliced = sliced[:5] + (dict(options, ramp=ramp),)
+    return sliced
+
+
 def parse_string_to_list(string):
     """Parse a string into a list of strings"""
     if string:
@@ -417,12 +628,14 @@ def parse_statsd_args(args=None):
         return metrics.SinkMetrics()
     if args.statsd_host is not None:
         # We're using statsd
-        return metrics.TwistedMetrics(args.statsd_host,
-                                      args.statsd_port,
-                                      args.metric_namespace)
+        client = metrics.TwistedMetrics(args.statsd_host,
+                                        args.statsd_port,
+                                        args.metric_namespace,
+                                        args.statsd_flush_interval,
+                                        args.statsd_packet_size)
     elif args.datadog_api_key is not None:
         # We're using datadog
-        return metrics.DatadogMetrics(
+        client = metrics.DatadogMetrics(
             api_key=args.datadog_api_key,
             app_key=args.datadog_app_key,
             flush_interval=args.datadog_flush_interval,
@@ -431,6 +644,10 @@ def parse_statsd_args(args=None):
     else:
         # Metric sink
         return metrics.SinkMetrics()
+    if args.histogram_interval:
+        # Send timing percentiles rather than every sample
+        client = metrics.HistogramMetrics(client, args.histogram_interval)
+    return client
 
 
 def parse_endpoint_args(args):
@@ -451,6 +668,69 @@ def parse_endpoint_args(args):
     return endpoint, cert, key
 
 
+def parse_vapid_args(args):
+    """Selects the VAPID crypto backend, and returns a VAPID process pool if
+    one was asked for, stopped with the reactor"""
+    if args.vapid_backend:
+        set_default_backend(args.vapid_backend)
+    if not args.vapid_processes:
+        return None
+    pool = VapidPool(args.vapid_processes)
+    reactor.addSystemEventTrigger("after", "shutdown", pool.stop)
+    return pool
+
+
+def parse_timer_args(args):
+    """Sets the tick resolution of the shared timer wheel"""
+    if args.timer_resolution <= 0:
+        raise Exception("Invalid timer resolution: %s" %
+                        args.timer_resolution)
+    set_resolution(args.timer_resolution)
+
+
+def parse_http_args(args):
+    """Sets the options of the HTTP connection pools notifications are sent
+    through, or of HTTP/2 sending, with their connections closed before the
+    reactor stops"""
+    if args.http_connections < 1 or args.http_idle_timeout <= 0:
+        raise Exception("Invalid HTTP connection pool options")
+    set_pool_options(args.http_connections, args.http_idle_timeout,
+                     args.http_discard_bodies)
+    if args.http2_connections < 1 or args.http2_streams < 1:
+        raise Exception("Invalid HTTP/2 options")
+    try:
+        set_http2_options(args.http2, args.http2_connections,
+                          args.http2_streams)
+    except H2Error as exc:
+        raise Exception(str(exc))
+    reactor.addSystemEventTrigger("before", "shutdown", close_pools)
+    reactor.addSystemEventTrigger("before", "shutdown", close_clients)
+
+
+def parse_payload_args(args):
+    """Sets the size of the random pool notification payloads are sliced
+    from, generated once scenarios are started, and the histogram their
+    sizes are drawn from"""
+    try:
+        set_payload_options(args.payload_pool_size, args.payload_sizes)
+    except ValueError as exc:
+        raise Exception("Invalid payload options: %s" % exc)
+
+
+def parse_log_args(args):
+    """Sets the level and sampling rates hot path logging is checked
+    against, and how often repeated scenario errors are logged, with the
+    summaries of any still suppressed logged as the reactor stops"""
+    try:
+        set_trace_level(args.log_level, parse_sample_rates(args.log_sample))
+    except ValueError as exc:
+        raise Exception("Invalid log options: %s" % exc)
+    if args.error_burst < 1 or args.error_interval <= 0:
+        raise Exception("Invalid error log limits")
+    set_error_limits(args.error_burst, args.error_interval)
+    reactor.addSystemEventTrigger("before", "shutdown", stop_error_limits)
+
+
 def group_kw_args(*args):
     """Divvy up argument hashes and single values into args and kwargs."""
     kw_args = {}
@@ -510,6 +790,17 @@ def parse_common_args(parser):
                         type=int,
                         help="port on statsd_host for metric collection",
                         env_var="STATSD_PORT")
+    parser.add_argument("--statsd_flush_interval",
+                        type=float,
+                        help="period (in secs) between sending batches of "
+                             "metrics to statsd",
+                        env_var="STATSD_FLUSH_INTERVAL",
+                        default=1)
+    parser.add_argument("--statsd_packet_size",
+                        type=int,
+                        help="maximum size of the datagrams sent to statsd",
+                        env_var="STATSD_PACKET_SIZE",
+                        default=1432)
     parser.add_argument("--datadog_api_key",
                         help="datadog API key",
                         env_var="DATADOG_API_KEY")
@@ -520,6 +811,13 @@ def parse_common_args(parser):
                         type=int,
                         help="period (in secs) before datadog data flushed",
                         env_var="DATADOG_FLUSH_INTERVAL")
+    parser.add_argument("--histogram_interval",
+                        type=float,
+                        help="period (in secs) between sending timing "
+                             "percentiles instead of every timing sample, "
+                             "0 (the default) to send every sample",
+                        env_var="HISTOGRAM_INTERVAL",
+                        default=0)
     parser.add_argument("-e", "--endpoint",
                         help="push notification endpoint override URL",
                         env_var="ENDPOINT")
@@ -529,21 +827,109 @@ def parse_common_args(parser):
     parser.add_argument("--endpoint_ssl_key",
                         help="path to custom TLS key for endpoint",
                         env_var="ENDPOINT_SSL_KEY")
+    parser.add_argument("--vapid_processes",
+                        help="number of processes to sign VAPID claims in, "
+                             "0 to sign in the reactor",
+                        type=int,
+                        env_var="VAPID_PROCESSES",
+                        default=0)
+    parser.add_argument("--vapid_backend",
+                        help="crypto library to sign VAPID claims with "
+                             "(default: cryptography if installed, or ecdsa)",
+                        choices=sorted(BACKENDS),
+                        env_var="VAPID_BACKEND")
+    parser.add_argument("--http_connections",
+                        help="idle connections kept open to each push "
+                             "endpoint host, per test plan tuple",
+                        type=int,
+                        env_var="HTTP_CONNECTIONS",
+                        default=10)
+    parser.add_argument("--http_idle_timeout",
+                        help="seconds an idle push endpoint connection is "
+                             "kept open for",
+                        type=float,
+                        env_var="HTTP_IDLE_TIMEOUT",
+                        default=240)
+    parser.add_argument("--http_discard_bodies",
+                        help="drop push endpoint response bodies unread, "
+                             "send_notification returning empty content",
+                        action="store_true",
+                        env_var="HTTP_DISCARD_BODIES",
+                        default=False)
+    parser.add_argument("--http2",
+                        help="send notifications over HTTP/2 (needs h2)",
+                        action="store_true",
+                        env_var="HTTP2",
+                        default=False)
+    parser.add_argument("--http2_connections",
+                        help="HTTP/2 connections opened to each push "
+                             "endpoint host, per test plan tuple",
+                        type=int,
+                        env_var="HTTP2_CONNECTIONS",
+                        default=2)
+    parser.add_argument("--http2_streams",
+                        help="notifications sent at once over each HTTP/2 "
+                             "connection",
+                        type=int,
+                        env_var="HTTP2_STREAMS",
+                        default=100)
+    parser.add_argument("--payload_pool_size",
+                        help="bytes of random data generated at startup "
+                             "for notification payloads to be sliced from",
+                        type=int,
+                        env_var="PAYLOAD_POOL_SIZE",
+                        default=1 << 20)
+    parser.add_argument("--payload_sizes",
+                        help="histogram random_data payload sizes are "
+                             "drawn from, as a comma separated list of "
+                             "min[-max][:weight], e.g. 2048-4096:3,32768",
+                        type=str,
+                        env_var="PAYLOAD_SIZES",
+                        default=DEFAULT_SIZES)
+    parser.add_argument("--timer_resolution",
+                        help="period (in secs) between ticks of the timer "
+                             "wheel that times out scenario waits and "
+                             "expected notifications",
+                        type=float,
+                        env_var="TIMER_RESOLUTION",
+                        default=0.01)
     parser.add_argument("--log_name",
                         help="log prefix name",
                         env_var="LOG_NAME",
                         default="push_test")
     parser.add_argument("--log_level",
+                        type=str.lower,
+                        choices=["debug", "info", "warn", "error",
+                                 "critical"],
                         help="minimum log level to report (debug, info, warn,"
                              "error, critical)",
                         env_var="LOG_LEVEL",
                         default="info")
+    parser.add_argument("--log_sample",
+                        help="fraction of frequent log events to keep, by "
+                             "type: command, message or vapid "
+                             "(e.g. command=0.01,message=0.1)",
+                        env_var="LOG_SAMPLE")
+    parser.add_argument("--error_burst",
+                        help="tracebacks logged for each repeated scenario "
+                             "error every error_interval, beyond which only "
+                             "a summary is logged",
+                        type=int,
+                        env_var="ERROR_BURST",
+                        default=5)
+    parser.add_argument("--error_interval",
+                        help="period (in secs) between summaries of repeated "
+                             "scenario errors",
+                        type=float,
+                        env_var="ERROR_INTERVAL",
+                        default=10)
     parser.add_argument("--log_format",
                         help="format for log output (default, human, json)",
                         env_var="LOG_FORMAT",
                         default="default")
     parser.add_argument("--log_output",
-                        help="output target for log info (stdout, none, path)",
+                        help="output target for log info (stdout, none, "
+                             "path, path.gz for gzip)",
                         default="stdout",
                         env_var="LOG_OUTPUT")
 
@@ -569,13 +955,30 @@ def run_scenario(args=None, run=True):
                       [--metric_namespace=METRIC_NAMESPACE]
                       [--statsd_host=STATSD_HOST]
                       [--statsd_port=STATSD_PORT]
+                      [--statsd_flush_interval=STATSD_FLUSH_INTERVAL]
+                      [--statsd_packet_size=STATSD_PACKET_SIZE]
                       [--datadog_api_key=DD_API_KEY]
                       [--datadog_app_key=DD_APP_KEY]
                       [--datadog_flush_interval=DD_FLUSH_INTERVAL]
+                      [--histogram_interval=HISTOGRAM_INTERVAL]
                       [-e URL --endpoint=URL]
                       [--endpoint_ssl_cert=SSL_CERT]
                       [--endpoint_ssl_key=SSL_KEY]
+                      [--vapid_processes=VAPID_PROCESSES]
+                      [--vapid_backend=VAPID_BACKEND]
+                      [--http_connections=HTTP_CONNECTIONS]
+                      [--http_idle_timeout=HTTP_IDLE_TIMEOUT]
+                      [--http_discard_bodies]
+                      [--http2]
+                      [--http2_connections=HTTP2_CONNECTIONS]
+                      [--http2_streams=HTTP2_STREAMS]
+                      [--payload_pool_size=PAYLOAD_POOL_SIZE]
+                      [--payload_sizes=PAYLOAD_SIZES]
+                      [--timer_resolution=TIMER_RESOLUTION]
                       [--log_level=LOG_LEVEL]
+                      [--log_sample=LOG_SAMPLE]
+                      [--error_burst=ERROR_BURST]
+                      [--error_interval=ERROR_INTERVAL]
                       [--log_format=LOG_FORMAT]
                       [--log_output=LOG_OUTPUT]
 
@@ -607,13 +1010,18 @@ def run_scenario(args=None, run=True):
         scenario_args = try_int_list_coerce(scenario_args)
         verify_arguments(scenario, *scenario_args, **scenario_kw)
     endpoint, ssl_cert, ssl_key = parse_endpoint_args(arguments)
+    parse_timer_args(arguments)
+    parse_log_args(arguments)
+    parse_http_args(arguments)
+    parse_payload_args(arguments)
 
     # this is a smoke test, so only run one instance once.
     plan = ([scenario, 1, 1, 0] + [(scenario_args, scenario_kw)])
     testplans = [plan]
 
     lh = LoadRunner(testplans, statsd_client, arguments.websocket_url,
-                    endpoint, ssl_cert, ssl_key)
+                    endpoint, ssl_cert, ssl_key,
+                    parse_vapid_args(arguments))
     if arguments.log_format:
         observer = AP_Logger(arguments.log_name,
                              arguments.log_level,
@@ -623,7 +1031,7 @@ def run_scenario(args=None, run=True):
     else:
         observer = log.PythonLoggingObserver()
     log.startLoggingWithObserver(observer.emit, False)
-    logging.basicConfig(level=val_to_level(arguments.log_level))
+    logging.basicConfig(level=val_to_level(arguments.log_level.upper()))
     statsd_client.start()
     lh.logging = observer
     lh.metrics = statsd_client
@@ -647,6 +1055,15 @@ def parse_testplan_args(args):
         args_for_setting_config_path=["-c", "--config"],
     )
     parse_common_args(parser)
+    parser.add_argument("--workers",
+                        help="number of worker processes to spread the test "
+                             "plan across",
+                        type=int,
+                        env_var="WORKERS",
+                        default=1)
+    parser.add_argument("--worker_index",
+                        help=SUPPRESS,
+                        type=int)
     parser.add_argument("test_plan")
     return parser.parse_args(args)
 
@@ -659,12 +1076,31 @@ def run_testplan(args=None, run=True):
                       [--metric_namespace=METRIC_NAMESPACE]
                       [--statsd_host=STATSD_HOST]
                       [--statsd_port=STATSD_PORT]
+                      [--statsd_flush_interval=STATSD_FLUSH_INTERVAL]
+                      [--statsd_packet_size=STATSD_PACKET_SIZE]
                       [--datadog_api_key=DD_API_KEY]
                       [--datadog_app_key=DD_APP_KEY]
                       [--datadog_flush_interval=DD_FLUSH_INTERVAL]
+                      [--histogram_interval=HISTOGRAM_INTERVAL]
                       [--endpoint=URL]
                       [--endpoint_ssl_cert=SSL_CERT]
                       [--endpoint_ssl_key=SSL_KEY]
+                      [--vapid_processes=VAPID_PROCESSES]
+                      [--vapid_backend=VAPID_BACKEND]
+                      [--http_connections=HTTP_CONNECTIONS]
+                      [--http_idle_timeout=HTTP_IDLE_TIMEOUT]
+                      [--http_discard_bodies]
+                      [--http2]
+                      [--http2_connections=HTTP2_CONNECTIONS]
+                      [--http2_streams=HTTP2_STREAMS]
+                      [--payload_pool_size=PAYLOAD_POOL_SIZE]
+                      [--payload_sizes=PAYLOAD_SIZES]
+                      [--timer_resolution=TIMER_RESOLUTION]
+                      [--log_level=LOG_LEVEL]
+                      [--log_sample=LOG_SAMPLE]
+                      [--error_burst=ERROR_BURST]
+                      [--error_interval=ERROR_INTERVAL]
+                      [--workers=WORKERS]
 
     test_plan should be a string with the following format:
         "<scenario_function>, <quantity>, <stagger>, <delay>, *args | *repeat"
@@ -685,6 +1121,30 @@ def run_testplan(args=None, run=True):
         Any optional additional arguments to be supplied to the scenario. The
         argument will be coerced to an integer if possible.
 
+    arrival=<constant|jittered|poisson|burst>
+        How launches are spread out. constant (the default) spaces them
+        evenly, to the millisecond, jittered at a random point of each
+        evenly spaced slot, poisson at random intervals averaging <stagger>
+        per second, and burst launches <stagger> at once every second.
+        Every launch up to <quantity> is made. Launches are made
+        on schedule whether or not earlier ones finished, the lag behind
+        schedule is recorded as the launch.lag timing and added to the
+        first timer each launch of the scenario starts.
+
+    ramp=<linear|step|spike|FILE>
+        Vary the launch rate over time rather than holding it at <stagger>,
+        until <quantity> have launched:
+            linear: from ramp_from (default 0) up to <stagger> over
+                    ramp_time seconds (default 60)
+            step:   the same climb in ramp_steps (default 5) equal steps
+            spike:  <stagger>, jumping to spike_rate (default ten times
+                    <stagger>) for spike_time seconds (default 10) at
+                    spike_at seconds (default 60)
+            FILE:   a CSV file of "seconds,rate" rows, interpolated
+                    linearly. Repeat a time to step the rate.
+        The rate holds at its last value after the ramp ends. Workers
+        scale the ramp by their share of <stagger>.
+
     *repeat
         More tuples of the same format.
 
@@ -696,13 +1156,34 @@ def run_testplan(args=None, run=True):
     accept a path to cert files (like the command line equivalent) or
     optionally the contents of the PEM files themselves.
 
+    With --workers greater than 1, a worker process is spawned per worker
+    that runs its own share of every test plan tuple's quantity and stagger.
+    The worker metrics are merged and sent on by this process, and a SIGINT
+    or SIGTERM stopping it is passed on to the workers.
+
     """
+    if args is None:
+        args = sys.argv[1:]
     arguments = parse_testplan_args(args)
     testplans = parse_testplan(arguments.test_plan)
-    statsd_client = parse_statsd_args(arguments)
+    worker = arguments.worker_index is not None
+    if worker:
+        testplans = split_testplan(testplans, arguments.workers,
+                                   arguments.worker_index)
+        statsd_client = metrics.PipeMetrics(METRICS_FD)
+    else:
+        statsd_client = parse_statsd_args(arguments)
     endpoint, ssl_cert, ssl_key = parse_endpoint_args(arguments)
-    lh = LoadRunner(testplans, statsd_client, arguments.websocket_url,
-                    endpoint, ssl_cert, ssl_key)
+    parse_timer_args(arguments)
+    parse_log_args(arguments)
+    parse_http_args(arguments)
+    parse_payload_args(arguments)
+    if arguments.workers > 1 and not worker:
+        lh = WorkerSupervisor(args, arguments.workers, statsd_client)
+    else:
+        lh = LoadRunner(testplans, statsd_client, arguments.websocket_url,
+                        endpoint, ssl_cert, ssl_key,
+                        parse_vapid_args(arguments))
     observer = log.PythonLoggingObserver()
     log.startLoggingWithObserver(observer.emit, False)
     logging.basicConfig(level=logging.INFO)
@@ -711,6 +1192,8 @@ def run_testplan(args=None, run=True):
     lh.start()
 
     if run:
+        if isinstance(lh, WorkerSupervisor):
+            reactor.callWhenRunning(lh.forward_signals)
         loop = task.LoopingCall(check_loadrunner, lh)
         reactor.callLater(1, loop.start, 1)
         reactor.run()
@@ -7,6 +7,7 @@ from aplt.commands import (
     hello,
     register,
     send_notification,
+    send_notifications,
     expect_notification,
     expect_notifications,
     unregister,
@@ -215,7 +216,7 @@ def reconnect_forever(reconnect_delay=30, run_once=0):
     uaid = response["uaid"]
 
     while True:
-        length, data = random_data(min_length=2048, max_length=4096)
+        length, data = random_data()
         yield timer_start("update.latency")
         response, content = yield send_notification(endpoint, data,
                                                     headers={"TTL": "60"})
@@ -276,7 +277,7 @@ def notification_forever(notif_delay=30, run_once=0, vapid_claims=None):
     reg, endpoint = yield register(random_channel_id())
 
     while True:
-        length, data = random_data(min_length=2048, max_length=4096)
+        length, data = random_data()
         yield timer_start("update.latency")
         response, content = yield send_notification(endpoint, data,
                                                     headers={"TTL": "60"},
@@ -299,12 +300,14 @@ def notification_forever(notif_delay=30, run_once=0, vapid_claims=None):
 def notification_forever_stored(qty_stored=32, ttl=300, notif_delay=30,
                                 run_once=0, *args, **kwargs):
     """Connects, registers, disconnects and then repeats every delay interval:
-    1. send notifications x qty_stored (# of notifications to store)
+    1. send notifications x qty_stored (# of notifications to store), up to
+       the send_window keyword argument (default 8) at once
     2. connects
     3. receive notifications x qty_stored
 
     Repeats forever.
     """
+    send_window = kwargs.get("send_window", 8)
     yield connect()
     response = yield hello(None)
     reg, endpoint = yield register(random_channel_id())
@@ -313,16 +316,15 @@ def notification_forever_stored(qty_stored=32, ttl=300, notif_delay=30,
 
     while True:
         message_ids = []
-        length, data = random_data(min_length=2048, max_length=4096)
+        length, data = random_data()
 
-        for i in range(qty_stored):
-            response, content = yield send_notification(
-                endpoint,
-                data,
-                headers={"TTL": str(ttl)}
-            )
-            yield counter("notification.throughput.bytes", length)
-            yield counter("notification.sent", 1)
+        yield send_notifications(
+            [send_notification(endpoint, data, headers={"TTL": str(ttl)})
+             for _ in range(qty_stored)],
+            send_window
+        )
+        yield counter("notification.throughput.bytes", length * qty_stored)
+        yield counter("notification.sent", qty_stored)
 
         yield wait(5)
 
@@ -373,7 +375,7 @@ def notification_forever_direct_store(cycle_delay=10, run_once=0):
     ttl = 600
 
     while True:
-        length, data = random_data(min_length=2048, max_length=4096)
+        length, data = random_data()
         response, content = yield send_notification(
             endpoint,
             data,
@@ -415,7 +417,7 @@ def notification_forever_unsubscribed(notif_delay=30, run_once=0):
     unregister(reg["channelID"])
 
     while True:
-        length, data = random_data(min_length=2048, max_length=4096)
+        length, data = random_data()
         yield timer_start("update.latency")
         response, content = yield send_notification(endpoint, data,
                                                     headers={"TTL": "60"})
@@ -450,7 +452,7 @@ def notification_forever_bad_tokens(notif_delay=30, run_once=0,
 
     while True:
         endpoint = bad_push_endpoint(endpoint, token_length)
-        length, data = random_data(min_length=2048, max_length=4096)
+        length, data = random_data()
         response, content = yield send_notification(endpoint, data,
                                                     headers={"TTL": "60"})
         yield counter("notification.throughput.bytes", length)
@@ -473,7 +475,7 @@ def notification_forever_bad_endpoints(notif_delay=30, run_once=0):
 
     while True:
         endpoint = bad_push_endpoint()
-        length, data = random_data(min_length=2048, max_length=4096)
+        length, data = random_data()
         response, content = yield send_notification(endpoint, data,
                                                     headers={"TTL": "60"})
         yield counter("notification.throughput.bytes", length)
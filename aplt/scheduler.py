@@ -0,0 +1,260 @@
+"""Scenario launch scheduling
+
+The launches of a test plan tuple are laid out in time by an arrival
+schedule: a generator of the offsets, in seconds from the start of the
+tuple, at which each instance of the scenario is intended to start. A
+:class:`Launcher` then starts them at those times, whether or not earlier
+instances have finished, so a slow server can't quietly lower the offered
+load.
+
+Each launch is handed its intended start time, and how late it actually
+started is recorded as the ``launch.lag`` timing. The lag is also added to
+the first timer the launched scenario starts, so that time spent waiting
+to be launched shows up in the latencies instead of being omitted.
+
+Instead of a flat rate, a test plan tuple can follow a :class:`RateCurve`,
+either one of the :data:`RAMPS` shapes or one loaded from a CSV file of
+``seconds,rate`` rows with :func:`load_rate_file`.
+
+"""
+import csv
+import math
+import random
+
+from twisted.internet import reactor
+
+
+def burst_arrivals(quantity, rate):
+    """``rate`` launches at once at the start of every second, the last
+    second launching whatever is left of ``quantity``"""
+    for index in range(quantity):
+        yield index // rate
+
+
+def constant_arrivals(quantity, rate):
+    """Launches evenly spaced at ``rate`` per second"""
+    interval = 1.0 / rate
+    for index in range(quantity):
+        yield index * interval
+
+
+def jittered_arrivals(quantity, rate, rand=random):
+    """Launches averaging ``rate`` per second, each at a random point of its
+    own evenly spaced slot, so launches don't line up across test plan
+    tuples or workers"""
+    interval = 1.0 / rate
+    for index in range(quantity):
+        yield (index + rand.random()) * interval
+
+
+def poisson_arrivals(quantity, rate, rand=random):
+    """Launches at random intervals averaging ``rate`` per second, as
+    independent users arriving would"""
+    offset = 0.0
+    for _ in range(quantity):
+        yield offset
+        offset += rand.expovariate(rate)
+
+
+ARRIVALS = {
+    "burst": burst_arrivals,
+    "constant": constant_arrivals,
+    "jittered": jittered_arrivals,
+    "poisson": poisson_arrivals,
+}
+
+# Schedule used when a test plan tuple doesn't pick one
+DEFAULT_ARRIVAL = "constant"
+
+
+class RateCurve(object):
+    """A launch rate varying over time
+
+    The rate is linearly interpolated between ``(seconds, rate)`` points,
+    two points at the same time making a step. It holds at the first point's
+    rate before it and the last point's rate after it.
+
+    """
+    def __init__(self, points):
+        points = sorted(points, key=lambda point: point[0])
+        if not points:
+            raise ValueError("A rate curve needs at least one point")
+        if any(rate < 0 for _, rate in points):
+            raise ValueError("Rates can't be negative")
+        if points[0][0] > 0:
+            points.insert(0, (0, points[0][1]))
+        self.points = [(float(when), float(rate)) for when, rate in points]
+
+    def __eq__(self, other):
+        return isinstance(other, RateCurve) and self.points == other.points
+
+    def __ne__(self, other):
+        return not self == other
+
+    def scaled(self, factor):
+        """Return the curve with every rate multiplied by ``factor``"""
+        return RateCurve([(when, rate * factor)
+                          for when, rate in self.points])
+
+    def times(self, counts):
+        """Map ascending launch counts to the times the curve reaches them
+
+        Stops early if the rate ends at 0 before reaching a count.
+
+        """
+        segments = zip(self.points, self.points[1:])
+        segment = 0
+        total = 0.0
+        for count in counts:
+            while segment < len(segments):
+                (start, from_rate), (end, to_rate) = segments[segment]
+                area = (from_rate + to_rate) * (end - start) / 2
+                if count < total + area:
+                    break
+                total += area
+                segment += 1
+            else:
+                # Past the last point
+                start, rate = self.points[-1]
+                if not rate:
+                    return
+                yield start + (count - total) / rate
+                continue
+            remaining = count - total
+            slope = (to_rate - from_rate) / (end - start)
+            if not slope:
+                yield start + remaining / from_rate
+            else:
+                # Solve from_rate * x + slope * x ** 2 / 2 = remaining
+                yield start + (math.sqrt(from_rate ** 2 +
+                                         2 * slope * remaining) -
+                               from_rate) / slope
+
+
+def linear_ramp(rate, ramp_from=0, ramp_time=60):
+    """Ramp evenly from ``ramp_from`` to ``rate`` launches per second over
+    ``ramp_time`` seconds"""
+    return RateCurve([(0, ramp_from), (ramp_time, rate)])
+
+
+def step_ramp(rate, ramp_from=0, ramp_time=60, ramp_steps=5):
+    """Climb from ``ramp_from`` to ``rate`` launches per second in
+    ``ramp_steps`` equal steps over ``ramp_time`` seconds, holding each
+    rate for a while to find where latencies turn"""
+    points = []
+    length = float(ramp_time) / ramp_steps
+    for step in range(ramp_steps):
+        step_rate = ramp_from + (rate - ramp_from) * (step + 1.0) / ramp_steps
+        points.append((step * length, step_rate))
+        points.append(((step + 1) * length, step_rate))
+    return RateCurve(points)
+
+
+def spike_ramp(rate, spike_rate=None, spike_at=60, spike_time=10):
+    """Launch at ``rate`` per second, jumping to ``spike_rate`` (ten times
+    ``rate`` by default) for ``spike_time`` seconds at ``spike_at``"""
+    if spike_rate is None:
+        spike_rate = rate * 10
+    return RateCurve([(0, rate), (spike_at, rate), (spike_at, spike_rate),
+                      (spike_at + spike_time, spike_rate),
+                      (spike_at + spike_time, rate)])
+
+
+RAMPS = {
+    "linear": linear_ramp,
+    "step": step_ramp,
+    "spike": spike_ramp,
+}
+
+
+def load_rate_file(path):
+    """Load a :class:`RateCurve` from a CSV file of ``seconds,rate`` rows
+
+    Rows that aren't numbers, such as a header, are skipped.
+
+    """
+    points = []
+    with open(path, "rb") as f:
+        for row in csv.reader(f):
+            try:
+                points.append((float(row[0]), float(row[1])))
+            except (ValueError, IndexError):
+                continue
+    return RateCurve(points)
+
+
+def curve_arrivals(quantity, curve, arrival=DEFAULT_ARRIVAL,
+                   rand=random):
+    """Launches following a :class:`RateCurve`, spread out as the named
+    :data:`ARRIVALS` schedule would spread out a flat rate"""
+    if arrival in ("jittered", "poisson"):
+        counts = ARRIVALS[arrival](quantity, 1, rand)
+    else:
+        counts = range(quantity)
+    for offset in curve.times(counts):
+        yield math.floor(offset) if arrival == "burst" else offset
+
+
+class Launcher(object):
+    """Calls ``launch`` with the intended start time of every launch in an
+    arrival schedule
+
+    Only the next launch is ever scheduled with the reactor; every launch
+    that's due within ``resolution`` seconds of it firing is made together,
+    so closely spaced launches don't each need their own reactor call.
+
+    :param launch: Callable taking the intended start time.
+    :param offsets: Arrival schedule, offsets in seconds from ``start``.
+    :param start: Time the schedule starts at.
+    :param metrics: Optional :class:`aplt.metrics.IMetrics` to record the
+        ``launch.lag`` of every launch to.
+    :param resolution: Seconds that launches may be made early by.
+
+    """
+    def __init__(self, launch, offsets, start, metrics=None, clock=reactor,
+                 resolution=0.001):
+        self._launch = launch
+        self._offsets = iter(offsets)
+        self._start = start
+        self._metrics = metrics
+        self._clock = clock
+        self._resolution = resolution
+        self._next = next(self._offsets, None)
+        self._call = None
+        self.launched = 0
+
+    @property
+    def finished(self):
+        """Indicates whether every launch has been made"""
+        return self._next is None
+
+    def start(self):
+        """Schedule the first launch"""
+        self._schedule()
+
+    def stop(self):
+        """Cancel any remaining launches"""
+        if self._call and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self._next = None
+
+    def _schedule(self):
+        if self._next is None:
+            self._call = None
+            return
+        delay = self._start + self._next - self._clock.seconds()
+        self._call = self._clock.callLater(max(delay, 0), self._fire)
+
+    def _fire(self):
+        now = self._clock.seconds()
+        due = now + self._resolution
+        while self._next is not None and self._start + self._next <= due:
+            intended = self._start + self._next
+            self._next = next(self._offsets, None)
+            if self._metrics:
+                lag = max(self._clock.seconds() - intended, 0)
+                self._metrics.timing("launch.lag", int(lag * 1000))
+            self.launched += 1
+            self._launch(intended)
+        self._schedule()
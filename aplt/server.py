@@ -0,0 +1,316 @@
+"""Local autopush stand-in
+
+Speaks enough of the autopush WebSocket protocol (hello, register,
+unregister, ack and notification messages) and of the HTTP push endpoint for
+every scenario in :mod:`aplt.scenarios` to run against localhost, without a
+real autopush deployment. Nothing is persisted or verified: messages are kept
+in memory, and VAPID headers and payload encryption are ignored.
+
+Messages sent with a ``TTL`` are stored until they're acked (unless storage
+is turned off), so they're delivered again on reconnect, and a newer message
+with the same ``Topic`` replaces an undelivered one. Replies and deliveries
+can be held back by a fixed delay to simulate a slower server.
+
+"""
+import base64
+import json
+import logging
+import time
+import uuid
+
+from autobahn.twisted.websocket import (
+    WebSocketServerFactory,
+    WebSocketServerProtocol,
+)
+from configargparse import ArgumentParser
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.web import resource, server
+
+
+class PushServerProtocol(WebSocketServerProtocol):
+    """A single client's WebSocket connection"""
+    def __init__(self):
+        WebSocketServerProtocol.__init__(self)
+        self.uaid = None
+        self.connected = False
+
+    def onOpen(self):
+        self.connected = True
+
+    def onClose(self, wasClean, code, reason):
+        self.connected = False
+        self.factory.push_server.client_lost(self)
+
+    def onMessage(self, payload, isBinary):
+        try:
+            message = json.loads(payload)
+            handler = getattr(self, "handle_" + message["messageType"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            log.msg("Invalid message: {!r}".format(payload))
+            self.sendClose()
+            return
+        if message["messageType"] != "hello" and not self.uaid:
+            log.msg("Message before hello: {!r}".format(payload))
+            self.sendClose()
+            return
+        handler(message)
+
+    def send_message(self, message):
+        """Send a message if the connection is still open"""
+        if self.connected:
+            self.sendMessage(json.dumps(message).encode("utf8"), False)
+
+    def handle_hello(self, message):
+        self.factory.push_server.hello(self, message.get("uaid"))
+
+    def handle_register(self, message):
+        self.factory.push_server.register(self, message["channelID"])
+
+    def handle_unregister(self, message):
+        self.factory.push_server.unregister(self, message["channelID"])
+
+    def handle_ack(self, message):
+        for update in message.get("updates", []):
+            self.factory.push_server.ack(self, update["version"])
+
+
+class PushEndpoint(resource.Resource):
+    """The HTTP push endpoint, accepting ``POST /wpush/v1/<token>``"""
+    isLeaf = True
+
+    def __init__(self, push_server):
+        resource.Resource.__init__(self)
+        self.push_server = push_server
+
+    def render_POST(self, request):
+        path = request.postpath
+        if len(path) != 3 or path[:2] != ["wpush", "v1"]:
+            request.setResponseCode(404)
+            return ""
+        try:
+            ttl = int(request.getHeader("TTL") or 0)
+        except ValueError:
+            request.setResponseCode(400)
+            return ""
+        headers = {}
+        for name, key in (("Content-Encoding", "encoding"),
+                          ("Crypto-Key", "crypto_key"),
+                          ("Encryption", "encryption")):
+            if request.getHeader(name):
+                headers[key] = request.getHeader(name)
+        code = self.push_server.notify(path[2], request.content.read(),
+                                       headers, ttl,
+                                       request.getHeader("Topic"))
+        request.setResponseCode(code)
+        if not self.push_server.delay:
+            return ""
+
+        def finish():
+            request.finish()
+        call = reactor.callLater(self.push_server.delay, finish)
+        request.notifyFinish().addErrback(lambda failure: call.cancel())
+        return server.NOT_DONE_YET
+
+
+class PushServer(object):
+    """In-memory state of the stand-in server
+
+    :param store: Whether messages with a TTL are stored for clients that
+        aren't connected, and until they're acked.
+    :param delay: Seconds that every reply, notification delivery and
+        endpoint response is held back for.
+
+    """
+    def __init__(self, store=True, delay=0):
+        self.store = store
+        self.delay = delay
+        self.websocket_url = None
+        self.endpoint_url = None
+        self.clients = {}
+        self.channels = {}
+        self.tokens = {}
+        self.messages = {}
+        self._ports = []
+
+    def listen(self, port=0, endpoint_port=0, interface="127.0.0.1",
+               hostname="localhost"):
+        """Start listening for WebSocket connections and push endpoint
+        requests
+
+        Ports of 0 pick a free port; :attr:`websocket_url` and
+        :attr:`endpoint_url` are set to the URLs actually listened on.
+
+        """
+        endpoint = reactor.listenTCP(endpoint_port,
+                                     server.Site(PushEndpoint(self)),
+                                     interface=interface)
+        self.endpoint_url = "http://{}:{}".format(hostname,
+                                                  endpoint.getHost().port)
+        factory = WebSocketServerFactory()
+        factory.protocol = PushServerProtocol
+        factory.push_server = self
+        websocket = reactor.listenTCP(port, factory, interface=interface)
+        self.websocket_url = "ws://{}:{}/".format(hostname,
+                                                  websocket.getHost().port)
+        self._ports = [websocket, endpoint]
+
+    def stop(self):
+        """Stop listening, returns a deferred firing once done"""
+        ports, self._ports = self._ports, []
+        return defer.gatherResults([port.stopListening() for port in ports])
+
+    def _send(self, client, message):
+        if self.delay:
+            reactor.callLater(self.delay, client.send_message, message)
+        else:
+            client.send_message(message)
+
+    def hello(self, client, uaid):
+        if client.uaid:
+            client.sendClose()
+            return
+        if not uaid or uaid not in self.channels:
+            uaid = uuid.uuid4().hex
+            self.channels[uaid] = {}
+        previous = self.clients.get(uaid)
+        if previous:
+            previous.sendClose()
+        client.uaid = uaid
+        self.clients[uaid] = client
+        self._send(client, dict(messageType="hello", uaid=uaid, status=200,
+                                use_webpush=True))
+        now = time.time()
+        messages = [stored for stored in self.messages.get(uaid, [])
+                    if stored[0] > now]
+        self.messages[uaid] = messages
+        for expiry, topic, message in messages:
+            self._send(client, message)
+
+    def client_lost(self, client):
+        if client.uaid and self.clients.get(client.uaid) is client:
+            del self.clients[client.uaid]
+
+    def register(self, client, channel_id):
+        channels = self.channels[client.uaid]
+        token = channels.get(channel_id)
+        if not token:
+            token = channels[channel_id] = uuid.uuid4().hex
+            self.tokens[token] = (client.uaid, channel_id)
+        self._send(client, dict(
+            messageType="register", channelID=channel_id, status=200,
+            pushEndpoint="{}/wpush/v1/{}".format(self.endpoint_url, token)))
+
+    def unregister(self, client, channel_id):
+        self.channels[client.uaid].pop(channel_id, None)
+        self._send(client, dict(messageType="unregister",
+                                channelID=channel_id, status=200))
+
+    def ack(self, client, version):
+        messages = self.messages.get(client.uaid)
+        if messages:
+            self.messages[client.uaid] = [
+                stored for stored in messages
+                if stored[2]["version"] != version]
+
+    def notify(self, token, data, headers, ttl, topic=None):
+        """Deliver or store a notification sent to a push endpoint token
+
+        :returns: the HTTP status code to respond with.
+
+        """
+        if token not in self.tokens:
+            return 404
+        uaid, channel_id = self.tokens[token]
+        if channel_id not in self.channels[uaid]:
+            return 410
+        message = dict(messageType="notification", channelID=channel_id,
+                       version=uuid.uuid4().hex)
+        if data:
+            message["data"] = base64.urlsafe_b64encode(data).rstrip("=")
+            message["headers"] = headers
+        if self.store and ttl > 0:
+            messages = self.messages.setdefault(uaid, [])
+            if topic:
+                # Replaces any message on the channel with the same topic
+                messages[:] = [
+                    stored for stored in messages
+                    if stored[1] != topic or
+                    stored[2]["channelID"] != channel_id]
+            messages.append((time.time() + ttl, topic, message))
+        client = self.clients.get(uaid)
+        if client:
+            self._send(client, message)
+        return 201
+
+
+def parse_server_args(args):
+    parser = ArgumentParser(
+        description="Run a local autopush stand-in server",
+        default_config_files=["config.ini"],
+        args_for_setting_config_path=["-c", "--config"],
+    )
+    parser.add_argument("--port",
+                        help="port to listen for WebSocket connections on",
+                        type=int,
+                        env_var="SERVER_PORT",
+                        default=8080)
+    parser.add_argument("--endpoint_port",
+                        help="port to listen for push endpoint requests on",
+                        type=int,
+                        env_var="SERVER_ENDPOINT_PORT",
+                        default=8082)
+    parser.add_argument("--interface",
+                        help="interface to listen on",
+                        env_var="SERVER_INTERFACE",
+                        default="127.0.0.1")
+    parser.add_argument("--hostname",
+                        help="hostname to use in push endpoint URLs",
+                        env_var="SERVER_HOSTNAME",
+                        default="localhost")
+    parser.add_argument("--delay",
+                        help="seconds to hold back every reply and "
+                             "notification for",
+                        type=float,
+                        env_var="SERVER_DELAY",
+                        default=0)
+    parser.add_argument("--no_store",
+                        help="don't store messages for clients that aren't "
+                             "connected",
+                        action="store_true",
+                        env_var="SERVER_NO_STORE")
+    return parser.parse_args(args)
+
+
+def run_server(args=None, run=True):
+    """Run a local autopush stand-in server
+
+    Usage:
+        aplt_server [--port=PORT]
+                    [--endpoint_port=ENDPOINT_PORT]
+                    [--interface=INTERFACE]
+                    [--hostname=HOSTNAME]
+                    [--delay=DELAY]
+                    [--no_store]
+
+    Point aplt_scenario or aplt_testplan at it with
+    ``--websocket_url=ws://localhost:PORT/``.
+
+    """
+    arguments = parse_server_args(args)
+    push_server = PushServer(store=not arguments.no_store,
+                             delay=arguments.delay)
+    push_server.listen(arguments.port, arguments.endpoint_port,
+                       arguments.interface, arguments.hostname)
+    if not run:
+        return push_server
+    observer = log.PythonLoggingObserver()
+    log.startLoggingWithObserver(observer.emit, False)
+    logging.basicConfig(level=logging.INFO)
+    log.msg("Listening on {}, push endpoint {}".format(
+        push_server.websocket_url, push_server.endpoint_url))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    run_server()
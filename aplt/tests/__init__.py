@@ -1,8 +1,9 @@
 import json
+import os
 import time
 
 from mock import Mock, patch
-from nose.tools import eq_, raises
+from nose.tools import assert_raises, eq_, ok_, raises
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.trial import unittest
@@ -32,6 +33,31 @@ def _stack_gens():
     yield wait(0.1)
 
 
+def _count_once():
+    from aplt.commands import counter
+    yield counter("test.count", 1)
+
+
+def _connect_hello():
+    from aplt.commands import connect, hello
+    yield connect()
+    yield hello(None)
+
+
+def _send_once():
+    from aplt.commands import counter, send_notification
+    yield send_notification("http://localhost/push", None)
+    yield counter("test.sent", 1)
+
+
+def _expect_in_order(received):
+    from aplt.commands import expect_notification, expect_notifications
+    received.append((yield expect_notification("b", 5)))
+    received.append((yield expect_notifications(["a", "c"], 5)))
+    received.append((yield expect_notifications(["a", "b", "c", "d"], 5)))
+    received.append((yield expect_notification("d", 5)))
+
+
 class Aclass(object):
     @classmethod
     def amethod(cls):
@@ -39,6 +65,17 @@ class Aclass(object):
 
 
 class TestIntegration(unittest.TestCase):
+    def setUp(self):
+        # Run against a local stand-in server, unless a real one is given in
+        # the environment (e.g. AUTOPUSH_SERVER=wss://autopush.dev.mozaws.net/)
+        self.websocket_url = os.environ.get("AUTOPUSH_SERVER")
+        if not self.websocket_url:
+            from aplt.server import PushServer
+            push_server = PushServer()
+            push_server.listen()
+            self.addCleanup(push_server.stop)
+            self.websocket_url = push_server.websocket_url
+
     def _check_testplan_done(self, load_runner, d):
         if load_runner.finished:
             load_runner.metrics.stop()
@@ -47,11 +84,9 @@ class TestIntegration(unittest.TestCase):
             reactor.callLater(0.5, self._check_testplan_done, load_runner, d)
 
     def tearDown(self):
-        # Find the connection pool and shut it down
-        from treq._utils import get_global_pool
-        pool = get_global_pool()
-        if pool:
-            return pool.closeCachedConnections()
+        # Shut down the notification connection pools
+        from aplt.httpclient import close_pools
+        return close_pools()
 
     def test_basic_runner(self):
         """Test the "basic" scenario.
@@ -67,7 +102,7 @@ class TestIntegration(unittest.TestCase):
         h = runner.run_scenario([
             "--log_format=json",
             "--log_output=buffer",  # send the output to a string buffer
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:basic",
         ], run=False)
 
@@ -99,7 +134,7 @@ class TestIntegration(unittest.TestCase):
         h = runner.run_scenario([
             "--log_format=json",
             "--log_output=buffer",  # send the output to a string buffer
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:basic_topic",
         ], run=False)
 
@@ -121,7 +156,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         h = runner.run_scenario([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:basic",
             """vapid_claims={"sub": "mailto:admin@example.com"}""",
         ], run=False)
@@ -150,7 +185,7 @@ class TestIntegration(unittest.TestCase):
         jclaims = json.dumps(args).replace(",", "\\,")
         h = runner.run_scenario([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:basic",
             jclaims,
         ], run=False)
@@ -162,7 +197,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         lh = runner.run_testplan([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:basic, 5, 5, 0",
         ], run=False)
         d = Deferred()
@@ -172,7 +207,7 @@ class TestIntegration(unittest.TestCase):
     def test_spawn_testplan(self):
         import aplt.runner as runner
         h = runner.run_scenario([
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:_test_spawn",
         ], run=False)
         d = Deferred()
@@ -183,7 +218,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         h = runner.run_scenario([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:_test_multiple_spawn",
         ], run=False)
         d = Deferred()
@@ -194,7 +229,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         lh = runner.run_testplan([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:notification_forever, 5, 5, 0, 1, 1",
         ], run=False)
         d = Deferred()
@@ -205,7 +240,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         lh = runner.run_testplan([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.tests:_wait_multiple, 1, 1, 0",
         ], run=False)
         d = Deferred()
@@ -216,7 +251,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         lh = runner.run_testplan([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.tests:_stack_gens, 1, 1, 0",
         ], run=False)
         d = Deferred()
@@ -227,7 +262,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         lh = runner.run_testplan([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.tests:Aclass.amethod, 1, 1, 0",
         ], run=False)
         d = Deferred()
@@ -239,7 +274,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         runner.run_testplan([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:basic, 5, 5",
         ], run=False)
 
@@ -248,7 +283,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         runner.run_scenario([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenaribasic",
         ], run=False)
 
@@ -256,7 +291,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         h = runner.run_scenario([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:notification_forever",
             '0', '1',
         ], run=False)
@@ -269,7 +304,7 @@ class TestIntegration(unittest.TestCase):
 
         h = runner.run_scenario([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:reconnect_forever",
             '0', '1',  # args are broken into a list by parser.
         ], run=False)
@@ -281,7 +316,7 @@ class TestIntegration(unittest.TestCase):
         import aplt.runner as runner
         h = runner.run_scenario([
             "aplt.scenarios:_expect_notifications",
-            AUTOPUSH_SERVER,
+            self.websocket_url,
             "--log_output=none",
         ], run=False)
         d = Deferred()
@@ -297,7 +332,7 @@ class TestIntegration(unittest.TestCase):
         scenarios._RESTARTS = 0
         h = runner.run_scenario([
             "--log_output=none",
-            "--websocket_url={}".format(AUTOPUSH_SERVER),
+            "--websocket_url={}".format(self.websocket_url),
             "aplt.scenarios:_explode",
         ], run=False)
         f = Deferred()
@@ -340,6 +375,157 @@ class TestHarness(unittest.TestCase):
         h.remove_client(mock_client)
         eq_(mock_connect.called, True)
 
+    def test_send_notifications_window(self):
+        from twisted.internet.defer import Deferred
+        from aplt.commands import send_notification
+        from aplt.runner import RunnerHarness
+        from aplt.scenarios import basic
+        h = RunnerHarness(Mock(), AUTOPUSH_SERVER, Mock(), basic)
+        sent = []
+
+        def notify(url, *args):
+            d = Deferred()
+            sent.append((url, d))
+            return d
+        h._notify = notify
+        processor = Mock()
+        h.send_notifications(
+            processor, [send_notification(str(i)) for i in range(5)], 2)
+        eq_(len(sent), 2)
+        sent[1][1].callback(("response1", ""))
+        eq_(len(sent), 3)
+        while not all(d.called for _, d in sent):
+            waiting = [pair for pair in sent if not pair[1].called]
+            waiting[0][1].callback(("response" + waiting[0][0], ""))
+        eq_([url for url, _ in sent], ["0", "1", "2", "3", "4"])
+        processor._sending.return_value.assert_called_once_with(
+            [("response%d" % i, "") for i in range(5)])
+
+    @patch("aplt.runner.connectWS")
+    def test_shared_tls_context(self, mock_connect):
+        from aplt.runner import RunnerHarness
+        from aplt.scenarios import basic
+        from aplt.tls import ResumingClientContextFactory
+        stats = Mock()
+        h = RunnerHarness(Mock(), "wss://localhost:8443/", stats, basic)
+        ok_(isinstance(h._factory_context, ResumingClientContextFactory))
+        h._connect_waiters.extend([Mock(), Mock()])
+        h.remove_client(Mock())
+        h.remove_client(Mock())
+        contexts = [call[1]["contextFactory"]
+                    for call in mock_connect.call_args_list]
+        eq_(contexts, [h._factory_context] * 2)
+
+    def test_processor_reuse(self):
+        from aplt.runner import RunnerHarness
+        stats = Mock()
+        h = RunnerHarness(Mock(), AUTOPUSH_SERVER, stats, _count_once)
+        h.run()
+        eq_(h._processors, 0)
+        eq_(len(h._idle_processors), 1)
+        processor = list(h._idle_processors)[0]
+        ok_(not hasattr(processor, "__dict__"))
+        h.run()
+        eq_(h._idle_processors, set([processor]))
+        eq_(stats.increment.call_count, 2)
+
+    def test_unexpected_disconnect_idles_once(self):
+        from aplt.client import CommandProcessor
+        from aplt.runner import RunnerHarness
+        h = RunnerHarness(Mock(), AUTOPUSH_SERVER, Mock(), _connect_hello)
+        h.connect = Mock()
+        h.remove_processor = Mock(wraps=h.remove_processor)
+        processor = CommandProcessor(_connect_hello, (), {}, h)
+        processor.run()
+        processor.handle(dict(messageType="connect", client=Mock()))
+        eq_(processor._last_command, "hello")
+        processor.handle(dict(messageType="disconnect"))
+        self.flushLoggedErrors()
+        eq_(h.remove_processor.call_count, 1)
+        eq_(h._idle_processors, set([processor]))
+
+    def test_stale_send_result(self):
+        from aplt.client import CommandProcessor
+        from aplt.runner import RunnerHarness
+        stats = Mock()
+        h = RunnerHarness(Mock(), AUTOPUSH_SERVER, stats, _send_once)
+        sent = []
+
+        def notify(*args):
+            d = Deferred()
+            sent.append(d)
+            return d
+        h._notify = notify
+        processor = CommandProcessor(_send_once, (), {}, h)
+        processor.run()
+        eq_(len(sent), 1)
+        processor.shutdown(ended=True)
+        # A send still in flight keeps the processor out of reuse
+        ok_(not processor.reusable)
+        eq_(h._idle_processors, set())
+        processor.restart()
+        processor.run()
+        eq_(len(sent), 2)
+        sent[0].callback(("stale", ""))
+        eq_(stats.increment.call_count, 0)
+        sent[1].callback(("fresh", ""))
+        stats.increment.assert_called_once_with("test.sent", 1)
+
+
+class TestNotifications(unittest.TestCase):
+    def _notify(self, processor, channel_id, version):
+        processor.handle(dict(messageType="notification",
+                              channelID=channel_id, version=version))
+
+    @patch("aplt.client.get_wheel")
+    def test_channels(self, mock_wheel):
+        from aplt.client import CommandProcessor
+        received = []
+        processor = CommandProcessor(_expect_in_order, (received,), {},
+                                     Mock())
+        for channel_id, version in [("c", 1), ("a", 2), ("c", 3), ("b", 4)]:
+            self._notify(processor, channel_id, version)
+        processor.run()
+        # The earliest stored notification for any of the channels
+        eq_([n["version"] for n in received], [4, 1, 2])
+        eq_(sorted(processor._notifications), ["c"])
+        # Nothing stored for d, so it's delivered as it arrives
+        self._notify(processor, "d", 5)
+        eq_(received[-1]["version"], 5)
+        eq_(mock_wheel.return_value.call_later.return_value.cancel.called,
+            True)
+
+
+class TestDispatch(unittest.TestCase):
+    def test_long_synchronous_run(self):
+        from aplt.bench import NullHarness, _counters, _nested
+        from aplt.client import CommandProcessor
+
+        def scenario():
+            # Far more than the stack would take if run one inside another
+            yield _counters(5000)
+            yield _nested(5000)
+        harness = NullHarness()
+        processor = CommandProcessor(scenario, (), {}, harness)
+        processor.run()
+        return harness.done
+
+    def test_command_look_alike(self):
+        from collections import namedtuple
+        from aplt.client import CommandProcessor
+        counter = namedtuple("counter", "name count")
+        harness = Mock()
+        processor = CommandProcessor(_count_once, (), {}, harness)
+        processor._run_command(counter("look.alike", 1))
+        harness.counter.assert_any_call("look.alike", 1)
+
+    @raises(Exception)
+    def test_invalid_command(self):
+        from collections import namedtuple
+        from aplt.client import CommandProcessor
+        processor = CommandProcessor(_count_once, (), {}, Mock())
+        processor._run_command(namedtuple("bogus", "name")("x"))
+
 
 class TestRunnerFunctions(unittest.TestCase):
     @raises(Exception)
@@ -365,3 +551,44 @@ class TestRunnerFunctions(unittest.TestCase):
 
         result = verify_arguments(extras, 1, 2, 3, 4, 5)
         eq_(result, True)
+
+    @patch("aplt.metrics.datadog")
+    def test_statsd_histograms(self, mock_datadog):
+        from aplt.metrics import DatadogMetrics, HistogramMetrics
+        from aplt.runner import parse_statsd_args
+        args = Mock(statsd_host=None, datadog_api_key="key",
+                    histogram_interval=5)
+        client = parse_statsd_args(args)
+        ok_(isinstance(client, HistogramMetrics))
+        ok_(isinstance(client.client, DatadogMetrics))
+        args.histogram_interval = 0
+        ok_(isinstance(parse_statsd_args(args), DatadogMetrics))
+
+    def test_histograms_opt_in(self):
+        from aplt.runner import parse_scenario_args
+        args = parse_scenario_args(["aplt.scenarios:basic"])
+        eq_(args.histogram_interval, 0)
+
+    @patch("aplt.runner.reactor")
+    def test_http_closed_at_shutdown(self, mock_reactor):
+        from aplt.http2 import close_clients
+        from aplt.httpclient import close_pools
+        from aplt.runner import parse_http_args
+        args = Mock(http_connections=10, http_idle_timeout=240,
+                    http_discard_bodies=False, http2=False,
+                    http2_connections=2, http2_streams=100)
+        parse_http_args(args)
+        mock_reactor.addSystemEventTrigger.assert_any_call(
+            "before", "shutdown", close_pools)
+        mock_reactor.addSystemEventTrigger.assert_any_call(
+            "before", "shutdown", close_clients)
+
+    @patch("sys.stderr")
+    def test_log_level_names(self, mock_stderr):
+        from aplt.runner import parse_scenario_args
+        args = parse_scenario_args(["--log_level=INFO",
+                                    "aplt.scenarios:basic"])
+        eq_(args.log_level, "info")
+        with assert_raises(SystemExit):
+            parse_scenario_args(["--log_level=verbose",
+                                 "aplt.scenarios:basic"])
@@ -0,0 +1,105 @@
+import json
+from tempfile import NamedTemporaryFile
+
+from mock import patch
+from nose.tools import eq_, ok_
+from twisted.trial import unittest as trialtest
+
+import aplt.bench as bench
+from aplt.server import PushServer
+
+
+def test_measure():
+    calls = []
+    ok_(bench.measure(lambda: calls.append(1), 0.01) > 0)
+    ok_(calls)
+
+
+def test_rss():
+    ok_(bench.rss() > 0)
+
+
+def test_bench_vapid():
+    results = bench.bench_vapid(0.01)
+    eq_(sorted(results), ["cryptography", "ecdsa"])
+    ok_(all(rate > 0 for rate in results.values()))
+
+
+def test_bench_processor_rss():
+    result = bench.bench_processor_rss(100)
+    eq_(result["clients"], 100)
+    ok_("bytes_per_client" in result)
+
+
+def test_unknown_benchmark():
+    with patch("sys.stderr"):
+        try:
+            bench.run_bench(["nothing"])
+        except SystemExit:
+            pass
+        else:  # pragma: nocover
+            raise AssertionError("Unknown benchmark accepted")
+
+
+def test_start_server():
+    process, url = bench.start_server()
+    try:
+        ok_(url.startswith("ws://127.0.0.1:"))
+        eq_(process.poll(), None)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+class TestBenchmarks(trialtest.TestCase):
+    def setUp(self):
+        self.server = PushServer()
+        self.server.listen()
+        self.addCleanup(self.server.stop)
+
+    def tearDown(self):
+        from aplt.httpclient import close_pools
+        return close_pools()
+
+    def test_command(self):
+        d = bench.bench_command(0.05, 2)
+        d.addCallback(lambda result: ok_(result["commands_per_sec"] > 0))
+        return d
+
+    def test_dispatch(self):
+        d = bench.bench_dispatch(1000)
+        d.addCallback(lambda result: eq_(
+            list(result), ["counter_ns", "timer_ns", "nested_ns"]))
+        return d
+
+    def test_connect(self):
+        d = bench.bench_connect(self.server.websocket_url, 0.05, 2)
+        d.addCallback(lambda result: ok_(result["connections_per_sec"] > 0))
+        return d
+
+    def test_notification(self):
+        d = bench.bench_notification(self.server.websocket_url, 0.05, 2)
+        d.addCallback(
+            lambda result: ok_(result["notifications_per_sec"] > 0))
+        return d
+
+    def test_idle_rss(self):
+        d = bench.bench_idle_rss(self.server.websocket_url, 5)
+        d.addCallback(lambda result: eq_(result["connections"], 5))
+        return d
+
+    def test_run_bench(self):
+        output = NamedTemporaryFile()
+        self.addCleanup(output.close)
+        with patch.dict(bench.BENCHMARKS,
+                        vapid=lambda args: {"ecdsa": 1.0}):
+            d = bench.run_bench(["vapid", "command", "--duration=0.05",
+                                 "--concurrency=2", "--output",
+                                 output.name], run=False)
+
+        def check(report):
+            eq_(json.load(open(output.name)), report)
+            eq_(report["results"]["vapid"], {"ecdsa": 1.0})
+            ok_(report["results"]["command"]["commands_per_sec"] > 0)
+        d.addCallback(check)
+        return d
@@ -0,0 +1,50 @@
+import json
+import unittest
+
+from nose.tools import eq_, ok_
+
+import aplt.codec as codec
+from aplt.client import CommandProcessor
+from aplt.decorators import skip_notification_fields
+from aplt.scenarios import notification_forever
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        message = dict(messageType="hello", uaid=u"\u00e9t\u00e9",
+                       status=200)
+        data = codec.dumps(message)
+        ok_(isinstance(data, str))
+        eq_(codec.loads(data), message)
+        eq_(json.loads(data), message)
+
+    def test_skip(self):
+        data = json.dumps(dict(messageType="notification", channelID="abc",
+                               version="1", data="aGVsbG8",
+                               headers={"encoding": "aesgcm"}))
+        eq_(codec.loads(data, ("data", "headers")),
+            dict(messageType="notification", channelID="abc", version="1"))
+
+    def test_skip_nested(self):
+        message = dict(messageType="notification", channelID="abc",
+                       headers={"data": "keep"}, version='"data":"keep"',
+                       data="aGVsbG8")
+        eq_(codec.loads(json.dumps(message), ("data",)),
+            dict(messageType="notification", channelID="abc",
+                 headers={"data": "keep"}, version='"data":"keep"'))
+
+    def test_skip_notifications_only(self):
+        message = dict(messageType="register", data="keep",
+                       extra=dict(messageType="notification"))
+        eq_(codec.loads(json.dumps(message), ("data",)), message)
+
+    def test_skip_fields(self):
+        @skip_notification_fields("data")
+        def scenario():
+            yield None
+        eq_(scenario._skip_fields, ("data",))
+        processor = CommandProcessor(scenario, (), {}, None)
+        eq_(processor.skip_fields, ("data",))
+        # The stock scenarios decode notifications in full
+        processor = CommandProcessor(notification_forever, (), {}, None)
+        eq_(processor.skip_fields, ())
@@ -0,0 +1,61 @@
+import unittest
+
+from mock import Mock
+from nose.tools import eq_
+from twisted.internet import defer, reactor
+from twisted.trial import unittest as trialtest
+
+from aplt.coordinator import Coordinator, LoadAgent
+from aplt.metrics import AggregateMetrics, SinkMetrics, merge_timers
+
+
+class TestAggregateMetrics(unittest.TestCase):
+    def test_collect(self):
+        m = AggregateMetrics(Mock())
+        m.increment("test", 5)
+        m.increment("test")
+        m.timing("lifespan", 113)
+        m.timing("lifespan", 7)
+        m.client.timing.assert_called_with("lifespan", 7)
+        eq_(m.collect(), ({"test": 6}, {"lifespan": [2, 120, 7, 113]}))
+        eq_(m.collect(), ({}, {}))
+
+    def test_collect_only_counters(self):
+        m = AggregateMetrics(Mock(), forward_counters=False)
+        m.increment("test", 5)
+        m.timing("lifespan", 7)
+        eq_(m.client.increment.called, False)
+        m.client.timing.assert_called_with("lifespan", 7)
+        eq_(m.collect(), ({"test": 5}, {"lifespan": [1, 7, 7, 7]}))
+
+    def test_merge_timers(self):
+        timers = {"a": [2, 120, 7, 113]}
+        merge_timers(timers, {"a": [1, 200, 200, 200], "b": [1, 1, 1, 1]})
+        eq_(timers, {"a": [3, 320, 7, 200], "b": [1, 1, 1, 1]})
+
+
+class TestCoordinator(trialtest.TestCase):
+    def test_localhost_agents(self):
+        coordinator = Coordinator(
+            "aplt.tests:_count_once, 7, 7, 0, arrival=burst", 3, Mock(),
+            start_delay=0.2)
+        port = reactor.listenTCP(0, coordinator, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+
+        agents = []
+        for _ in range(3):
+            client = AggregateMetrics(SinkMetrics(), forward_counters=False)
+            agent = LoadAgent("ws://localhost:9999/", None, None, None,
+                              client, report_interval=0.1)
+            reactor.connectTCP("127.0.0.1", port.getHost().port, agent)
+            agents.append(agent)
+
+        def check(result):
+            counters, timers = result
+            eq_(counters, {"test.count": 7})
+            eq_(coordinator.metrics.increment.call_count, 3)
+            # Every agent got a share of the launches
+            eq_([len(a._load_runner._harnesses) for a in agents], [1, 1, 1])
+            return defer.gatherResults([a.done for a in agents])
+        coordinator.done.addCallback(check)
+        return coordinator.done
@@ -0,0 +1,136 @@
+from mock import Mock
+from nose.tools import eq_, ok_
+from twisted.internet import defer, reactor, ssl
+from twisted.trial import unittest as trialtest
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+import aplt.http2 as http2
+from aplt.utils import UnverifiedHTTPS
+
+try:
+    # Twisted's own HTTP/2 server, also needing priority
+    import twisted.web._http2  # noqa
+except ImportError:  # pragma: nocover
+    SKIP = "h2 and priority aren't installed"
+else:
+    SKIP = None
+
+
+class Echo(Resource):
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.pending = []
+
+    def render_POST(self, request):
+        request.setResponseCode(201)
+        request.setHeader("TTL", request.getHeader("ttl"))
+        if request.args.get("hold"):
+            self.pending.append(request)
+            return NOT_DONE_YET
+        return request.content.read()
+
+
+class NoALPNSite(Site):
+    def acceptableProtocols(self):
+        return []
+
+
+class TestH2Client(trialtest.TestCase):
+    skip = SKIP
+    site = Site
+
+    def setUp(self):
+        key = ssl.KeyPair.generate(size=2048)
+        cert = key.selfSignedCert(1, CN="localhost")
+        options = ssl.CertificateOptions(
+            privateKey=cert.privateKey.original,
+            certificate=cert.original)
+        self.resource = Echo()
+        self.port = reactor.listenSSL(0, self.site(self.resource), options,
+                                      interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+        self.url = "https://127.0.0.1:%d/push" % self.port.getHost().port
+        self.counter = Mock()
+        self.client = http2.H2Client(connections=2, streams=2,
+                                     policy=UnverifiedHTTPS(),
+                                     counter=self.counter)
+
+    def tearDown(self):
+        return self.client.close()
+
+    @defer.inlineCallbacks
+    def test_post(self):
+        response = yield self.client.post(self.url, "data" * 10000,
+                                          {"TTL": 60})
+        eq_(response.code, 201)
+        eq_(response.headers.getRawHeaders(b"ttl"), [b"60"])
+        content = yield response.content()
+        eq_(content, "data" * 10000)
+
+    @defer.inlineCallbacks
+    def test_multiplexed(self):
+        responses = yield defer.gatherResults([
+            self.client.post(self.url + "?hold=1", str(i), {"TTL": 0})
+            for i in range(4)] + [self._release(4)])
+        eq_(sorted(response.code for response in responses[:4]),
+            [201] * 4)
+        # Two connections, each running two requests at once
+        eq_(self.counter.call_count, 2)
+
+    @defer.inlineCallbacks
+    def _release(self, count):
+        while len(self.resource.pending) < count:
+            d = defer.Deferred()
+            reactor.callLater(0.01, d.callback, None)
+            yield d
+        for request in self.resource.pending:
+            request.write(b"ok")
+            request.finish()
+
+
+class TestH2NotNegotiated(TestH2Client):
+    site = NoALPNSite
+
+    def test_post(self):
+        d = self.client.post(self.url, "data", {"TTL": 60})
+        return self.assertFailure(d, http2.H2Error)
+
+    def test_multiplexed(self):
+        pass
+
+
+class TestOptions(trialtest.TestCase):
+    skip = SKIP
+
+    def tearDown(self):
+        http2.set_http2_options()
+
+    def test_new_client(self):
+        ok_(http2.new_client() is None)
+        http2.set_http2_options(True, connections=3, streams=10)
+        client = http2.new_client()
+        eq_((client._connections, client._streams), (3, 10))
+
+    def test_close_clients(self):
+        http2.set_http2_options(True)
+        client = http2.new_client()
+        client.close = Mock(return_value=defer.succeed(None))
+        d = http2.close_clients()
+        client.close.assert_called_once_with()
+        return d
+
+    def test_harness(self):
+        from aplt.runner import RunnerHarness
+        from aplt.scenarios import basic
+        http2.set_http2_options(True)
+        h = RunnerHarness(Mock(), "ws://localhost:8080/", Mock(), basic)
+        ok_(isinstance(h._h2_client, http2.H2Client))
+        h._h2_client.post = Mock()
+        h._post_notification({"Authorization": "vapid"}, "https://push/",
+                             "data", {"TTL": "60"})
+        h._h2_client.post.assert_called_with(
+            "https://push/", "data",
+            {"TTL": "60", "Authorization": "vapid"})
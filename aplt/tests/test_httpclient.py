@@ -0,0 +1,60 @@
+import treq
+from mock import Mock
+from nose.tools import eq_
+from twisted.internet import defer, reactor
+from twisted.trial import unittest as trialtest
+from twisted.web.client import Agent
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+import aplt.httpclient as httpclient
+
+
+class Hello(Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        return "hello"
+
+
+class TestConnectionPool(trialtest.TestCase):
+    def setUp(self):
+        self.port = reactor.listenTCP(0, Site(Hello()),
+                                      interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+        self.url = "http://127.0.0.1:%d/" % self.port.getHost().port
+
+    def tearDown(self):
+        httpclient.set_pool_options()
+        return httpclient.close_pools()
+
+    @defer.inlineCallbacks
+    def _post(self, pool, count):
+        agent = Agent(reactor, pool=pool)
+        bodies = []
+        for _ in range(count):
+            response = yield treq.post(self.url, data="x", agent=agent)
+            body = yield httpclient.read_body(response)
+            bodies.append(body)
+        defer.returnValue(bodies)
+
+    @defer.inlineCallbacks
+    def test_reuse(self):
+        counter = Mock()
+        pool = httpclient.new_pool(counter)
+        bodies = yield self._post(pool, 3)
+        eq_(bodies, ["hello"] * 3)
+        eq_((pool.created, pool.reused), (1, 2))
+        eq_([call[0][0] for call in counter.call_args_list],
+            ["http.connection.new"] + ["http.connection.reused"] * 2)
+
+    @defer.inlineCallbacks
+    def test_options(self):
+        httpclient.set_pool_options(max_per_host=3, idle_timeout=5,
+                                    discard_bodies=True)
+        pool = httpclient.new_pool()
+        eq_(pool.maxPersistentPerHost, 3)
+        eq_(pool.cachedConnectionTimeout, 5)
+        bodies = yield self._post(pool, 2)
+        eq_(bodies, ["", ""])
+        eq_(pool.reused, 1)
@@ -1,3 +1,5 @@
+import gzip
+import os
 import sys
 import unittest
 import io
@@ -10,9 +12,19 @@ from twisted.logger import (
 )
 from twisted.logger._stdlib import StringifiableFromEvent
 
+from mock import Mock, patch
+from twisted.internet import task
+
 from aplt.logobserver import (
+    DEBUG,
+    INFO,
     AP_Logger,
-    LogLevel
+    ErrorLimiter,
+    LogLevel,
+    LogWriter,
+    parse_sample_rates,
+    set_trace_level,
+    tracing,
 )
 
 
@@ -75,3 +87,187 @@ class TestLogger(unittest.TestCase):
         assert out['message'] == event['message']
         assert out['isError'] == event['isError']
         assert out['reason'] == repr(event['reason'])
+
+    def test_dump_buffer(self):
+        obj = AP_Logger("test", log_format="human", log_output="buffer",
+                        flush_interval=60)
+        obj.start()
+        self.addCleanup(obj.stop)
+        obj.emit(dict(log_level=LogLevel.info, log_time=time.time(),
+                      log_format=u"hello"))
+        lines = obj.dump()
+        assert lines[-1].endswith(u"INFO hello\n")
+        obj.emit(dict(log_level=LogLevel.info, log_time=time.time(),
+                      log_format=u"again"))
+        assert obj.dump()[-1].endswith(u"INFO again\n")
+        assert len(obj.dump()) == len(lines) + 1
+
+    def _log_lines(self, filename, count):
+        obj = AP_Logger("test", log_format="human", log_output=filename,
+                        batch_lines=7, flush_interval=60)
+        obj.start()
+        for i in range(count):
+            obj.emit(dict(log_level=LogLevel.info, log_time=time.time(),
+                          log_format=u"line {i}", i=i))
+        obj.stop()
+
+    def test_stop_writes_every_line(self):
+        filename = tempfile.mktemp()
+        self.addCleanup(os.remove, filename)
+        self._log_lines(filename, 100)
+        # Events logged elsewhere may be written too, once it's registered
+        with io.open(filename, encoding="utf-8") as f:
+            lines = [line for line in f if " line " in line]
+        assert len(lines) == 100
+        assert lines[-1].endswith("line 99\n")
+
+    def test_gzip_output(self):
+        filename = tempfile.mktemp(suffix=".gz")
+        self.addCleanup(os.remove, filename)
+        self._log_lines(filename, 10)
+        self._log_lines(filename, 10)
+        with gzip.open(filename) as f:
+            lines = [line for line in f if b" line " in line]
+        assert len(lines) == 20
+        assert lines[-1].endswith(b"line 9\n")
+
+
+class TestLogWriter(unittest.TestCase):
+
+    def test_batches(self):
+        output = io.StringIO()
+        writes = []
+        output.flush = lambda: writes.append(output.getvalue())
+        writer = LogWriter(output, max_lines=10, batch_lines=3,
+                           flush_interval=60)
+        for i in range(7):
+            writer.write(u"{}\n".format(i))
+        writer.start()
+        writer.stop()
+        assert output.getvalue() == u"".join(u"{}\n".format(i)
+                                             for i in range(7))
+        assert len(writes) == 3
+        assert not writer.is_alive()
+
+    def test_flush_interval(self):
+        output = io.StringIO()
+        writer = LogWriter(output, flush_interval=0.01)
+        writer.start()
+        writer.write(u"line\n")
+        for _ in range(500):
+            if output.getvalue():
+                break
+            time.sleep(0.01)
+        assert output.getvalue() == u"line\n"
+        writer.stop()
+
+
+class TestTracing(unittest.TestCase):
+
+    def tearDown(self):
+        set_trace_level()
+
+    def test_level(self):
+        assert tracing(INFO)
+        assert not tracing(DEBUG, "command")
+
+        set_trace_level("debug")
+        assert tracing(DEBUG, "command")
+
+        set_trace_level("error")
+        assert not tracing(INFO)
+
+        set_trace_level("DEBUG")
+        assert tracing(DEBUG, "command")
+
+    @patch("aplt.logobserver.random.random")
+    def test_sampling(self, mock_random):
+        set_trace_level("debug", dict(command=0.25))
+        mock_random.return_value = 0.2
+        assert tracing(DEBUG, "command")
+        mock_random.return_value = 0.3
+        assert not tracing(DEBUG, "command")
+        # Other event types aren't sampled
+        assert tracing(DEBUG, "message")
+
+    def test_parse_sample_rates(self):
+        assert parse_sample_rates(None) == {}
+        assert parse_sample_rates("command=0.01, message=1") == dict(
+            command=0.01, message=1.0)
+        for value in ["command", "command=2", "=0.5"]:
+            with self.assertRaises(ValueError):
+                parse_sample_rates(value)
+
+
+class TestErrorLimiter(unittest.TestCase):
+
+    def _raise(self, limiter, counter=None, exc_type=ValueError):
+        try:
+            raise exc_type("oops")
+        except Exception:
+            limiter.err(counter)
+
+    @patch("aplt.logobserver.log")
+    def test_burst(self, mock_log):
+        clock = task.Clock()
+        counter = Mock()
+        limiter = ErrorLimiter(burst=2, interval=10, clock=clock)
+        for _ in range(5):
+            self._raise(limiter, counter)
+        self._raise(limiter, counter, KeyError)
+        assert mock_log.err.call_count == 3
+        assert counter.call_count == 6
+        counter.assert_called_with("error.KeyError")
+
+        clock.advance(10)
+        assert mock_log.msg.call_count == 1
+        summary = mock_log.msg.call_args[0][0]
+        assert summary.startswith("3 occurrences of ValueError at ")
+        assert "in the last 10s" in summary
+
+        # The bucket refills over the interval
+        self._raise(limiter)
+        self._raise(limiter)
+        assert mock_log.err.call_count == 5
+
+    @patch("aplt.logobserver.log")
+    def test_quiet(self, mock_log):
+        clock = task.Clock()
+        limiter = ErrorLimiter(burst=1, interval=10, clock=clock)
+        self._raise(limiter)
+        self._raise(limiter)
+        clock.advance(10)
+        clock.advance(10)
+        # Nothing suppressed for a whole interval, so it stops summarizing
+        assert not limiter._buckets
+        assert not clock.getDelayedCalls()
+        assert mock_log.msg.call_count == 1
+
+    @patch("aplt.logobserver.log")
+    def test_stop(self, mock_log):
+        clock = task.Clock()
+        limiter = ErrorLimiter(burst=1, interval=10, clock=clock)
+        self._raise(limiter)
+        self._raise(limiter)
+        limiter.stop()
+        assert mock_log.msg.call_count == 1
+        assert not clock.getDelayedCalls()
+
+    @patch("aplt.runner.reactor")
+    @patch("aplt.logobserver.log")
+    def test_stopped_at_shutdown(self, mock_log, mock_reactor):
+        import aplt.logobserver as logobserver
+        from aplt.runner import parse_log_args
+        original = logobserver._error_limiter
+        self.addCleanup(setattr, logobserver, "_error_limiter", original)
+        args = Mock(log_level="info", log_sample=None, error_burst=1,
+                    error_interval=10)
+        parse_log_args(args)
+        mock_reactor.addSystemEventTrigger.assert_called_once_with(
+            "before", "shutdown", logobserver.stop_error_limits)
+        limiter = logobserver._error_limiter
+        self._raise(limiter)
+        self._raise(limiter)
+        logobserver.stop_error_limits()
+        assert mock_log.msg.call_count == 1
+        assert not limiter._loop.running
@@ -10,8 +10,11 @@ from datadog.util.hostname import get_hostname
 from aplt.metrics import (
     IMetrics,
     DatadogMetrics,
+    Histogram,
+    HistogramMetrics,
     TwistedMetrics,
     SinkMetrics,
+    pack_lines,
 )
 
 
@@ -21,6 +24,7 @@ class IMetricsTestCase(unittest.TestCase):
         im.start()
         self.assertRaises(NotImplementedError, im.increment, "test")
         self.assertRaises(NotImplementedError, im.timing, "test", 10)
+        self.assertRaises(NotImplementedError, im.gauge, "test", 10)
 
 
 class SinkMetricsTestCase(unittest.TestCase):
@@ -29,20 +33,51 @@ class SinkMetricsTestCase(unittest.TestCase):
         sm.start()
         eq_(None, sm.increment("test"))
         eq_(None, sm.timing("test", 10))
+        eq_(None, sm.gauge("test", 10))
 
 
 class TwistedMetricsTestCase(unittest.TestCase):
+    @patch("aplt.metrics.task")
+    @patch("aplt.metrics.TwistedStatsDClient")
     @patch("aplt.metrics.reactor")
-    def test_basic(self, mock_reactor):
+    def test_basic(self, mock_reactor, mock_client, mock_task):
         twisted.internet.base.DelayedCall.debug = True
-        m = TwistedMetrics()
+        m = TwistedMetrics(namespace="push", flush_interval=5)
         m.start()
         ok_(len(mock_reactor.mock_calls) > 0)
-        m._metric = Mock()
+        mock_task.LoopingCall.return_value.start.assert_called_with(
+            5, now=False)
+        m.client = Mock()
         m.increment("test", 5)
-        m._metric.increment.assert_called_with("test", 5)
-        m.timing("lifespan", 113)
-        m._metric.timing.assert_called_with("lifespan", 113)
+        m.increment("test")
+        m.timing("lifespan", 0.5)
+        m.gauge("connections", 7)
+        m.gauge("connections", 8)
+        eq_(m.client.write.called, False)
+        m.flush()
+        m.client.write.assert_called_once_with(
+            "push.test:6|c\npush.lifespan:500.0|ms\npush.connections:8|g")
+
+        # Nothing is sent again until there's something new
+        m.client.reset_mock()
+        m.stop()
+        eq_(m.client.write.called, False)
+
+    @patch("aplt.metrics.TwistedStatsDClient")
+    def test_packing(self, mock_client):
+        m = TwistedMetrics(namespace="", max_packet_size=31)
+        m.client = Mock()
+        for _ in range(5):
+            m.timing("latency", 1)
+        m.flush()
+        eq_([c[0][0] for c in m.client.write.call_args_list],
+            ["latency:1000|ms\nlatency:1000|ms"] * 2 + ["latency:1000|ms"])
+
+
+def test_pack_lines():
+    eq_(pack_lines([], 10), [])
+    eq_(pack_lines(["aaaa", "bbbb", "cc"], 9), ["aaaa\nbbbb", "cc"])
+    eq_(pack_lines(["aaaaaaaaaaaa", "b"], 9), ["aaaaaaaaaaaa", "b"])
 
 
 class DatadogMetricsTestCase(unittest.TestCase):
@@ -62,3 +97,76 @@ class DatadogMetricsTestCase(unittest.TestCase):
         m.timing("lifespan", 113)
         m._client.timing.assert_called_with("testpush.lifespan", value=113,
                                             host=hostname)
+        m.gauge("connections", 7)
+        m._client.gauge.assert_called_with("testpush.connections", value=7,
+                                           host=hostname)
+        m.stop()
+        ok_(m._client.flush.called)
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_exact_small_values(self):
+        h = Histogram()
+        for value in range(1, 101):
+            h.record(value)
+        eq_(h.count, 100)
+        eq_(h.max, 100)
+        eq_(h.percentiles(50, 90, 99, 99.9, 100), [50, 90, 99, 100, 100])
+
+    def test_precision(self):
+        h = Histogram(significant_figures=2)
+        for value in range(0, 1000000, 7):
+            h.record(value)
+        for percentile, value in zip((50, 99), h.percentiles(50, 99)):
+            expected = 1000000 * percentile / 100.0
+            ok_(abs(value - expected) / expected < 0.01)
+        eq_(h.percentiles(100), [h.max])
+
+    def test_negative_and_float(self):
+        h = Histogram()
+        h.record(-5)
+        h.record(2.7)
+        eq_(h.percentiles(50, 100), [0, 2])
+
+    def test_empty(self):
+        eq_(Histogram().percentiles(50), [0])
+
+
+class HistogramMetricsTestCase(unittest.TestCase):
+    @patch("aplt.metrics.task")
+    def test_flush(self, mock_task):
+        client = Mock(spec=IMetrics)
+        m = HistogramMetrics(client, flush_interval=5)
+        m.start()
+        client.start.assert_called_with()
+        mock_task.LoopingCall.return_value.start.assert_called_with(
+            5, now=False)
+        m.increment("sent", 2)
+        client.increment.assert_called_with("sent", 2)
+        m.gauge("connections", 3)
+        client.gauge.assert_called_with("connections", 3)
+        for duration in range(1, 11):
+            m.timing("latency", duration)
+        eq_(client.timing.called, False)
+
+        client.reset_mock()
+        m.flush()
+        eq_(sorted(c[0] for c in client.gauge.call_args_list),
+            [("latency.max", 10), ("latency.p50", 5), ("latency.p90", 9),
+             ("latency.p99", 10), ("latency.p999", 10)])
+        client.increment.assert_called_with("latency.count", 10)
+
+        # Histograms are reset every flush
+        client.reset_mock()
+        m.stop()
+        eq_(client.gauge.called, False)
+        client.stop.assert_called_with()
+
+    def test_scaled_like_timings(self):
+        client = Mock(spec=IMetrics)
+        client.timing_scale = 1000
+        m = HistogramMetrics(client)
+        m.timing("latency", 250)
+        m.flush()
+        client.gauge.assert_any_call("latency.p50", 250000)
+        client.gauge.assert_any_call("latency.max", 250000)
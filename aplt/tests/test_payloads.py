@@ -0,0 +1,84 @@
+import string
+import unittest
+
+from mock import Mock
+from nose.tools import eq_, ok_, assert_raises
+
+import aplt.payloads as payloads
+from aplt.commands import random_channel_id, random_data
+from aplt.payloads import RandomPool, parse_sizes, random_payload
+from aplt.utils import string_generator
+
+
+class TestRandomPool(unittest.TestCase):
+    def test_slices(self):
+        urandom = Mock(return_value="0123456789")
+        pool = RandomPool(10, urandom)
+        urandom.assert_called_once_with(10)
+        view = pool.slice(4)
+        ok_(isinstance(view, memoryview))
+        eq_(len(view), 4)
+        ok_(view.tobytes() in "0123456789")
+        eq_(pool.slice(10).tobytes(), "0123456789")
+        eq_(len(pool.slice(0)), 0)
+        assert_raises(ValueError, pool.slice, 11)
+        eq_(urandom.call_count, 1)
+
+    def test_string(self):
+        characters = string.ascii_lowercase + string.digits
+        generated = RandomPool(1024).string(500)
+        eq_(len(generated), 500)
+        ok_(all(c in characters for c in generated))
+        # Longer than the pool takes more than one slice
+        eq_(len(RandomPool(16).string(100)), 100)
+
+    def test_string_even(self):
+        every_byte = "".join(chr(i) for i in range(256))
+        mapped = every_byte.translate(payloads._CHARACTER_TABLE,
+                                      payloads._REJECTED)
+        counts = set(mapped.count(c)
+                     for c in string.ascii_lowercase + string.digits)
+        eq_(counts, set([7]))
+
+
+class TestSizes(unittest.TestCase):
+    def test_parse(self):
+        sizes = parse_sizes("10-20:3, 100")
+        eq_(sizes.max_length, 100)
+        drawn = [sizes.draw() for _ in range(400)]
+        ok_(all(10 <= size < 20 or size == 100 for size in drawn))
+        fixed = drawn.count(100)
+        # a weight of 1 in 4
+        ok_(50 < fixed < 150, fixed)
+
+    def test_invalid(self):
+        for sizes in ["", "x", "20-10", "10:0", "-5"]:
+            assert_raises(ValueError, parse_sizes, sizes)
+
+
+class TestPayloads(unittest.TestCase):
+    def tearDown(self):
+        payloads.set_payload_options()
+
+    def test_random_data(self):
+        payloads.set_payload_options(64, "8,16-32")
+        for _ in range(20):
+            length, data = random_data()
+            ok_(isinstance(data, str))
+            eq_(len(data), length)
+            ok_(length == 8 or 16 <= length < 32)
+        eq_(random_data(40, 40)[0], 40)
+        assert_raises(ValueError, random_data, 65, 65)
+        payload = random_payload(20, 20)
+        ok_(isinstance(payload, memoryview))
+        eq_(len(payload), 20)
+
+    def test_pool_too_small(self):
+        assert_raises(ValueError, payloads.set_payload_options, 64, "100")
+
+    def test_generators(self):
+        eq_(len(string_generator(12)), 12)
+        channel_id = random_channel_id()
+        eq_(len(channel_id), 36)
+        eq_(channel_id[14], "4")
+        ok_(channel_id != random_channel_id())
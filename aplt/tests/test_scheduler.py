@@ -0,0 +1,231 @@
+import os
+import random
+import tempfile
+import unittest
+
+from mock import Mock, patch
+from nose.tools import eq_, ok_, raises
+from twisted.internet import task
+
+import aplt.runner as runner
+from aplt.client import CommandProcessor
+from aplt.commands import counter, timer_end, timer_start, wait
+from aplt.scheduler import (
+    Launcher,
+    RateCurve,
+    burst_arrivals,
+    constant_arrivals,
+    curve_arrivals,
+    jittered_arrivals,
+    linear_ramp,
+    load_rate_file,
+    poisson_arrivals,
+    spike_ramp,
+    step_ramp,
+)
+
+
+def _timed(backdated):
+    yield timer_start("backdated")
+    yield wait(1)
+    yield timer_start("not_backdated")
+    yield timer_end("not_backdated")
+    yield timer_end("backdated")
+    yield counter("done", 1)
+
+
+class TestArrivals(unittest.TestCase):
+    def test_burst(self):
+        eq_(list(burst_arrivals(7, 3)), [0, 0, 0, 1, 1, 1, 2])
+
+    def test_jittered(self):
+        offsets = list(jittered_arrivals(1000, 10, random.Random(1)))
+        eq_(offsets, sorted(offsets))
+        for index, offset in enumerate(offsets):
+            ok_(index / 10.0 <= offset < (index + 1) / 10.0)
+
+    def test_constant(self):
+        eq_(list(constant_arrivals(5, 4)), [0, 0.25, 0.5, 0.75, 1.0])
+
+    def test_poisson(self):
+        offsets = list(poisson_arrivals(10000, 100, random.Random(1)))
+        eq_(len(offsets), 10000)
+        eq_(offsets, sorted(offsets))
+        # Averages close to the rate
+        ok_(95 < 10000 / offsets[-1] < 105)
+
+
+class TestRateCurve(unittest.TestCase):
+    def test_flat(self):
+        curve = RateCurve([(0, 4)])
+        eq_(list(curve.times(range(5))), [0, 0.25, 0.5, 0.75, 1.0])
+
+    def test_linear(self):
+        # 0 to 10/sec over 10 secs launches 50, the nth at sqrt(2n)
+        curve = linear_ramp(10, ramp_time=10)
+        eq_(list(curve.times([0, 2, 8, 50, 60])), [0, 2, 4, 10, 11])
+
+    def test_ends(self):
+        curve = RateCurve([(0, 2), (1, 2), (1, 0)])
+        eq_(list(curve.times(range(5))), [0, 0.5])
+
+    def test_late_start(self):
+        curve = RateCurve([(10, 0), (10, 1)])
+        eq_(list(curve.times(range(2))), [10, 11])
+
+    def test_scaled(self):
+        eq_(linear_ramp(10, 2).scaled(0.5), RateCurve([(0, 1), (60, 5)]))
+        ok_(linear_ramp(10) != linear_ramp(20))
+
+    @raises(ValueError)
+    def test_negative(self):
+        RateCurve([(0, -1)])
+
+    def test_step(self):
+        eq_(step_ramp(10, 0, 4, 2).points,
+            [(0, 5), (2, 5), (2, 10), (4, 10)])
+
+    def test_spike(self):
+        curve = spike_ramp(1, spike_at=2, spike_time=1)
+        spike = [2 + n / 10.0 for n in range(10)]
+        eq_(list(curve.times(range(15))), [0, 1] + spike + [3, 4, 5])
+
+    def test_rate_file(self):
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        os.write(fd, "seconds,rate\n0,1\n10,5\n10,2\n")
+        os.close(fd)
+        try:
+            eq_(load_rate_file(path).points,
+                [(0, 1), (10, 5), (10, 2)])
+        finally:
+            os.remove(path)
+
+    def test_curve_arrivals(self):
+        curve = linear_ramp(4, ramp_from=4, ramp_time=1)
+        eq_(list(curve_arrivals(6, curve, "burst")), [0, 0, 0, 0, 1, 1])
+        eq_(list(curve_arrivals(3, curve)), [0, 0.25, 0.5])
+        for arrival in ("jittered", "poisson"):
+            offsets = list(curve_arrivals(100, curve, arrival,
+                                          random.Random(1)))
+            eq_(len(offsets), 100)
+            eq_(offsets, sorted(offsets))
+
+
+class TestLauncher(unittest.TestCase):
+    def test_launches(self):
+        clock = task.Clock()
+        clock.advance(100)
+        launched = []
+        metrics = Mock()
+        launcher = Launcher(launched.append, [0, 0, 0.5, 2], 101, metrics,
+                            clock=clock)
+        launcher.start()
+        clock.advance(0.99)
+        eq_(launched, [])
+        clock.advance(0.01)
+        eq_(launched, [101, 101])
+        # A late tick makes every launch that's due, recording the lag
+        clock.advance(1.0)
+        eq_(launched, [101, 101, 101.5])
+        metrics.timing.assert_called_with("launch.lag", 500)
+        ok_(not launcher.finished)
+        clock.advance(1.0)
+        eq_(launched, [101, 101, 101.5, 103])
+        ok_(launcher.finished)
+        eq_(launcher.launched, 4)
+        eq_(clock.getDelayedCalls(), [])
+
+    def test_resolution(self):
+        clock = task.Clock()
+        launched = []
+        launcher = Launcher(launched.append, [0.0001 * n for n in range(20)],
+                            0, clock=clock)
+        launcher.start()
+        clock.advance(0)
+        # Launches within a millisecond are made in the same call
+        eq_(len(launched), 11)
+        eq_(len(clock.getDelayedCalls()), 1)
+        clock.advance(0.0011)
+        eq_(len(launched), 20)
+
+    def test_stop(self):
+        clock = task.Clock()
+        launched = []
+        launcher = Launcher(launched.append, [1, 2], 0, clock=clock)
+        launcher.start()
+        launcher.stop()
+        ok_(launcher.finished)
+        clock.advance(5)
+        eq_(launched, [])
+
+
+class TestTestplanOptions(unittest.TestCase):
+    def test_arrival(self):
+        plan = runner.parse_testplan(
+            "aplt.scenarios:basic, 10, 5, 0, arrival=poisson, a=1")
+        eq_(plan[0][4], ([], {"a": 1}))
+        eq_(plan[0][5], {"arrival": "poisson"})
+        eq_(runner.parse_testplan("aplt.scenarios:basic, 10, 5, 0")[0][5],
+            {})
+
+    @raises(Exception)
+    def test_bad_arrival(self):
+        runner.parse_testplan("aplt.scenarios:basic, 10, 5, 0, arrival=x")
+
+    def test_ramp(self):
+        plan = runner.parse_testplan(
+            "aplt.scenarios:basic, 100, 10, 0, ramp=step, ramp_steps=2, "
+            "ramp_time=4")
+        eq_(plan[0][5], {"ramp": step_ramp(10, 0, 4, 2)})
+        eq_(plan[0][4], ([], {}))
+
+    @raises(Exception)
+    def test_ramp_bad_option(self):
+        runner.parse_testplan(
+            "aplt.scenarios:basic, 100, 10, 0, ramp=linear, spike_at=4")
+
+    @raises(Exception)
+    def test_ramp_option_without_ramp(self):
+        runner.parse_testplan("aplt.scenarios:basic, 100, 10, 0, ramp_time=4")
+
+    @raises(Exception)
+    def test_missing_rate_file(self):
+        runner.parse_testplan(
+            "aplt.scenarios:basic, 100, 10, 0, ramp=/nonexistent.csv")
+
+    def test_split_ramp(self):
+        plans = runner.parse_testplan(
+            "aplt.scenarios:basic, 100, 10, 0, ramp=linear")
+        split = runner.split_testplan(plans, 2, 1)
+        eq_(split[0][1:3], (50, 5))
+        eq_(split[0][5]["ramp"], linear_ramp(5))
+        eq_(plans[0][5]["ramp"], linear_ramp(10))
+
+    @patch("aplt.runner.reactor")
+    def test_load_runner_arrival(self, mock_reactor):
+        mock_reactor.seconds.return_value = 0
+        lr = runner.LoadRunner(
+            [(_timed, 4, 2, 1, ((True,), {}), {"arrival": "constant"})],
+            Mock(), "ws://localhost/", None, None, None)
+        lr._run_testplan(lr._testplans[0])
+        launcher = lr._launchers[0]
+        eq_(launcher._start, 1)
+        eq_(list(launcher._offsets), [0.5, 1.0, 1.5])
+        ok_(not lr.finished)
+        launcher.stop()
+        ok_(launcher.finished)
+
+
+class TestBackdating(unittest.TestCase):
+    @patch("aplt.client.get_wheel")
+    @patch("aplt.client.reactor")
+    @patch("aplt.client.time")
+    def test_timers(self, mock_time, mock_reactor, mock_wheel):
+        mock_time.time.return_value = 110
+        harness = Mock()
+        processor = CommandProcessor(_timed, (True,), {}, harness, 100)
+        processor.run()
+        mock_time.time.return_value = 112
+        processor.timeoutConnection()
+        eq_(harness.timer.call_args_list[0][0], ("not_backdated", 0))
+        eq_(harness.timer.call_args_list[1][0], ("backdated", 12000))
@@ -0,0 +1,212 @@
+import time
+import unittest
+
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.trial import unittest as trialtest
+
+import aplt.runner as runner
+import aplt.scenarios as scenarios
+from aplt.commands import (
+    ack,
+    connect,
+    counter,
+    disconnect,
+    expect_notification,
+    hello,
+    random_channel_id,
+    register,
+    send_notification,
+    send_notifications,
+)
+from aplt.metrics import SinkMetrics
+from aplt.server import PushServer
+
+
+def _send_batch(count, window):
+    yield connect()
+    yield hello(None)
+    reg, endpoint = yield register(random_channel_id())
+    results = yield send_notifications(
+        [send_notification(endpoint, "data%d" % i, headers={"TTL": "60"})
+         for i in range(count)], window)
+    yield counter("batch.created",
+                  len([r for r, _ in results if r and r.code == 201]))
+    for _ in range(count):
+        notif = yield expect_notification(reg["channelID"], 5)
+        yield ack(channel_id=notif["channelID"], version=notif["version"])
+    yield disconnect()
+
+
+class TestPushServer(unittest.TestCase):
+    def setUp(self):
+        self.server = PushServer()
+        self.server.endpoint_url = "http://localhost:8082"
+        self.client = Mock(uaid=None)
+        self.server.hello(self.client, None)
+        self.uaid = self.client.uaid
+        self.server.register(self.client, "chan")
+        reply = self.client.send_message.call_args[0][0]
+        self.token = reply["pushEndpoint"].split("/")[-1]
+        self.client.reset_mock()
+
+    def _reconnect(self):
+        self.server.client_lost(self.client)
+        self.client = Mock(uaid=None)
+        self.server.hello(self.client, self.uaid)
+        return [call[0][0] for call in
+                self.client.send_message.call_args_list[1:]]
+
+    def test_deliver(self):
+        eq_(self.server.notify(self.token, "\xff\xfe", {}, 0), 201)
+        message = self.client.send_message.call_args[0][0]
+        eq_(message["channelID"], "chan")
+        eq_(message["data"], "__4")
+        ok_(message["version"])
+
+    def test_unknown_endpoint(self):
+        eq_(self.server.notify("nope", "", {}, 0), 404)
+        self.server.unregister(self.client, "chan")
+        eq_(self.server.notify(self.token, "", {}, 0), 410)
+
+    def test_store_until_ack(self):
+        self.server.client_lost(self.client)
+        self.server.notify(self.token, "", {}, 0)
+        self.server.notify(self.token, "a", {}, 60)
+        messages = self._reconnect()
+        eq_([m.get("data") for m in messages], ["YQ"])
+        eq_(len(self._reconnect()), 1)
+        self.server.ack(self.client, messages[0]["version"])
+        eq_(self._reconnect(), [])
+
+    def test_topic(self):
+        self.server.client_lost(self.client)
+        self.server.notify(self.token, "a", {}, 60, "t")
+        self.server.notify(self.token, "b", {}, 60, "t")
+        self.server.notify(self.token, "c", {}, 60)
+        eq_([m["data"] for m in self._reconnect()], ["Yg", "Yw"])
+
+    def test_no_store(self):
+        self.server.store = False
+        self.server.client_lost(self.client)
+        self.server.notify(self.token, "a", {}, 60)
+        eq_(self._reconnect(), [])
+
+    def test_unknown_uaid(self):
+        client = Mock(uaid=None)
+        self.server.hello(client, "unknown")
+        ok_(client.uaid != "unknown")
+
+
+class TestScenarios(trialtest.TestCase):
+    def setUp(self):
+        self.server = PushServer()
+        self.server.listen()
+        self.addCleanup(self.server.stop)
+
+    def tearDown(self):
+        from aplt.httpclient import close_pools
+        return close_pools()
+
+    def _launch(self, scenario, *args, **kwargs):
+        metrics = Mock(wraps=SinkMetrics())
+        lr = runner.LoadRunner([(scenario, 1, 1, 0, (args, kwargs))],
+                               metrics, self.server.websocket_url,
+                               None, None, None)
+        lr.start()
+        d = Deferred()
+
+        def check_done():
+            if lr.finished:
+                d.callback(metrics)
+            else:
+                reactor.callLater(0.05, check_done)
+        reactor.callLater(0, check_done)
+        return d
+
+    def _received(self, metrics, count):
+        metrics.increment.assert_any_call("notification.received", 1)
+        eq_(len([c for c in metrics.increment.call_args_list
+                 if c[0][0] == "notification.received"]), count)
+
+    def test_basic(self):
+        d = self._launch(scenarios.basic)
+        d.addCallback(self._received, 1)
+        return d
+
+    def test_basic_vapid(self):
+        d = self._launch(scenarios.basic,
+                         vapid_claims={"sub": "mailto:admin@example.com"})
+        d.addCallback(self._received, 1)
+        return d
+
+    def test_launch_lag(self):
+        # Every launch starts two seconds behind schedule
+        run = runner.RunnerHarness.run
+        patcher = patch.object(
+            runner.RunnerHarness, "run",
+            lambda harness, intended_start=None: run(harness,
+                                                     time.time() - 2))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def check(metrics):
+            latencies = [c[0][1] for c in metrics.timing.call_args_list
+                         if c[0][0] == "update.latency"]
+            eq_(len(latencies), 1)
+            ok_(latencies[0] >= 2000, latencies)
+        d = self._launch(scenarios.basic)
+        d.addCallback(check)
+        return d
+
+    def test_basic_topic(self):
+        d = self._launch(scenarios.basic_topic)
+        d.addCallback(self._received, 1)
+        return d
+
+    def test_notification_forever(self):
+        d = self._launch(scenarios.notification_forever, 0, 1)
+        d.addCallback(self._received, 1)
+        return d
+
+    def test_notification_forever_stored(self):
+        d = self._launch(scenarios.notification_forever_stored, 3, 60, 0, 1)
+        d.addCallback(self._received, 3)
+        return d
+
+    def test_notification_forever_stored_window(self):
+        d = self._launch(scenarios.notification_forever_stored, 3, 60, 0, 1,
+                         send_window=1)
+        d.addCallback(self._received, 3)
+        return d
+
+    def test_notification_forever_direct_store(self):
+        return self._launch(scenarios.notification_forever_direct_store, 0, 1)
+
+    def test_reconnect_forever(self):
+        d = self._launch(scenarios.reconnect_forever, 0, 1)
+        d.addCallback(self._received, 1)
+        return d
+
+    def test_register_forever(self):
+        return self._launch(scenarios.register_forever, 0, 1)
+
+    def test_bad_tokens(self):
+        return self._launch(scenarios.notification_forever_bad_tokens, 0, 1)
+
+    def test_send_notifications(self):
+        d = self._launch(_send_batch, 5, 2)
+        d.addCallback(lambda metrics: metrics.increment.assert_any_call(
+            "batch.created", 5))
+        return d
+
+    def test_expect_notifications(self):
+        return self._launch(scenarios._expect_notifications)
+
+    def test_delay(self):
+        self.server.delay = 0.01
+        d = self._launch(scenarios.basic)
+        d.addCallback(self._received, 1)
+        return d
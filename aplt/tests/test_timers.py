@@ -0,0 +1,174 @@
+import unittest
+
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet import task
+
+import aplt.timers as timers
+from aplt.client import CommandProcessor
+from aplt.commands import counter, wait
+from aplt.timers import TimerWheel
+
+
+def _wait_twice():
+    yield wait(0.2)
+    yield counter("waited", 1)
+    yield wait(0.2)
+    yield counter("waited", 1)
+
+
+class TestTimerWheel(unittest.TestCase):
+    def _make_one(self, slots=8, resolution=0.1):
+        self.clock = task.Clock()
+        return TimerWheel(resolution, slots, clock=self.clock)
+
+    def test_fires(self):
+        wheel = self._make_one()
+        fired = []
+        wheel.call_later(0.25, fired.append, "a")
+        wheel.call_later(0, fired.append, "b")
+        # No delay is a reactor call, not a tick
+        eq_(len(wheel), 1)
+        self.clock.advance(0)
+        eq_(fired, ["b"])
+        self.clock.advance(0.1)
+        eq_(fired, ["b"])
+        self.clock.advance(0.1)
+        eq_(fired, ["b"])
+        self.clock.advance(0.1)
+        eq_(fired, ["b", "a"])
+        eq_(len(wheel), 0)
+        # Stops ticking once nothing's pending
+        eq_(self.clock.getDelayedCalls(), [])
+
+    def test_rounds(self):
+        wheel = self._make_one(slots=4, resolution=1)
+        fired = []
+        wheel.call_later(10, fired.append, "a")
+        wheel.call_later(4, fired.append, "b")
+        self.clock.pump([1] * 4)
+        eq_(fired, ["b"])
+        self.clock.pump([1] * 5)
+        eq_(fired, ["b"])
+        self.clock.advance(1)
+        eq_(fired, ["b", "a"])
+
+    def test_cancel(self):
+        wheel = self._make_one()
+        fired = []
+        timer = wheel.call_later(0.1, fired.append, "a")
+        ok_(timer.active())
+        timer.cancel()
+        ok_(not timer.active())
+        timer.cancel()
+        eq_(len(wheel), 0)
+        eq_(self.clock.getDelayedCalls(), [])
+        wheel.call_later(0.2, fired.append, "b")
+        self.clock.pump([0.1] * 3)
+        eq_(fired, ["b"])
+
+    def test_cancel_immediate(self):
+        wheel = self._make_one()
+        fired = []
+        timer = wheel.call_later(0, fired.append, "a")
+        timer.cancel()
+        ok_(not timer.active())
+        self.clock.advance(0)
+        eq_(fired, [])
+
+    def test_cancel_frees_slot(self):
+        wheel = self._make_one()
+        timers = [wheel.call_later(0.5, Mock()) for _ in range(3)]
+        timers[1].cancel()
+        eq_(sum(len(slot) for slot in wheel._slots), 2)
+
+    def test_cancel_while_firing(self):
+        wheel = self._make_one()
+        fired = []
+        timers = []
+
+        def cancel_others(name):
+            fired.append(name)
+            for timer in timers:
+                timer.cancel()
+        timers.extend(wheel.call_later(0.1, cancel_others, name)
+                      for name in "ab")
+        self.clock.advance(0.1)
+        # Whichever fires first cancels the other
+        eq_(len(fired), 1)
+        eq_(len(wheel), 0)
+        eq_(self.clock.getDelayedCalls(), [])
+
+    def test_never_early(self):
+        wheel = self._make_one(slots=4, resolution=0.25)
+        fired = []
+
+        def done(start, delay):
+            fired.append((start, delay, self.clock.seconds()))
+        # Keep the wheel running, then schedule part way through ticks
+        wheel.call_later(10, Mock())
+        for offset, delay in [(0.125, 0.25), (0.0625, 0.5), (0.125, 1.25),
+                              (0.25, 0.25), (0.1875, 0.0625)]:
+            self.clock.advance(offset)
+            wheel.call_later(delay, done, self.clock.seconds(), delay)
+        self.clock.pump([0.0625] * 40)
+        eq_(len(fired), 5)
+        for start, delay, fire_time in fired:
+            ok_(fire_time - start >= delay, (start, delay, fire_time))
+            ok_(fire_time - start < delay + 0.25, (start, delay, fire_time))
+
+    def test_late_ticks(self):
+        wheel = self._make_one()
+        fired = []
+        for delay in (0.1, 0.3, 0.5):
+            wheel.call_later(delay, fired.append, delay)
+        # A reactor busy for a while catches up on every missed tick
+        self.clock.advance(0.4)
+        eq_(fired, [0.1, 0.3])
+
+    def test_schedule_while_firing(self):
+        wheel = self._make_one()
+        fired = []
+
+        def again():
+            fired.append(len(fired))
+            if len(fired) < 3:
+                wheel.call_later(0.1, again)
+        wheel.call_later(0.1, again)
+        self.clock.pump([0.1] * 5)
+        eq_(fired, [0, 1, 2])
+        eq_(self.clock.getDelayedCalls(), [])
+
+    @patch("aplt.timers.log")
+    def test_error(self, mock_log):
+        wheel = self._make_one()
+        fired = []
+        wheel.call_later(0.1, Mock(side_effect=Exception("Oops")))
+        wheel.call_later(0.1, fired.append, "a")
+        self.clock.advance(0.1)
+        eq_(fired, ["a"])
+        eq_(mock_log.err.call_count, 1)
+
+    def test_processor_waits(self):
+        wheel = self._make_one()
+        harness = Mock()
+        with patch("aplt.client.get_wheel", return_value=wheel):
+            processor = CommandProcessor(_wait_twice, (), {}, harness)
+            processor.run()
+            eq_(len(wheel), 1)
+            self.clock.pump([0.1] * 2)
+            eq_(harness.counter.call_count, 1)
+            # A new timeout replaces the old one
+            processor.setTimeout(5)
+            eq_(len(wheel), 1)
+            processor.setTimeout(None)
+            eq_(len(wheel), 0)
+
+    def test_set_resolution(self):
+        original = timers.get_wheel()
+        try:
+            wheel = timers.set_resolution(0.5)
+            eq_(wheel.resolution, 0.5)
+            ok_(timers.get_wheel() is wheel)
+        finally:
+            timers._default_wheel = original
@@ -0,0 +1,78 @@
+from mock import Mock, patch
+from nose.tools import eq_
+from twisted.internet import defer, protocol, reactor, ssl
+from twisted.trial import unittest as trialtest
+
+from aplt.tls import ResumingClientContextFactory
+
+
+class Greeter(protocol.Protocol):
+    def connectionMade(self):
+        self.transport.write("hello")
+
+
+class Reader(protocol.Protocol):
+    def dataReceived(self, data):
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.factory.done.callback(None)
+
+
+class TestResumingClientContextFactory(trialtest.TestCase):
+    server_options = {}
+
+    def setUp(self):
+        key = ssl.KeyPair.generate(size=2048)
+        cert = key.selfSignedCert(1, CN="localhost")
+        options = ssl.CertificateOptions(
+            privateKey=cert.privateKey.original,
+            certificate=cert.original,
+            enableSessionTickets=True,
+            **self.server_options)
+        self.port = reactor.listenSSL(
+            0, protocol.Factory.forProtocol(Greeter), options,
+            interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+
+    def _connect(self, context_factory):
+        factory = protocol.ClientFactory.forProtocol(Reader)
+        factory.done = defer.Deferred()
+        reactor.connectSSL("127.0.0.1", self.port.getHost().port, factory,
+                           context_factory)
+        return factory.done
+
+    @defer.inlineCallbacks
+    def test_resumption(self):
+        counter = Mock()
+        context_factory = ResumingClientContextFactory("localhost", counter)
+        for _ in range(3):
+            yield self._connect(context_factory)
+        eq_(context_factory.full_handshakes, 1)
+        eq_(context_factory.resumed, 2)
+        eq_([call[0][0] for call in counter.call_args_list],
+            ["tls.full_handshake", "tls.resumed", "tls.resumed"])
+
+    @defer.inlineCallbacks
+    def test_unknown_resumption(self):
+        patcher = patch("aplt.tls._session_reused", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        counter = Mock()
+        context_factory = ResumingClientContextFactory("localhost", counter)
+        for _ in range(2):
+            yield self._connect(context_factory)
+        eq_(context_factory.handshakes, 2)
+        eq_([call[0][0] for call in counter.call_args_list],
+            ["tls.handshake"] * 2)
+
+    def test_shared_context(self):
+        context_factory = ResumingClientContextFactory()
+        one = context_factory.clientConnectionForTLS(None)
+        other = context_factory.clientConnectionForTLS(None)
+        eq_(one.get_context(), other.get_context())
+        eq_(context_factory.getContext(), one.get_context())
+
+
+class TestTLS12Resumption(TestResumingClientContextFactory):
+    server_options = dict(lowerMaximumSecurityTo=ssl.TLSVersion.TLSv1_2)
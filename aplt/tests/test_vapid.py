@@ -0,0 +1,215 @@
+import time
+import unittest
+from tempfile import NamedTemporaryFile
+
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet.defer import Deferred
+from twisted.trial import unittest as trialtest
+
+from aplt.metrics import SinkMetrics
+from aplt.tests import T_PRIVATE
+import aplt.vapid as vapid
+from aplt.vapid import Vapid, VapidCache, VapidException, VapidPool
+
+
+CLAIMS = {"aud": "https://example.com", "sub": "mailto:admin@example.com"}
+
+
+class TestVapidBackends(unittest.TestCase):
+    def setUp(self):
+        self.ecdsa = Vapid(private_key=T_PRIVATE, backend="ecdsa")
+        self.crypto = Vapid(private_key=T_PRIVATE, backend="cryptography")
+
+    def tearDown(self):
+        vapid._default_backend = None
+
+    def _split(self, headers):
+        return str(headers["Authorization"][len("Bearer "):]).split(".")
+
+    def test_default(self):
+        eq_(vapid.get_backend().name, "cryptography")
+        eq_(Vapid().backend.name, "cryptography")
+        vapid.set_default_backend("ecdsa")
+        eq_(Vapid().backend.name, "ecdsa")
+
+    def test_unknown(self):
+        self.assertRaises(VapidException, Vapid, backend="rot13")
+
+    def test_keys_match(self):
+        eq_(self.crypto.private_key_base64, self.ecdsa.private_key_base64)
+        eq_(self.crypto.public_key_urlsafe_base64,
+            self.ecdsa.public_key_urlsafe_base64)
+        for key in (self.crypto, self.ecdsa):
+            key.generate_keys()
+            pem = key.backend.private_pem(key.private_key)
+            eq_(Vapid(private_key=pem, backend="ecdsa").private_key_base64,
+                Vapid(private_key=pem,
+                      backend="cryptography").private_key_base64)
+
+    def test_token_format(self):
+        claims = dict(CLAIMS, exp=1)
+        ecdsa_headers = self.ecdsa.sign(dict(claims), "keyid=p256dh")
+        crypto_headers = self.crypto.sign(dict(claims), "keyid=p256dh")
+        eq_(ecdsa_headers["Crypto-Key"], crypto_headers["Crypto-Key"])
+        eq_(type(ecdsa_headers["Authorization"]),
+            type(crypto_headers["Authorization"]))
+        ecdsa_token = self._split(ecdsa_headers)
+        crypto_token = self._split(crypto_headers)
+        eq_(ecdsa_token[:2], crypto_token[:2])
+        eq_(len(ecdsa_token[2]), len(crypto_token[2]))
+
+    def test_cross_verify(self):
+        for signer, verifier in ((self.ecdsa, self.crypto),
+                                 (self.crypto, self.ecdsa)):
+            header, payload, sig = self._split(signer.sign(dict(CLAIMS)))
+            ok_(verifier.verify_token(sig, header + "." + payload))
+            ok_(not verifier.verify_token(sig, header + "." + header))
+            ok_(verifier.verify_token(signer.validate("token"), "token"))
+
+    def test_save_keys(self):
+        for key in (self.crypto, self.ecdsa):
+            with NamedTemporaryFile() as f:
+                key.save_private_key(f.name)
+                eq_(Vapid(private_key_file=f.name).private_key_base64,
+                    key.private_key_base64)
+            with NamedTemporaryFile() as f:
+                key.save_public_key(f.name)
+                ok_(f.read().startswith("-----BEGIN PUBLIC KEY-----"))
+
+
+class TestVapidCache(unittest.TestCase):
+    def setUp(self):
+        self.vapid = Vapid(private_key=T_PRIVATE)
+
+    def test_reuse(self):
+        metrics = Mock()
+        cache = VapidCache(metrics=metrics)
+        first = cache.sign(self.vapid, dict(CLAIMS), "keyid=p256dh")
+        second = cache.sign(self.vapid, dict(CLAIMS), "keyid=p256dh")
+        eq_(first, second)
+        ok_(first["Authorization"].startswith("Bearer "))
+        ok_(first["Crypto-Key"].startswith("keyid=p256dh,p256ecdsa="))
+        eq_((cache.hits, cache.misses), (1, 1))
+        metrics.increment.assert_any_call("vapid.cache.miss")
+        metrics.increment.assert_called_with("vapid.cache.hit")
+        # Returned headers can be modified without affecting the cache
+        second["Authorization"] = "changed"
+        eq_(cache.sign(self.vapid, CLAIMS, "keyid=p256dh"), first)
+
+    def test_concurrent_misses(self):
+        cache = VapidCache()
+        signing = Deferred()
+        sign = Mock(return_value=signing)
+        first = cache.sign_later(self.vapid, dict(CLAIMS), "k", sign)
+        second = cache.sign_later(self.vapid, dict(CLAIMS), "k", sign)
+        eq_(sign.call_count, 1)
+        ok_("exp" in sign.call_args[0][0])
+        signing.callback({"Authorization": "Bearer x"})
+        results = []
+        first.addCallback(results.append)
+        second.addCallback(results.append)
+        eq_(results, [{"Authorization": "Bearer x"}] * 2)
+        ok_(results[0] is not results[1])
+        # Signed once, then cached
+        third = cache.sign_later(self.vapid, dict(CLAIMS), "k", sign)
+        third.addCallback(results.append)
+        eq_(len(results), 3)
+        eq_(sign.call_count, 1)
+        eq_((cache.hits, cache.misses), (1, 2))
+
+    def test_concurrent_failure(self):
+        cache = VapidCache()
+        signing = Deferred()
+        sign = Mock(return_value=signing)
+        ds = [cache.sign_later(self.vapid, dict(CLAIMS), None, sign)
+              for _ in range(2)]
+        signing.errback(VapidException("Oops"))
+        failures = []
+        for d in ds:
+            d.addErrback(failures.append)
+        eq_(len(failures), 2)
+        # Signed again on the next miss
+        d = cache.sign_later(self.vapid, dict(CLAIMS), None,
+                             lambda claims: {"Authorization": "Bearer y"})
+        d.addCallback(failures.append)
+        eq_(failures[-1], {"Authorization": "Bearer y"})
+
+    def test_claims_not_modified(self):
+        claims = dict(CLAIMS)
+        VapidCache().sign(self.vapid, claims)
+        eq_(claims, CLAIMS)
+
+    def test_keys(self):
+        cache = VapidCache()
+        other = Vapid()
+        other.generate_keys()
+        cache.sign(self.vapid, CLAIMS)
+        cache.sign(other, CLAIMS)
+        cache.sign(self.vapid, dict(CLAIMS, aud="https://example.org"))
+        cache.sign(self.vapid, CLAIMS, "keyid=p256dh")
+        eq_((cache.hits, cache.misses, len(cache)), (0, 4, 4))
+
+    def test_refresh(self):
+        cache = VapidCache(ttl=600, refresh=60)
+        now = time.time()
+        with patch("aplt.vapid.time.time", return_value=now):
+            cache.sign(self.vapid, CLAIMS)
+        with patch("aplt.vapid.time.time", return_value=now + 539):
+            cache.sign(self.vapid, CLAIMS)
+        eq_((cache.hits, cache.misses), (1, 1))
+        with patch("aplt.vapid.time.time", return_value=now + 541):
+            cache.sign(self.vapid, CLAIMS)
+        eq_((cache.hits, cache.misses), (1, 2))
+
+
+class TestVapidPool(trialtest.TestCase):
+    def setUp(self):
+        self.pool = VapidPool(1)
+        self.addCleanup(self.pool.stop)
+
+    def test_sign(self):
+        vapid = Vapid(private_key=T_PRIVATE)
+        d = self.pool.sign(vapid, dict(CLAIMS), "keyid=p256dh")
+
+        def check(headers):
+            ok_(headers["Authorization"].startswith("Bearer "))
+            eq_(headers["Crypto-Key"], "keyid=p256dh,p256ecdsa=" +
+                vapid.public_key_urlsafe_base64)
+        d.addCallback(check)
+        return d
+
+    def test_sign_error(self):
+        d = self.pool.sign(Vapid(private_key=T_PRIVATE), {})
+        return self.assertFailure(d, VapidException)
+
+    def test_generate_keys(self):
+        d = self.pool.generate_keys()
+
+        def check(vapid):
+            ok_(isinstance(vapid, Vapid))
+            ok_(vapid.public_key_urlsafe_base64)
+        d.addCallback(check)
+        return d
+
+    def test_harness_signing(self):
+        from aplt.runner import RunnerHarness
+        from aplt.scenarios import basic
+        h = RunnerHarness(Mock(), "ws://localhost/", SinkMetrics(), basic,
+                          None, None, None, self.pool)
+        # Keys are still being generated
+        eq_(h._vapid, None)
+        first = h._sign_claims(dict(CLAIMS))
+        second = h._sign_claims(dict(CLAIMS))
+
+        def check(headers):
+            ok_(h._vapid)
+            ok_(headers["Crypto-Key"].endswith(
+                h._vapid.public_key_urlsafe_base64))
+            eq_(h._vapid_cache.misses, 2)
+            d = h._sign_claims(dict(CLAIMS))
+            d.addCallback(lambda _: eq_(h._vapid_cache.hits, 1))
+            return d
+        second.addCallback(lambda _: first)
+        second.addCallback(check)
+        return second
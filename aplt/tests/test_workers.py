@@ -0,0 +1,116 @@
+import json
+import os
+import signal
+import unittest
+
+from mock import Mock, patch
+from nose.tools import eq_, ok_
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.trial import unittest as trialtest
+
+import aplt.payloads as payloads
+from aplt.metrics import PipeMetrics
+import aplt.runner as runner
+from aplt.workers import METRICS_FD, WorkerProtocol, WorkerSupervisor
+
+
+class TestSplitTestplan(unittest.TestCase):
+    def test_split_quantity(self):
+        shares = [runner.split_quantity(1003, 100, 4, i) for i in range(4)]
+        eq_(shares, [(251, 25), (251, 25), (251, 25), (250, 25)])
+        eq_(sum(q for q, _ in shares), 1003)
+
+    def test_split_small_stagger(self):
+        shares = [runner.split_quantity(10, 2, 4, i) for i in range(4)]
+        eq_(shares, [(5, 1), (5, 1), (0, 0), (0, 0)])
+
+    def test_split_testplan(self):
+        args = ([], {})
+        plans = [("a", 10, 2, 0, args), ("b", 8, 8, 5, args)]
+        eq_(runner.split_testplan(plans, 4, 0),
+            [("a", 5, 1, 0, args), ("b", 2, 2, 5, args)])
+        eq_(runner.split_testplan(plans, 4, 3), [("b", 2, 2, 5, args)])
+
+
+class TestPipeMetrics(unittest.TestCase):
+    def test_forwarding(self):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        m = PipeMetrics(write_fd)
+        m.increment("test", 5)
+        m.timing("lifespan", 113)
+        m.gauge("connections", 7)
+        m.flush()
+
+        supervisor = WorkerSupervisor([], 1, Mock())
+        worker = WorkerProtocol(supervisor, 0)
+        data = os.read(read_fd, 4096)
+        # Split across reads, and ignoring other fds
+        worker.childDataReceived(1, "noise\n")
+        worker.childDataReceived(METRICS_FD, data[:7])
+        worker.childDataReceived(METRICS_FD, data[7:])
+        supervisor.metrics.increment.assert_called_with("test", 5)
+        supervisor.metrics.timing.assert_called_with("lifespan", 113)
+        supervisor.metrics.gauge.assert_called_with("connections", 7)
+
+    def test_bad_line(self):
+        supervisor = WorkerSupervisor([], 1, Mock())
+        supervisor.metric_received("not json")
+        supervisor.metric_received(json.dumps(["meter", "a", 1]))
+        eq_(supervisor.metrics.mock_calls, [])
+
+
+class TestWorkers(trialtest.TestCase):
+    def _check_done(self, supervisor, d):
+        if supervisor.finished:
+            d.callback(True)
+        else:
+            reactor.callLater(0.5, self._check_done, supervisor, d)
+
+    def test_workers(self):
+        supervisor = runner.run_testplan([
+            "--workers=2",
+            "aplt.tests:_count_once, 3, 3, 0",
+        ], run=False)
+        supervisor.metrics = Mock()
+        ok_(not supervisor.finished)
+        # Only the workers generate payloads
+        ok_(payloads._pool is None)
+
+        def check_metrics(result):
+            eq_(supervisor.metrics.increment.call_count, 3)
+            supervisor.metrics.increment.assert_called_with("test.count", 1)
+
+        d = Deferred()
+        d.addCallback(check_metrics)
+        reactor.callLater(0.5, self._check_done, supervisor, d)
+        return d
+
+
+class TestSignals(unittest.TestCase):
+    @patch("aplt.workers.reactor")
+    def test_forward_signals(self, mock_reactor):
+        handlers = {}
+        previous = Mock()
+        with patch.object(signal, "getsignal", return_value=previous), \
+                patch.object(signal, "signal", handlers.__setitem__):
+            supervisor = WorkerSupervisor([], 1, Mock())
+            supervisor.forward_signals()
+        eq_(sorted(handlers), sorted([signal.SIGINT, signal.SIGTERM]))
+        handlers[signal.SIGINT](signal.SIGINT, None)
+        previous.assert_called_once_with(signal.SIGINT, None)
+
+        process = Mock()
+        supervisor._processes = {WorkerProtocol(supervisor, 0): process}
+        supervisor.stop()
+        process.signalProcess.assert_called_once_with(signal.SIGINT)
+
+    @patch("aplt.workers.reactor")
+    def test_default_sigterm(self, mock_reactor):
+        supervisor = WorkerSupervisor([], 1, Mock())
+        process = Mock()
+        supervisor._processes = {WorkerProtocol(supervisor, 0): process}
+        supervisor.stop()
+        process.signalProcess.assert_called_once_with(signal.SIGTERM)
@@ -0,0 +1,169 @@
+"""Shared timer wheel
+
+Every :class:`aplt.client.CommandProcessor` has at most one timeout pending,
+for a ``wait`` or an expected notification, and with hundreds of thousands
+of virtual clients giving each its own reactor ``DelayedCall`` makes the
+reactor's heap of delayed calls the bottleneck. Instead, their timeouts go
+into a hashed timing wheel: a ring of slots each holding the timers due on
+one tick, advanced by a single periodic call. Scheduling and cancelling a
+timer are O(1), and timers fire no sooner than their delay and within one
+tick of it.
+
+"""
+import math
+
+from twisted.internet import reactor, task
+from twisted.python import log
+
+
+class Timer(object):
+    """A pending call on a :class:`TimerWheel`"""
+    __slots__ = ("wheel", "slot", "rounds", "func", "args")
+
+    def __init__(self, wheel, slot, rounds, func, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.func = func
+        self.args = args
+
+    def active(self):
+        """Indicates whether the timer is still to fire"""
+        return self.func is not None
+
+    def cancel(self):
+        """Cancel the call if it hasn't been made yet"""
+        if self.func is not None:
+            self.func = self.args = None
+            self.wheel._removed(self)
+
+
+class TimerWheel(object):
+    """Calls functions after a delay, rounded up to whole ticks
+
+    :param resolution: Seconds per tick.
+    :param slots: Number of slots in the wheel. Timers more than ``slots``
+        ticks away go round the wheel more than once.
+
+    The wheel only ticks while it has timers pending. Timers with no delay
+    are called on the next reactor iteration instead. Timers due on the same
+    tick are called in no particular order.
+
+    """
+    def __init__(self, resolution=0.01, slots=1024, clock=reactor):
+        self.resolution = resolution
+        self._slots = [set() for _ in range(slots)]
+        self._index = 0
+        # Ticks the wheel has advanced since its loop started
+        self._ticks = 0
+        self._pending = 0
+        self._ticking = False
+        self._loop = task.LoopingCall.withCount(self._tick)
+        self._loop.clock = clock
+        self._clock = clock
+
+    def __len__(self):
+        return self._pending
+
+    def call_later(self, delay, func, *args):
+        """Call ``func`` with ``args`` once ``delay`` seconds have passed
+
+        :returns: a :class:`Timer` that can be cancelled.
+
+        """
+        if delay <= 0:
+            timer = Timer(self, None, 0, func, args)
+            self._clock.callLater(0, self._fire, timer)
+            return timer
+        if self._loop.running:
+            # Time passed since the wheel last advanced counts against the
+            # first tick, so the delay is never cut short
+            since = self._clock.seconds() - (
+                self._loop.starttime + self._ticks * self.resolution)
+            delay += max(since, 0)
+        # Rounded first, so float error doesn't add a tick
+        ticks = max(int(math.ceil(round(delay / self.resolution, 6))), 1)
+        count = len(self._slots)
+        slot = (self._index + ticks) % count
+        timer = Timer(self, slot, (ticks - 1) // count, func, args)
+        self._slots[slot].add(timer)
+        self._pending += 1
+        if not self._loop.running:
+            self._ticks = 0
+            self._loop.start(self.resolution, now=False)
+        return timer
+
+    def _removed(self, timer):
+        if timer.slot is None:
+            return
+        # Not found if its slot is firing, having already been taken out
+        self._slots[timer.slot].discard(timer)
+        self._pending -= 1
+        self._stop_idle()
+
+    def _stop_idle(self):
+        # Left to the end of a tick, as the loop can't restart during one
+        if not self._pending and not self._ticking and self._loop.running:
+            self._loop.stop()
+
+    def _tick(self, ticks):
+        self._ticking = True
+        try:
+            # Catch up on any ticks missed while the reactor was busy
+            for _ in range(ticks):
+                if not self._pending:
+                    break
+                self._ticks += 1
+                self._advance()
+        finally:
+            self._ticking = False
+        self._stop_idle()
+
+    def _advance(self):
+        count = len(self._slots)
+        self._index = (self._index + 1) % count
+        due = self._slots[self._index]
+        self._slots[self._index] = waiting = set()
+        for timer in due:
+            if timer.func is None:
+                continue
+            if timer.rounds:
+                timer.rounds -= 1
+                waiting.add(timer)
+                continue
+            self._pending -= 1
+            self._fire(timer)
+
+    def _fire(self, timer):
+        func, args = timer.func, timer.args
+        if func is None:
+            return
+        timer.func = timer.args = None
+        try:
+            func(*args)
+        except Exception:
+            log.err()
+
+
+_default_wheel = None
+
+
+def get_wheel():
+    """Return the shared timer wheel, creating it with the default
+    resolution unless :func:`set_resolution` was called first"""
+    global _default_wheel
+    if _default_wheel is None:
+        _default_wheel = TimerWheel()
+    return _default_wheel
+
+
+def set_resolution(resolution):
+    """Replace the shared timer wheel with one ticking every ``resolution``
+    seconds
+
+    Timers already scheduled still fire on the wheel they were scheduled on.
+
+    """
+    global _default_wheel
+    _default_wheel = TimerWheel(resolution)
+    return _default_wheel
@@ -0,0 +1,86 @@
+"""TLS client connections with session resumption
+
+Every ``wss`` connection from a :class:`aplt.runner.RunnerHarness` is made
+with one shared OpenSSL context. The latest session, or with TLS 1.3 the
+latest session ticket, is offered on every new connection, so a server
+supporting resumption skips the key exchange and certificate checks that
+make connection storms expensive for the load-tester.
+
+"""
+import weakref
+
+from OpenSSL import SSL
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from zope.interface import implementer
+
+# pyOpenSSL has no public way to tell whether a session was resumed, so
+# its private binding is used where it's there
+try:
+    from OpenSSL._util import lib as _lib
+except ImportError:  # pragma: nocover
+    _lib = None
+_session_reused = getattr(_lib, "SSL_session_reused", None)
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class ResumingClientContextFactory(object):
+    """Creates TLS client connections from one shared context, resuming
+    the latest session where the server allows
+
+    Like :class:`twisted.internet.ssl.ClientContextFactory`, certificates
+    aren't verified.
+
+    :param hostname: Server name to send with SNI, if any.
+    :param counter: Optional callable taking a metric name, called with
+        ``tls.resumed`` or ``tls.full_handshake`` once every handshake
+        completes, or ``tls.handshake`` if pyOpenSSL can't tell which.
+
+    """
+    def __init__(self, hostname=None, counter=None):
+        self._hostname = hostname.encode("ascii") if hostname else None
+        self._counter = counter
+        self._session = None
+        # Connections yet to complete their first handshake
+        self._handshaking = weakref.WeakSet()
+        self.resumed = 0
+        self.full_handshakes = 0
+        # Handshakes that couldn't be told apart
+        self.handshakes = 0
+        self._context = SSL.Context(SSL.SSLv23_METHOD)
+        self._context.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+        self._context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        self._context.set_info_callback(self._info)
+
+    def getContext(self):
+        """The shared context, for callers expecting a context factory"""
+        return self._context
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = SSL.Connection(self._context, None)
+        if self._hostname:
+            connection.set_tlsext_host_name(self._hostname)
+        if self._session is not None:
+            connection.set_session(self._session)
+        self._handshaking.add(connection)
+        return connection
+
+    def _info(self, connection, where, ret):
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            self._session = connection.get_session()
+            self._handshaking.discard(connection)
+            if _session_reused is None:
+                self.handshakes += 1
+                name = "tls.handshake"
+            elif _session_reused(connection._ssl):
+                self.resumed += 1
+                name = "tls.resumed"
+            else:
+                self.full_handshakes += 1
+                name = "tls.full_handshake"
+            if self._counter is not None:
+                self._counter(name)
+        elif (where & SSL.SSL_CB_CONNECT_EXIT == SSL.SSL_CB_CONNECT_EXIT and
+              ret > 0 and connection not in self._handshaking):
+            # With TLS 1.3 the session tickets only come after the
+            # handshake, so the session is only then worth resuming
+            self._session = connection.get_session()
@@ -1,18 +1,16 @@
 """Scenario utilities"""
 
-import string
-import random
-
 from OpenSSL import SSL
 from OpenSSL.crypto import FILETYPE_PEM, load_certificate, load_privatekey
 from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 from twisted.web.iweb import IPolicyForHTTPS
 from zope.interface import implementer
 
+from aplt.payloads import get_pool
+
 
 def string_generator(length=10):
-    return ''.join(random.choice(string.ascii_lowercase + string.digits)
-                   for _ in range(length))
+    return get_pool().string(length)
 
 
 def bad_push_endpoint(push_endpoint=None, token_length=None):
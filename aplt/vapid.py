@@ -1,10 +1,28 @@
 import base64
+import binascii
+import json
 import time
 import hashlib
+import multiprocessing
+import signal
 
 import ecdsa
 import logging
 from jose import jws
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.asymmetric.utils import (
+        decode_dss_signature,
+        encode_dss_signature,
+    )
+except ImportError:  # pragma: nocover
+    ec = None
 
 
 logger = logging.getLogger()
@@ -14,36 +32,198 @@ class VapidException(Exception):
     pass
 
 
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).strip('=')
+
+
+class EcdsaBackend(object):
+    """Pure python P-256 signing with ``ecdsa`` and ``python-jose``
+
+    Backends load, generate, serialize and sign with keys of their own type.
+    Signatures are the raw 64 byte ``r || s`` form used by JWS, and public
+    keys the raw 64 byte ``x || y`` point used in the ``Crypto-Key`` header.
+
+    """
+    name = "ecdsa"
+
+    def generate_key(self):
+        return ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+
+    def load_pem(self, pem):
+        return ecdsa.SigningKey.from_pem(pem)
+
+    def load_der(self, der):
+        return ecdsa.SigningKey.from_der(der)
+
+    def private_pem(self, key):
+        return key.to_pem()
+
+    def private_der(self, key):
+        return key.to_der()
+
+    def public_key(self, key):
+        return key.get_verifying_key()
+
+    def public_pem(self, public_key):
+        return public_key.to_pem()
+
+    def public_raw(self, public_key):
+        return public_key.to_string()
+
+    def sign(self, key, data):
+        return key.sign(data, hashfunc=hashlib.sha256)
+
+    def verify(self, public_key, signature, data):
+        try:
+            return public_key.verify(signature, data, hashfunc=hashlib.sha256)
+        except ecdsa.BadSignatureError:
+            return False
+
+    def sign_jwt(self, key, claims):
+        return jws.sign(claims, key, algorithm="ES256")
+
+
+class CryptographyBackend(EcdsaBackend):
+    """OpenSSL backed P-256 signing with ``cryptography``
+
+    JWTs are assembled the same way ``python-jose`` does, so tokens are
+    interchangeable with :class:`EcdsaBackend` ones.
+
+    """
+    name = "cryptography"
+
+    def __init__(self):
+        self._backend = default_backend()
+        self._curve = ec.SECP256R1()
+        self._algorithm = ec.ECDSA(hashes.SHA256())
+
+    def generate_key(self):
+        return ec.generate_private_key(self._curve, self._backend)
+
+    def load_pem(self, pem):
+        return serialization.load_pem_private_key(pem, None, self._backend)
+
+    def load_der(self, der):
+        return serialization.load_der_private_key(der, None, self._backend)
+
+    def _private_bytes(self, key, encoding):
+        return key.private_bytes(
+            encoding, serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption())
+
+    def private_pem(self, key):
+        return self._private_bytes(key, serialization.Encoding.PEM)
+
+    def private_der(self, key):
+        return self._private_bytes(key, serialization.Encoding.DER)
+
+    def public_key(self, key):
+        return key.public_key()
+
+    def public_pem(self, public_key):
+        return public_key.public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    def public_raw(self, public_key):
+        # Strip the leading 0x04 marking an uncompressed point
+        return public_key.public_bytes(
+            serialization.Encoding.X962,
+            serialization.PublicFormat.UncompressedPoint)[1:]
+
+    def sign(self, key, data):
+        r, s = decode_dss_signature(key.sign(data, self._algorithm))
+        return binascii.unhexlify("%064x%064x" % (r, s))
+
+    def verify(self, public_key, signature, data):
+        if len(signature) != 64:
+            return False
+        r = int(binascii.hexlify(signature[:32]), 16)
+        s = int(binascii.hexlify(signature[32:]), 16)
+        try:
+            public_key.verify(encode_dss_signature(r, s), data,
+                              self._algorithm)
+        except InvalidSignature:
+            return False
+        return True
+
+    def sign_jwt(self, key, claims):
+        header = _b64url(json.dumps({"typ": "JWT", "alg": "ES256"},
+                                    separators=(',', ':')).encode('utf-8'))
+        payload = _b64url(json.dumps(claims,
+                                     separators=(',', ':')).encode('utf-8'))
+        signing_input = header + "." + payload
+        signature = _b64url(self.sign(key, signing_input))
+        return (signing_input + "." + signature).decode('utf-8')
+
+
+BACKENDS = {"ecdsa": EcdsaBackend}
+if ec is not None:
+    BACKENDS["cryptography"] = CryptographyBackend
+
+_default_backend = None
+
+
+def get_backend(name=None):
+    """Return the backend with the given name, or the default one
+
+    The default is ``cryptography`` when it's installed, and ``ecdsa``
+    otherwise, unless changed with :func:`set_default_backend`.
+
+    """
+    if name is None:
+        global _default_backend
+        if _default_backend is None:
+            _default_backend = get_backend(
+                "cryptography" if "cryptography" in BACKENDS else "ecdsa")
+        return _default_backend
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise VapidException("Unknown VAPID backend: {}".format(name))
+
+
+def set_default_backend(name):
+    """Set the backend used by :class:`Vapid` instances that don't specify
+    one"""
+    global _default_backend
+    _default_backend = get_backend(name)
+    return _default_backend
+
+
 class Vapid(object):
     """Minimal VAPID signature generation library."""
     _private_key = None
     _public_key = None
-    _hasher = hashlib.sha256
 
-    def __init__(self, private_key_file=None, private_key=None):
+    def __init__(self, private_key_file=None, private_key=None, backend=None):
         """Initialize VAPID using an optional file containing a private key
         in PEM format.
 
         :param private_key_file: The name of the file containing the
         private key
+        :param backend: The crypto backend, or the name of one, to use in
+        place of the default from :func:`get_backend`
 
         """
+        if backend is None or isinstance(backend, basestring):
+            backend = get_backend(backend)
+        self.backend = backend
         if private_key_file:
             with open(private_key_file) as f:
                 private_key = f.read()
         if private_key:
             try:
                 if "BEGIN EC" in private_key:
-                    self._private_key = ecdsa.SigningKey.from_pem(private_key)
+                    self._private_key = backend.load_pem(private_key)
                 else:
-                    self._private_key = \
-                        ecdsa.SigningKey.from_der(
-                            base64.standard_b64decode(
-                                private_key + '===='[len(private_key) % 4:]))
+                    self._private_key = backend.load_der(
+                        base64.standard_b64decode(
+                            private_key + '===='[len(private_key) % 4:]))
             except Exception, exc:
                 logger.error("Could not open private key file: %s", repr(exc))
                 raise VapidException(exc)
-            self._publicKey = self._private_key.get_verifying_key()
+            self._public_key = backend.public_key(self._private_key)
 
     @property
     def private_key(self):
@@ -61,16 +241,25 @@ class Vapid(object):
     def public_key(self):
         """The public half of the VAPID ECDSA key. """
         if not self._public_key:
-            self._public_key = self.private_key.get_verifying_key()
+            self._public_key = self.backend.public_key(self.private_key)
         return self._public_key
 
+    @property
+    def private_key_base64(self):
+        """The private key as base64 encoded DER, as accepted by
+        :meth:`__init__`."""
+        return base64.standard_b64encode(
+            self.backend.private_der(self.private_key))
+
     @property
     def public_key_urlsafe_base64(self):
-        return self._encode(self.public_key.to_string()).strip('=')
+        return self._encode(
+            self.backend.public_raw(self.public_key)).strip('=')
 
     def generate_keys(self):
         """Generate a valid ECDSA Key Pair."""
-        self.private_key = ecdsa.SigningKey.generate(curve=ecdsa.NIST256p)
+        self.private_key = self.backend.generate_key()
+        self._public_key = None
         # init the public key using the above property function
         self.public_key
 
@@ -79,7 +268,7 @@ class Vapid(object):
         with open(key_file, "w") as f:
             if not self._private_key:
                 self.generate_keys()
-            f.write(self._private_key.to_pem())
+            f.write(self.backend.private_pem(self._private_key))
 
     def save_public_key(self, key_file):
         """Save the public key to a PEM file.
@@ -88,7 +277,7 @@ class Vapid(object):
 
         """
         with open(key_file, "w") as f:
-            f.write(self.public_key.to_pem())
+            f.write(self.backend.public_pem(self.public_key))
 
     def _encode(self, str):
         return base64.urlsafe_b64encode(str).strip('=')
@@ -102,7 +291,7 @@ class Vapid(object):
         :token: is the token value provided from the developer dashboard.
 
         """
-        sig = self.private_key.sign(token, hashfunc=self._hasher)
+        sig = self.backend.sign(self.private_key, token)
         token = self._encode(sig).strip('=')
         return token
 
@@ -118,8 +307,7 @@ class Vapid(object):
 
         """
         hsig = self._decode(sig)
-        return self.public_key.verify(hsig, token,
-                                      hashfunc=self._hasher)
+        return self.backend.verify(self.public_key, hsig, token)
 
     def sign(self, claims, crypto_key=None):
         """Sign a set of claims.
@@ -141,7 +329,7 @@ class Vapid(object):
             raise VapidException(
                 "Missing 'sub' from claims. "
                 "'sub' is your admin email as a mailto: link.")
-        sig = jws.sign(claims, self.private_key, algorithm="ES256")
+        sig = self.backend.sign_jwt(self.private_key, claims)
         pkey = 'p256ecdsa='
         pkey += self.public_key_urlsafe_base64
         if crypto_key:
@@ -151,3 +339,200 @@ class Vapid(object):
 
         return {"Authorization": "Bearer " + sig.strip('='),
                 "Crypto-Key": crypto_key}
+
+
+class VapidCache(object):
+    """Cache of signed VAPID headers
+
+    Signing is expensive, and the same claims get signed for every
+    notification sent to an endpoint host. Signed headers are cached by
+    ``aud``, ``sub``, the signing key, and the ``crypto_key`` the public key
+    is appended to. Each entry is reused until ``refresh`` seconds before its
+    ``exp``, then signed again. With :meth:`sign_later`, misses for an entry
+    that's already being signed wait on that signature rather than signing
+    again.
+
+    :param ttl: Seconds until the ``exp`` of newly signed claims that don't
+        specify one.
+    :param refresh: Seconds before ``exp`` that an entry is re-signed.
+    :param metrics: Optional :class:`aplt.metrics.IMetrics` to count
+        ``vapid.cache.hit`` and ``vapid.cache.miss`` to.
+
+    """
+    def __init__(self, ttl=86400, refresh=300, metrics=None):
+        self.ttl = ttl
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._metrics = metrics
+        self._entries = {}
+        # Deferreds waiting on an entry being signed, by its key
+        self._signing = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, vapid, claims, crypto_key):
+        return (claims.get('aud'), claims.get('sub'),
+                vapid.public_key_urlsafe_base64, crypto_key)
+
+    def lookup(self, vapid, claims, crypto_key=None):
+        """Return a copy of the cached headers for the claims, or None if
+        they need signing"""
+        entry = self._entries.get(self._key(vapid, claims, crypto_key))
+        if entry and time.time() < entry[0] - self.refresh:
+            self.hits += 1
+            if self._metrics:
+                self._metrics.increment("vapid.cache.hit")
+            return dict(entry[1])
+        self.misses += 1
+        if self._metrics:
+            self._metrics.increment("vapid.cache.miss")
+
+    def prepare(self, claims):
+        """Return a copy of the claims with an ``exp`` set to sign"""
+        claims = dict(claims)
+        if not claims.get('exp'):
+            claims['exp'] = int(time.time()) + self.ttl
+        return claims
+
+    def store(self, vapid, claims, crypto_key, headers):
+        """Cache the headers signed for prepared claims"""
+        self._entries[self._key(vapid, claims, crypto_key)] = (
+            claims['exp'], headers)
+        return dict(headers)
+
+    def sign(self, vapid, claims, crypto_key=None):
+        """Sign a set of claims with a :class:`Vapid`, reusing a previous
+        signature where possible.
+
+        :returns result: a hash containing the header fields to use in
+            the subscription update.
+
+        """
+        headers = self.lookup(vapid, claims, crypto_key)
+        if headers is None:
+            claims = self.prepare(claims)
+            headers = self.store(vapid, claims, crypto_key,
+                                 vapid.sign(claims, crypto_key))
+        return headers
+
+    def sign_later(self, vapid, claims, crypto_key, sign):
+        """Return a deferred firing with the headers for a set of claims,
+        cached or signed by ``sign``
+
+        :param sign: Callable taking the prepared claims and returning the
+            signed headers, or a deferred firing with them. It's only called
+            once for misses made while an entry is being signed.
+
+        """
+        headers = self.lookup(vapid, claims, crypto_key)
+        if headers is not None:
+            return defer.succeed(headers)
+        key = self._key(vapid, claims, crypto_key)
+        d = defer.Deferred()
+        if key in self._signing:
+            self._signing[key].append(d)
+            return d
+        self._signing[key] = [d]
+        claims = self.prepare(claims)
+        signing = defer.maybeDeferred(sign, claims)
+        signing.addBoth(self._signed, key, vapid, claims, crypto_key)
+        return d
+
+    def _signed(self, result, key, vapid, claims, crypto_key):
+        waiting = self._signing.pop(key)
+        if isinstance(result, Failure):
+            for d in waiting:
+                d.errback(result)
+            return
+        self.store(vapid, claims, crypto_key, result)
+        for d in waiting:
+            d.callback(dict(result))
+
+
+# Keys already loaded by a pool worker process, by their base64 DER
+_pool_keys = {}
+
+
+def _pool_init():
+    """Restore default signal handling in a pool worker
+
+    Workers forked from a running reactor inherit its signal handlers, which
+    would otherwise leave them ignoring :meth:`multiprocessing.Pool.terminate`.
+    Interrupts are left to the parent process.
+
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _pool_call(func, *args):
+    """Run a function in a pool worker, returning whether it succeeded along
+    with its result or exception"""
+    try:
+        return True, func(*args)
+    except Exception as exc:
+        return False, exc
+
+
+def _pool_sign(private_key, claims, crypto_key):
+    vapid = _pool_keys.get(private_key)
+    if vapid is None:
+        vapid = _pool_keys[private_key] = Vapid(private_key=private_key)
+    return vapid.sign(claims, crypto_key)
+
+
+def _pool_generate_keys():
+    vapid = Vapid()
+    vapid.generate_keys()
+    return vapid.private_key_base64
+
+
+class VapidPool(object):
+    """Runs VAPID signing and key generation in a pool of processes
+
+    Results are returned as deferreds that fire in the reactor thread, so the
+    reactor keeps running while the ECDSA work is done on other cores.
+
+    :param processes: Number of worker processes, defaults to the number of
+        CPUs.
+
+    """
+    def __init__(self, processes=None):
+        self._pool = multiprocessing.Pool(processes, _pool_init)
+
+    def _apply(self, func, *args):
+        d = defer.Deferred()
+
+        def finished(result):
+            success, value = result
+            reactor.callFromThread(d.callback if success else d.errback,
+                                   value)
+        self._pool.apply_async(_pool_call, (func,) + args, callback=finished)
+        return d
+
+    def sign(self, vapid, claims, crypto_key=None):
+        """Sign a set of claims with the key of a :class:`Vapid`
+
+        :returns result: a deferred firing with the header fields to use in
+            the subscription update.
+
+        """
+        return self._apply(_pool_sign, vapid.private_key_base64, claims,
+                           crypto_key)
+
+    def generate_keys(self):
+        """Generate a new :class:`Vapid` with a valid ECDSA key pair
+
+        :returns result: a deferred firing with the :class:`Vapid`.
+
+        """
+        d = self._apply(_pool_generate_keys)
+        d.addCallback(lambda private_key: Vapid(private_key=private_key))
+        return d
+
+    def stop(self):
+        """Stop the worker processes"""
+        self._pool.terminate()
+        self._pool.join()
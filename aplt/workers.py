@@ -0,0 +1,156 @@
+"""Multi-process test plan runner
+
+A supervising process spawns a worker process per CPU core (or however many
+are requested). Each worker runs its own reactor and an equal slice of the
+test plan, and reports its metrics back to the supervisor over a pipe where
+they're merged into a single metrics stream.
+
+"""
+import json
+import os
+import signal
+import sys
+
+from twisted.internet import defer, protocol, reactor
+from twisted.python import log
+
+
+# File descriptor workers write their metric lines to
+METRICS_FD = 3
+
+# Seconds to wait for workers to exit on shutdown before killing them
+KILL_TIMEOUT = 10
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """Supervises a single worker process"""
+    def __init__(self, supervisor, index):
+        self._supervisor = supervisor
+        self.index = index
+        self._buffer = ""
+
+    def childDataReceived(self, childFD, data):
+        if childFD != METRICS_FD:
+            return
+        lines = (self._buffer + data).split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            self._supervisor.metric_received(line)
+
+    def processEnded(self, reason):
+        self._supervisor.worker_ended(self, reason)
+
+
+class WorkerSupervisor(object):
+    """Spawns and supervises the worker processes for a test plan
+
+    When the supervisor's reactor shuts down, the workers are sent the
+    SIGINT or SIGTERM that stopped it (see :meth:`forward_signals`), or
+    SIGTERM otherwise, and given :data:`KILL_TIMEOUT` seconds to stop.
+
+    """
+    def __init__(self, args, workers, metrics):
+        self._args = list(args)
+        self._workers = workers
+        self.metrics = metrics
+        self._processes = {}
+        self._started = False
+        self._stopping = None
+        # The signal that stopped the supervisor, sent on to the workers
+        self._signal = None
+
+    def start(self):
+        """Spawn all the workers"""
+        for index in range(self._workers):
+            worker = WorkerProtocol(self, index)
+            argv = [sys.executable, "-m", "aplt.workers"] + self._args + [
+                "--worker_index={}".format(index)]
+            self._processes[worker] = reactor.spawnProcess(
+                worker, sys.executable, argv, env=os.environ,
+                childFDs={0: "w", 1: 1, 2: 2, METRICS_FD: "r"})
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+        self._started = True
+
+    def stop(self):
+        """Forward a termination signal to all running workers
+
+        Returns a deferred that fires once they've all exited.
+
+        """
+        if not self._processes:
+            return
+        if self._stopping:
+            return self._stopping
+        self._stopping = defer.Deferred()
+        self._signal_all(self._signal or signal.SIGTERM)
+        kill = reactor.callLater(KILL_TIMEOUT, self._signal_all,
+                                 signal.SIGKILL)
+        self._stopping.addBoth(
+            lambda result: kill.active() and kill.cancel())
+        return self._stopping
+
+    def forward_signals(self):
+        """Note a SIGINT or SIGTERM received before the existing handler
+        stops the reactor, so it's the one sent to the workers
+
+        Call once the reactor is running, as it installs its own handlers
+        when it starts.
+
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            handler = signal.getsignal(signum)
+            if callable(handler):
+                signal.signal(signum, self._noting_signal(handler))
+
+    def _noting_signal(self, handler):
+        def noted(signum, frame):
+            self._signal = signum
+            return handler(signum, frame)
+        return noted
+
+    def _signal_all(self, signum):
+        for process in self._processes.values():
+            try:
+                process.signalProcess(signum)
+            except Exception:  # pragma: nocover
+                # Already exited
+                pass
+
+    def metric_received(self, line):
+        """Merge a metric line from a worker into our metrics client"""
+        try:
+            method, name, value = json.loads(line)
+        except ValueError:
+            log.msg("Invalid metric line from worker: {!r}".format(line))
+            return
+        if method == "increment":
+            self.metrics.increment(name, value)
+        elif method == "timing":
+            self.metrics.timing(name, value)
+        elif method == "gauge":
+            self.metrics.gauge(name, value)
+
+    def worker_ended(self, worker, reason):
+        """Remove an exited worker"""
+        self._processes.pop(worker, None)
+        exit_code = getattr(reason.value, "exitCode", None)
+        if exit_code:
+            log.msg("Worker {} exited with code {}".format(worker.index,
+                                                           exit_code))
+        if not self._processes and self._stopping:
+            self._stopping.callback(None)
+
+    @property
+    def finished(self):
+        """Indicates whether all the workers have been started and exited"""
+        return self._started and not self._processes
+
+
+def main():
+    """Run a single worker, see :func:`aplt.runner.run_testplan`"""
+    from aplt.runner import run_testplan
+    run_testplan(sys.argv[1:])
+
+
+if __name__ == "__main__":
+    main()
@@ -16,5 +16,9 @@ setup(
     [console_scripts]
     aplt_scenario = aplt.runner:run_scenario
     aplt_testplan = aplt.runner:run_testplan
+    aplt_coordinator = aplt.coordinator:run_coordinator
+    aplt_agent = aplt.coordinator:run_agent
+    aplt_bench = aplt.bench:run_bench
+    aplt_server = aplt.server:run_server
     """
 )